@@ -0,0 +1,356 @@
+import hashlib
+import io
+import os
+import queue
+import shutil
+import struct
+import tarfile
+import tempfile
+import zlib
+from concurrent.futures import Future
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import settings
+from customexceptions import ArchiveException
+from staging import ChunkDuplicates, staged_name, wait_for_pending_chunks
+
+
+class ChunkStream(io.RawIOBase):
+    # Readable file object fed with chunks of an upload from the event loop,
+    # so a parser thread can consume the archive while it is still arriving.
+    # The queue is bounded, which pushes back on the upload when staging
+    # falls behind.
+    def __init__(self, max_chunks: int) -> None:
+        super().__init__()
+        self._chunks: queue.Queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = b""
+        self._eof = False
+        self.abandoned = False  # set by the reader when it stops early
+
+    def readable(self) -> bool:
+        return True
+
+    def feed(self, chunk: bytes, block: bool = True) -> bool:
+        # Returns False when the chunk could not be queued without blocking
+        while not self.abandoned:
+            try:
+                self._chunks.put(chunk, block=block, timeout=0.5 if block else None)
+                return True
+            except queue.Full:
+                if not block:
+                    return False
+        return True
+
+    def finish(self) -> None:
+        self.feed(b"")
+
+    def readinto(self, target) -> int:
+        while not self._buffer and not self._eof:
+            try:
+                chunk = self._chunks.get(timeout=0.5)
+            except queue.Empty:
+                # The upload side gave up (client went away); stop the parser
+                if self.abandoned:
+                    raise ArchiveException(error_message="Archive upload was abandoned")
+                continue
+            if chunk == b"":
+                self._eof = True
+            self._buffer = chunk
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class _PushbackReader:
+    # Lets the zip parser hand back bytes read past the end of a member
+    def __init__(self, stream: BinaryIO) -> None:
+        self._stream = stream
+        self._pushed = b""
+
+    def read(self, size: int) -> bytes:
+        if self._pushed:
+            data, self._pushed = self._pushed[:size], self._pushed[size:]
+            return data
+        return self._stream.read(size)
+
+    def read_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            part = self.read(size - len(data))
+            if not part:
+                raise ArchiveException(error_message="Archive is truncated")
+            data += part
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self._pushed = data + self._pushed
+
+
+class _StoredMember(io.RawIOBase):
+    def __init__(self, source: _PushbackReader, size: int) -> None:
+        super().__init__()
+        self._source = source
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        if not self._remaining:
+            return 0
+        data = self._source.read(min(len(target), self._remaining, 1 << 16))
+        if not data:
+            raise ArchiveException(error_message="Archive is truncated")
+        self._remaining -= len(data)
+        target[:len(data)] = data
+        return len(data)
+
+
+class _DescribedStoredMember(io.RawIOBase):
+    # A stored member whose size only follows it, in a data descriptor. Its
+    # end is found by scanning for the descriptor signature and taking the
+    # first one whose size and CRC match the data before it; the descriptor
+    # is consumed with the member. Descriptors without the (optional)
+    # signature can't be found this way.
+    def __init__(self, source: _PushbackReader, zip64: bool) -> None:
+        super().__init__()
+        self._source = source
+        self._descriptor = struct.Struct("<IIQQ" if zip64 else "<IIII")  # signature, crc32, sizes
+        self._buffer = b""  # read but not yet known to be member data
+        self._scan_from = 0
+        self._ready = b""  # member data not handed out yet
+        self._crc = 0
+        self._size = 0
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self._ready and not self._done:
+            self._advance()
+        size = min(len(target), len(self._ready))
+        target[:size] = self._ready[:size]
+        self._ready = self._ready[size:]
+        return size
+
+    def _advance(self) -> None:
+        position = self._buffer.find(_ZIP_DESCRIPTOR_SIGNATURE_BYTES, self._scan_from)
+        if position == -1:
+            # All of it is data, except what may be the start of a signature
+            self._accept(max(0, len(self._buffer) - 3))
+            self._scan_from = 0
+            self._read_more()
+            return
+        end = position + self._descriptor.size
+        if len(self._buffer) < end:
+            self._read_more()
+            return
+        _, crc, compressed_size, _ = self._descriptor.unpack_from(self._buffer, position)
+        if compressed_size == self._size + position and crc == zlib.crc32(self._buffer[:position], self._crc):
+            self._source.unread(self._buffer[end:])
+            self._accept(position)
+            self._buffer = b""
+            self._done = True
+        else:
+            self._scan_from = position + 1  # the signature bytes were image data
+
+    def _accept(self, size: int) -> None:
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += size
+        self._scan_from = max(0, self._scan_from - size)
+        self._ready += data
+
+    def _read_more(self) -> None:
+        data = self._source.read(1 << 16)
+        if not data:
+            raise ArchiveException(error_message="Archive is truncated (stored zip member without a data "
+                                                 "descriptor signature?)")
+        self._buffer += data
+
+
+class _DeflatedMember(io.RawIOBase):
+    # Deflate streams mark their own end, so members work even when the
+    # sizes are only given in a trailing data descriptor.
+    def __init__(self, source: _PushbackReader) -> None:
+        super().__init__()
+        self._source = source
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self._pending and not self._inflater.eof:
+            data = self._source.read(1 << 16)
+            if not data:
+                raise ArchiveException(error_message="Archive is truncated")
+            self._pending = self._inflater.decompress(data)
+            if self._inflater.eof:
+                self._source.unread(self._inflater.unused_data)
+        size = min(len(target), len(self._pending))
+        target[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+_ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_ZIP_LOCAL_SIGNATURE = 0x04034B50
+_ZIP_DESCRIPTOR_SIGNATURE = 0x08074B50
+_ZIP_DESCRIPTOR_SIGNATURE_BYTES = struct.pack("<I", _ZIP_DESCRIPTOR_SIGNATURE)
+
+
+def _zip64_sizes(extra: bytes) -> Optional[Tuple[int, int]]:
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, offset)
+        if header_id == 0x0001 and size >= 16:
+            return struct.unpack_from("<QQ", extra, offset + 4)  # uncompressed, compressed
+        offset += 4 + size
+    return None
+
+
+def iter_zip_members(stream: BinaryIO) -> Iterator[Tuple[str, BinaryIO]]:
+    # Walks the local file headers front to back instead of seeking to the
+    # central directory at the end, so members can be read as they arrive.
+    source = _PushbackReader(stream)
+    while True:
+        signature = source.read(4)
+        if len(signature) < 4 or struct.unpack("<I", signature)[0] != _ZIP_LOCAL_SIGNATURE:
+            return  # central directory (or end of stream) reached
+        header = _ZIP_LOCAL_HEADER.unpack(signature + source.read_exact(_ZIP_LOCAL_HEADER.size - 4))
+        _, _, flags, method, _, _, _, compressed_size, _, name_length, extra_length = header
+        raw_name = source.read_exact(name_length)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = source.read_exact(extra_length)
+        zip64 = _zip64_sizes(extra)
+        if zip64 is not None and compressed_size == 0xFFFFFFFF:
+            compressed_size = zip64[1]
+        has_descriptor = bool(flags & 0x8)
+
+        if flags & 0x1:
+            raise ArchiveException(error_message=f"Encrypted zip member is not supported: {name}")
+        if method == 0 and not has_descriptor:
+            member: io.RawIOBase = _StoredMember(source, compressed_size)
+        elif method == 0:
+            member = _DescribedStoredMember(source, zip64 is not None)
+        elif method == 8:
+            member = _DeflatedMember(source)
+        else:
+            raise ArchiveException(error_message=f"Unsupported zip member encoding for streaming: {name}")
+
+        if not name.endswith("/"):
+            yield name, io.BufferedReader(member)
+        # Skip whatever the consumer left unread
+        while member.read(1 << 16):
+            pass
+        if has_descriptor and method != 0:
+            descriptor = source.read_exact(4)
+            if struct.unpack("<I", descriptor)[0] == _ZIP_DESCRIPTOR_SIGNATURE:
+                descriptor = source.read_exact(4)
+            # crc32 already consumed above, then the two sizes
+            source.read_exact(16 if zip64 is not None else 8)
+
+
+_TAR_ERRORS = (tarfile.TarError, EOFError, zlib.error)
+
+
+class _TarMember(io.RawIOBase):
+    # A truncated or corrupt tar shows up while a member is read, in the
+    # consumer; it fails the same way as in the parser
+    def __init__(self, member: BinaryIO) -> None:
+        super().__init__()
+        self._member = member
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        try:
+            data = self._member.read(len(target))
+        except _TAR_ERRORS as e:
+            raise ArchiveException(error_message=f"Not a readable zip or tar archive: {e}")
+        target[:len(data)] = data
+        return len(data)
+
+
+def iter_tar_members(stream: BinaryIO) -> Iterator[Tuple[str, BinaryIO]]:
+    # "r|*" reads the tar (optionally gz/bz2/xz compressed) strictly forward
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info.name, io.BufferedReader(_TarMember(archive.extractfile(info)))
+    except _TAR_ERRORS as e:
+        raise ArchiveException(error_message=f"Not a readable zip or tar archive: {e}")
+
+
+def iter_archive_members(stream: io.BufferedReader) -> Iterator[Tuple[str, BinaryIO]]:
+    if stream.peek(4)[:4] == b"PK\x03\x04":
+        return iter_zip_members(stream)
+    return iter_tar_members(stream)
+
+
+class ArchiveBatch:
+    # Stages image members of an archive into chunk directories of
+    # OFIQ_ARCHIVE_CHUNK_SIZE files and hands every full chunk to `submit`
+    # straight away, so scoring overlaps with the rest of the upload.
+    # Members with identical content in a chunk are staged once.
+    def __init__(self, submit: Callable[[str, Dict[str, List[str]]], Future]) -> None:
+        self._submit = submit
+        self.staging_dir = tempfile.mkdtemp(prefix="ofiq-archive-", dir=settings.OFIQ_WORK_DIR)
+        self.chunks: List[Tuple[Future, Dict[str, str]]] = []  # (future, staged name -> member path)
+        self.skipped: List[str] = []
+        self._chunk_dir: Optional[str] = None
+        self._members: Dict[str, str] = {}
+        self._duplicates = ChunkDuplicates()
+
+    def run(self, stream: ChunkStream) -> None:
+        try:
+            for name, member in iter_archive_members(io.BufferedReader(stream)):
+                extension = os.path.splitext(name)[1].lower()
+                if extension not in settings.IMAGE_EXTENSIONS:
+                    self.skipped.append(name)
+                    continue
+                self._stage(name, member)
+            self._flush()
+        finally:
+            # Anything after the last member (zip central directory) or
+            # after a failure is not needed; let the upload side drop it
+            stream.abandoned = True
+
+    def _stage(self, name: str, member: BinaryIO) -> None:
+        if self._chunk_dir is None:
+            self._chunk_dir = os.path.join(self.staging_dir, f"chunk-{len(self.chunks):05d}")
+            os.mkdir(self._chunk_dir)
+        name_in_chunk = staged_name(len(self._members), name)
+        target = os.path.join(self._chunk_dir, name_in_chunk)
+        digest = hashlib.sha256()
+        with open(target, "wb") as file:
+            copied = 0
+            for block in iter(lambda: member.read(1 << 16), b""):
+                copied += len(block)
+                if copied > settings.OFIQ_ARCHIVE_MAX_MEMBER_BYTES:
+                    raise ArchiveException(error_message=f"Archive member is too large: {name}")
+                digest.update(block)
+                file.write(block)
+        if settings.OFIQ_BATCH_DEDUP and self._duplicates.original(digest.hexdigest(), name_in_chunk) is not None:
+            os.remove(target)
+        self._members[name_in_chunk] = name
+        if len(self._members) >= settings.OFIQ_ARCHIVE_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._members:
+            return
+        wait_for_pending_chunks(future for future, _ in self.chunks)
+        self.chunks.append((self._submit(self._chunk_dir, self._duplicates.aliases), self._members))
+        self._chunk_dir = None
+        self._members = {}
+        self._duplicates = ChunkDuplicates()
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
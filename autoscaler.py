@@ -0,0 +1,144 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import settings
+from cpuresources import cgroup_cpu_seconds, cpu_capacity
+from metrics import metrics
+from workerpool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class CpuLoad:
+    # Share of this process's CPU capacity (cpuresources.cpu_capacity, so
+    # the container's quota rather than the host's CPUs) in use. With cgroup
+    # CPU accounting it is the cgroup's CPU time used since the previous
+    # sample; without it, or on the first sample, the host's 1-minute load
+    # average stands in for it.
+    def __init__(self) -> None:
+        self._last: Optional[Tuple[float, float]] = None  # (monotonic time, cgroup CPU seconds)
+
+    def sample(self) -> float:
+        now, used = time.monotonic(), cgroup_cpu_seconds()
+        last = self._last
+        self._last = (now, used) if used is not None else None
+        if used is None or last is None or now <= last[0]:
+            return os.getloadavg()[0] / cpu_capacity()
+        return (used - last[1]) / (now - last[0]) / cpu_capacity()
+
+
+class Autoscaler:
+    # Grows and shrinks the worker pool between min_workers and max_workers.
+    # Every OFIQ_AUTOSCALE_INTERVAL seconds it looks at the queue and at how
+    # long recent jobs waited for a worker:
+    #   grow    more than OFIQ_AUTOSCALE_UP_QUEUE jobs queued per worker, or a
+    #           p95 wait above OFIQ_AUTOSCALE_UP_WAIT, for
+    #           OFIQ_AUTOSCALE_UP_CHECKS checks in a row; by half the current
+    #           size, but not while the CPUs are already loaded beyond
+    #           OFIQ_AUTOSCALE_MAX_LOAD, where more workers only add contention,
+    #           nor while the concurrency limiter keeps workers idle
+    #   shrink  nothing queued, fewer than half the workers busy and no wait
+    #           above a tenth of OFIQ_AUTOSCALE_UP_WAIT, for
+    #           OFIQ_AUTOSCALE_DOWN_SECONDS; by one worker
+    # The gap between the two conditions and OFIQ_AUTOSCALE_COOLDOWN seconds
+    # after every change keep it from flapping. Pool sizes are kept as a
+    # history for /metrics.
+    def __init__(self, pool: WorkerPool, min_workers: int, max_workers: int) -> None:
+        self.pool = pool
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pressure_checks = 0
+        self._idle_since: Optional[float] = None
+        self._changed_at = time.monotonic()
+        self._cpu_load = CpuLoad()
+        # (unix time, pool size) at startup and after every change
+        self._history: Deque[Tuple[float, int]] = deque([(time.time(), pool.workers)],
+                                                        maxlen=settings.OFIQ_AUTOSCALE_HISTORY)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_workers > self.min_workers
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._loop, name="ofiq-autoscaler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(settings.OFIQ_AUTOSCALE_INTERVAL):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Autoscaler check failed")
+
+    def check(self) -> None:
+        now = time.monotonic()
+        status = self.pool.snapshot()
+        workers, queued, running = status["workers"], status["queued"], status["running"]
+        wait_p95 = percentile(self.pool.wait_times(settings.OFIQ_AUTOSCALE_WINDOW), 0.95)
+        # Sampled every check so it covers the last interval
+        load = self._cpu_load.sample()
+
+        pressure = queued > settings.OFIQ_AUTOSCALE_UP_QUEUE * workers or wait_p95 > settings.OFIQ_AUTOSCALE_UP_WAIT
+        idle = queued == 0 and running * 2 < workers and wait_p95 <= settings.OFIQ_AUTOSCALE_UP_WAIT / 10
+        self._pressure_checks = self._pressure_checks + 1 if pressure else 0
+        self._idle_since = (self._idle_since or now) if idle else None
+        if now - self._changed_at < settings.OFIQ_AUTOSCALE_COOLDOWN:
+            return
+
+        target = workers
+        if self._pressure_checks >= settings.OFIQ_AUTOSCALE_UP_CHECKS and workers < self.max_workers:
+            if status["concurrency"] < workers:
+                metrics.increment("pool_scale_up_blocked_limit")
+                return
+            if load >= settings.OFIQ_AUTOSCALE_MAX_LOAD:
+                metrics.increment("pool_scale_up_blocked_cpu")
+                logger.info("Not growing the worker pool, CPUs are busy", extra={"load_per_cpu": load, **status})
+                return
+            target = min(self.max_workers, workers + math.ceil(workers / 2))
+        elif self._idle_since is not None and now - self._idle_since >= settings.OFIQ_AUTOSCALE_DOWN_SECONDS \
+                and workers > self.min_workers:
+            target = workers - 1
+        if target == workers:
+            return
+
+        self.pool.resize(target)
+        metrics.increment("pool_scaled_up" if target > workers else "pool_scaled_down")
+        logger.info("Resized the worker pool", extra={"from": workers, "to": target, "wait_p95": wait_p95, **status})
+        self._changed_at = now
+        self._pressure_checks = 0
+        self._idle_since = None
+        with self._lock:
+            self._history.append((time.time(), target))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            history = [[at, size] for at, size in self._history]
+        return {
+            "workers": self.pool.workers,
+            "min_workers": self.min_workers,
+            "max_workers": self.max_workers,
+            "autoscaling": self.enabled,
+            "history": history,
+        }
@@ -0,0 +1,106 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Deque, Tuple
+
+import settings
+from customexceptions import CircuitOpenException
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    # Stops launching OFIQ once it keeps failing. Closed: runs go through and
+    # their outcome is recorded; when at least min_runs runs finished in the
+    # last window_seconds and failure_rate of them failed, the circuit opens.
+    # Open: runs are refused with CircuitOpenException for open_seconds.
+    # Half-open: up to `probes` trial runs at a time are let through; the
+    # first success closes the circuit, a failure opens it again.
+    def __init__(self, name: str, failure_rate: float, min_runs: int, window_seconds: float,
+                 open_seconds: float, probes: int) -> None:
+        self.name = name
+        self._failure_rate = failure_rate
+        self._min_runs = min_runs
+        self._window_seconds = window_seconds
+        self._open_seconds = open_seconds
+        self._probes = probes
+        self._lock = threading.Lock()
+        self.state = "closed"  # closed | open | half_open
+        self._opened_at = 0.0
+        self._probing = 0
+        self._runs: Deque[Tuple[float, bool]] = deque()  # (finished at, succeeded)
+
+    def admit(self) -> bool:
+        # Call before a run. Raises CircuitOpenException if the run must not
+        # happen; otherwise returns whether it is a half-open trial run,
+        # which has to be passed back to record()
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                remaining = self._opened_at + self._open_seconds - now
+                if remaining > 0:
+                    metrics.increment(f"{self.name}_circuit_rejected")
+                    raise CircuitOpenException(error_message="OFIQ engine is failing, not accepting runs for now",
+                                               retry_after=math.ceil(remaining))
+                self.state = "half_open"
+                logger.info("Circuit half-open, probing", extra={"circuit": self.name})
+            if self.state == "half_open":
+                if self._probing >= self._probes:
+                    metrics.increment(f"{self.name}_circuit_rejected")
+                    raise CircuitOpenException(error_message="OFIQ engine is being probed, try again shortly",
+                                               retry_after=1)
+                self._probing += 1
+                return True
+            return False
+
+    def discard(self, probe: bool) -> None:
+        # For an admitted run whose outcome says nothing about the engine
+        if probe:
+            with self._lock:
+                self._probing -= 1
+
+    def record(self, succeeded: bool, probe: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self._probing -= 1
+                if self.state != "half_open":
+                    return
+                if succeeded:
+                    self.state = "closed"
+                    self._runs.clear()
+                    logger.info("Circuit closed", extra={"circuit": self.name})
+                else:
+                    self._open(now)
+                return
+            if self.state != "closed":
+                return  # a run admitted before the circuit opened
+            self._runs.append((now, succeeded))
+            horizon = now - self._window_seconds
+            while self._runs and self._runs[0][0] < horizon:
+                self._runs.popleft()
+            failed = sum(1 for _, ok in self._runs if not ok)
+            if len(self._runs) >= self._min_runs and failed >= self._failure_rate * len(self._runs):
+                self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = "open"
+        self._opened_at = now
+        self._runs.clear()
+        metrics.increment(f"{self.name}_circuit_opened")
+        logger.warning("Circuit opened", extra={"circuit": self.name, "open_seconds": self._open_seconds})
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            status = {"state": self.state, "recent_runs": len(self._runs)}
+            if self.state == "open":
+                status["retry_in"] = max(0.0, self._opened_at + self._open_seconds - time.monotonic())
+            return status
+
+
+engine_breaker = CircuitBreaker("engine", settings.OFIQ_BREAKER_FAILURE_RATE, settings.OFIQ_BREAKER_MIN_RUNS,
+                                settings.OFIQ_BREAKER_WINDOW_SECONDS, settings.OFIQ_BREAKER_OPEN_SECONDS,
+                                settings.OFIQ_BREAKER_PROBES)
@@ -0,0 +1,100 @@
+import logging
+import math
+import threading
+from typing import Optional
+
+import settings
+from workerpool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimiter:
+    # Adapts how many OFIQ runs the pool lets run at once, between
+    # min_limit and the pool's size, from the latency of finished
+    # single-image runs (a gradient limiter): uploads scored by the
+    # subprocess engine, and every image of the per-image engines. A short
+    # and a long exponential average of the latency are kept; while the
+    # short one stays within `tolerance` of the long one the limit creeps
+    # up by about sqrt(limit), and once
+    # latency rises past that the limit shrinks by the ratio, down to half
+    # per update. That settles near the throughput knee: more concurrency
+    # stops adding throughput and only adds latency. A run that timed out
+    # cuts the limit by a tenth. The limit only grows while at least half
+    # of it is in use, so an idle service doesn't inflate it.
+    def __init__(self, enabled: bool, min_limit: int, tolerance: float, smoothing: float,
+                 short_window: int, long_window: int) -> None:
+        self.enabled = enabled
+        self.min_limit = min_limit
+        self._tolerance = tolerance
+        self._smoothing = smoothing
+        self._short_alpha = 2 / (short_window + 1)
+        self._long_alpha = 2 / (long_window + 1)
+        self._lock = threading.Lock()
+        self._pool: Optional[WorkerPool] = None
+        self._limit = 0.0
+        self._short: Optional[float] = None
+        self._long: Optional[float] = None
+
+    def attach(self, pool: WorkerPool) -> None:
+        # Starts out at the pool's size, the static cap this replaces
+        self._pool = pool
+        self._limit = float(pool.workers)
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    def record(self, latency: float) -> None:
+        # Wall time of a finished single-image run
+        if not self.enabled or self._pool is None:
+            return
+        with self._lock:
+            self._short = latency if self._short is None else self._short + self._short_alpha * (latency - self._short)
+            self._long = latency if self._long is None else self._long + self._long_alpha * (latency - self._long)
+            if self._long > self._short * 2:
+                # Runs got much quicker (smaller images, say); let the
+                # baseline follow faster than its window would
+                self._long *= 0.95
+            gradient = max(0.5, min(1.0, self._tolerance * self._long / self._short))
+            limit = self._limit
+            target = limit * gradient
+            if gradient == 1.0:
+                if self._pool.running * 2 < limit:
+                    return
+                target += math.sqrt(limit)
+            self._set((1 - self._smoothing) * limit + self._smoothing * target)
+
+    def record_timeout(self) -> None:
+        if not self.enabled or self._pool is None:
+            return
+        with self._lock:
+            self._set(self._limit * 0.9)
+
+    def _set(self, limit: float) -> None:
+        previous = self.limit
+        self._limit = max(float(self.min_limit), min(float(self._pool.max_workers), limit))
+        if self.limit != previous:
+            logger.debug("Concurrency limit changed", extra={"from": previous, "to": self.limit,
+                                                             "latency_short": self._short, "latency_long": self._long})
+            self._pool.set_limit(self.limit)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "limit": self.limit if self.enabled else None,
+                "min_limit": self.min_limit,
+                "latency_short": self._short,
+                "latency_long": self._long,
+            }
+
+
+concurrency_limiter = ConcurrencyLimiter(
+    settings.OFIQ_ADAPTIVE_CONCURRENCY,
+    settings.OFIQ_CONCURRENCY_MIN,
+    settings.OFIQ_CONCURRENCY_TOLERANCE,
+    settings.OFIQ_CONCURRENCY_SMOOTHING,
+    settings.OFIQ_CONCURRENCY_SHORT_WINDOW,
+    settings.OFIQ_CONCURRENCY_LONG_WINDOW,
+)
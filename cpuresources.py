@@ -0,0 +1,115 @@
+import math
+import os
+from typing import Dict, List, Optional
+
+# How many CPUs this process may really use, from its affinity mask and the
+# cgroup CPU quota of its container, and how to split them between OFIQ
+# workers. Imported by settings, so it must not import settings itself.
+
+_CGROUP_V2_MAX = "/sys/fs/cgroup/cpu.max"
+_CGROUP_V1_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+_CGROUP_V1_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+_CGROUP_V2_STAT = "/sys/fs/cgroup/cpu.stat"
+_CGROUP_V1_USAGE = "/sys/fs/cgroup/cpuacct/cpuacct.usage"
+
+# Thread pool sizes read by the runtimes OFIQ links (OpenMP, which ONNX
+# Runtime and OpenCV builds use, BLAS and OpenCV's own parallel_for)
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "OPENCV_FOR_THREADS_NUM")
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_quota() -> Optional[float]:
+    # CPUs' worth of time the cgroup may use per period; None when unlimited
+    # or not in a cgroup with a quota
+    cpu_max = _read(_CGROUP_V2_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+    quota, period = _read(_CGROUP_V1_QUOTA), _read(_CGROUP_V1_PERIOD)
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_cpu_seconds() -> Optional[float]:
+    # CPU time the cgroup has used so far; None outside a cgroup with CPU
+    # accounting
+    stat = _read(_CGROUP_V2_STAT)
+    if stat is not None:
+        for line in stat.splitlines():
+            name, _, value = line.partition(" ")
+            if name == "usage_usec":
+                return int(value) / 1e6
+        return None
+    usage = _read(_CGROUP_V1_USAGE)
+    return int(usage) / 1e9 if usage is not None else None
+
+
+def affinity_cpus() -> List[int]:
+    # CPUs this process may be scheduled on
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def available_cpus() -> int:
+    # Whole CPUs to plan for: the affinity mask, capped by the quota (a
+    # fractional quota is rounded down, the remainder is left for the server)
+    cpus = len(affinity_cpus())
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+    return cpus
+
+
+def cpu_capacity() -> float:
+    # CPUs' worth of time this process may use: the affinity mask, capped by
+    # the quota, which unlike available_cpus() is not rounded
+    cpus = float(len(affinity_cpus()))
+    quota = cgroup_cpu_quota()
+    return min(cpus, quota) if quota is not None else cpus
+
+
+def thread_environment(threads: int) -> Dict[str, str]:
+    # Environment for an OFIQ child limited to `threads` threads per pool
+    return {**os.environ, **{name: str(threads) for name in THREAD_VARIABLES}}
+
+
+def worker_cpus(slot: Optional[int], threads: int) -> Optional[List[int]]:
+    # The CPUs worker `slot` is pinned to: consecutive blocks of `threads`
+    # CPUs, wrapping around when there are more workers than blocks
+    if slot is None:
+        return None
+    cpus = affinity_cpus()
+    start = slot * threads
+    return [cpus[(start + offset) % len(cpus)] for offset in range(min(threads, len(cpus)))]
+
+
+def pin(pid: int, cpus: Optional[List[int]]) -> None:
+    # Threads started after this inherit the mask, so pinning a child right
+    # after it is spawned covers the thread pools OFIQ creates once its
+    # models are loaded. pid 0 is the calling thread.
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(pid, cpus)
+        except (AttributeError, ProcessLookupError):
+            pass
+
+
+def cpu_summary(threads: int) -> dict:
+    return {
+        "affinity_cpus": len(affinity_cpus()),
+        "cgroup_cpu_quota": cgroup_cpu_quota(),
+        "available_cpus": available_cpus(),
+        "threads_per_worker": threads,
+    }
@@ -1,3 +1,28 @@
 class SubProcessException(Exception):
-    def __init__(self, error_message: str) -> None:        
-        self.error_message = error_message
\ No newline at end of file
+    # kind is one of input_error, no_face, engine_fault, timeout, cancelled
+    # (see ofiqprocess.classify_failure), or overloaded for an image of a
+    # batch that was refused without running OFIQ. engine_wide marks
+    # failures no input can have caused (OFIQ could not start or load its
+    # models), which bisecting a batch won't narrow down.
+    def __init__(self, error_message: str, kind: str = "engine_fault", engine_wide: bool = False) -> None:
+        self.error_message = error_message
+        self.kind = kind
+        self.engine_wide = engine_wide
+
+# Failure kinds about the image itself, which a retry won't change; the
+# others are worth retrying later
+PERMANENT_KINDS = ("input_error", "no_face")
+
+class OverloadedException(Exception):
+    def __init__(self, error_message: str, retry_after: int = 1) -> None:
+        self.error_message = error_message
+        self.retry_after = retry_after
+
+class ArchiveException(Exception):
+    def __init__(self, error_message: str) -> None:
+        super().__init__(error_message)
+        self.error_message = error_message
+
+class CircuitOpenException(OverloadedException):
+    # Refused without running OFIQ because the engine keeps failing
+    pass
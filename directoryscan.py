@@ -0,0 +1,121 @@
+import contextlib
+import os
+import shutil
+import stat
+import tempfile
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import settings
+from customexceptions import SubProcessException
+from resultstore import FileIndex, IndexEntry
+from staging import ChunkDuplicates, file_sha256, stage_file, staged_name, wait_for_pending_chunks
+
+
+class DirectoryScan:
+    # Walks a directory tree and compares every image against the file index.
+    # Files whose size and mtime match the index are skipped without being
+    # read; when only the mtime moved, the content hash decides. New and
+    # changed files are staged in batches and handed to `submit` as soon as a
+    # batch is full, so scoring starts while the tree is still being walked.
+    # Files with identical content in a batch are staged once. Files that
+    # can't be read are reported in `errors` and left out of the index, so
+    # the next scan tries them again.
+    def __init__(self, root: str, index: FileIndex,
+                 submit: Callable[[str, Dict[str, List[str]]], Future]) -> None:
+        self.root = os.path.abspath(root)
+        self._index = index
+        self._submit = submit
+        self.counts = {"new": 0, "changed": 0, "skipped": 0, "previously_failed": 0}
+        self.unchanged: List[str] = []
+        self.errors: Dict[str, SubProcessException] = {}
+        # (future, staged name -> index entry the file will get once scored)
+        self.chunks: List[Tuple[Future, Dict[str, IndexEntry]]] = []
+        self._chunk_dir: Optional[str] = None
+        self._staged: Dict[str, IndexEntry] = {}
+        self._duplicates = ChunkDuplicates()
+
+    def run(self) -> None:
+        try:
+            for directory, _, files in os.walk(self.root):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in settings.IMAGE_EXTENSIONS:
+                        self._check(os.path.join(directory, name))
+            self._flush()
+        except BaseException:
+            # A chunk that never reached the pool is ours to clean up
+            if self._chunk_dir is not None:
+                shutil.rmtree(self._chunk_dir, ignore_errors=True)
+            raise
+
+    def _check(self, path: str) -> None:
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return  # removed since the walk listed it
+        except OSError as e:
+            self._unreadable(path, e)
+            return
+        if not stat.S_ISREG(info.st_mode):
+            # Reading a FIFO or socket named like an image would block the scan
+            self.errors[path] = SubProcessException(error_message="not a regular file", kind="input_error")
+            return
+        known = self._index.lookup(path)
+        if known is not None and (known.size, known.mtime_ns) == (info.st_size, info.st_mtime_ns):
+            self._skip(known)
+            return
+        try:
+            sha256 = file_sha256(path)
+        except OSError as e:
+            self._unreadable(path, e)
+            return
+        entry = IndexEntry(path, info.st_size, info.st_mtime_ns, "scored", None, sha256)
+        if known is not None and known.sha256 == sha256:
+            # Touched (copied, restored from backup) but same content
+            self._index.mark_many([entry._replace(status=known.status, error=known.error)])
+            self._skip(known)
+            return
+        try:
+            self._stage(path, entry)
+        except OSError as e:
+            self._unreadable(path, e)
+            return
+        self.counts["changed" if known is not None else "new"] += 1
+
+    def _unreadable(self, path: str, error: OSError) -> None:
+        self.errors[path] = SubProcessException(error_message=f"could not read file: {error.strerror}",
+                                                kind="input_error")
+
+    def _skip(self, known: IndexEntry) -> None:
+        if known.status == "failed":
+            self.counts["previously_failed"] += 1
+        else:
+            self.counts["skipped"] += 1
+            self.unchanged.append(known.path)
+
+    def _stage(self, path: str, entry: IndexEntry) -> None:
+        if self._chunk_dir is None:
+            self._chunk_dir = tempfile.mkdtemp(prefix="ofiq-scan-", dir=settings.OFIQ_WORK_DIR)
+        name = staged_name(len(self._staged), path)
+        if not settings.OFIQ_BATCH_DEDUP or self._duplicates.original(entry.sha256, name) is None:
+            target = os.path.join(self._chunk_dir, name)
+            try:
+                stage_file(path, target)
+            except OSError:
+                # Later files with this content must not become aliases of it
+                self._duplicates.forget(entry.sha256)
+                with contextlib.suppress(OSError):
+                    os.remove(target)
+                raise
+        self._staged[name] = entry
+        if len(self._staged) >= settings.OFIQ_SCAN_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._staged:
+            return
+        wait_for_pending_chunks(future for future, _ in self.chunks)
+        self.chunks.append((self._submit(self._chunk_dir, self._duplicates.aliases), self._staged))
+        self._chunk_dir = None
+        self._staged = {}
+        self._duplicates = ChunkDuplicates()
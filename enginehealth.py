@@ -0,0 +1,124 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import settings
+from circuitbreaker import engine_breaker
+
+logger = logging.getLogger(__name__)
+
+# Quoted paths in ofiq_config.jaxn that point at model files
+_MODEL_PATH = re.compile(r"\"([^\"]+\.(?:onnx|caffemodel|prototxt|prototxt\.txt|pb|dat|xml|bin))\"", re.IGNORECASE)
+
+
+class EngineHealth:
+    # Startup state of the OFIQ engine; the service is ready only once the
+    # preflight checks pass and the warmup run has completed.
+    def __init__(self) -> None:
+        self.preflight_errors: List[str] = []
+        self.warmup_status = "pending"  # pending | running | done | failed
+        self.warmup_seconds: Optional[float] = None
+        self.warmup_error: Optional[str] = None
+        self.shutting_down = False
+        self._lock = threading.Lock()
+        self._runs: Deque[Tuple[float, bool]] = deque()  # (finished at, succeeded)
+
+    @property
+    def ready(self) -> bool:
+        return not self.preflight_errors and self.warmup_status == "done" and not self.shutting_down
+
+    def record_run(self, succeeded: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._runs.append((now, succeeded))
+            self._expire(now)
+
+    def _expire(self, now: float) -> None:
+        horizon = now - settings.OFIQ_FAILURE_WINDOW_SECONDS
+        while self._runs and self._runs[0][0] < horizon:
+            self._runs.popleft()
+
+    def failure_rate(self) -> Tuple[int, float]:
+        # (runs in the window, fraction of them that failed)
+        with self._lock:
+            self._expire(time.monotonic())
+            total = len(self._runs)
+            failed = sum(1 for _, succeeded in self._runs if not succeeded)
+        return total, (failed / total if total else 0.0)
+
+    def as_dict(self) -> dict:
+        runs, failure_rate = self.failure_rate()
+        return {
+            "ready": self.ready,
+            "preflight_errors": self.preflight_errors,
+            "warmup_status": self.warmup_status,
+            "warmup_seconds": self.warmup_seconds,
+            "warmup_error": self.warmup_error,
+            "shutting_down": self.shutting_down,
+            "recent_runs": runs,
+            "recent_failure_rate": failure_rate,
+        }
+
+    def liveness(self, pool) -> Tuple[bool, dict]:
+        # Alive unless every worker is wedged on a single job
+        pool_status = pool.snapshot()
+        stalled = pool.stalled_workers(settings.OFIQ_STALL_SECONDS)
+        alive = stalled < pool_status["workers"]
+        return alive, {"alive": alive, "stalled_workers": stalled, "pool": pool_status, **self.as_dict()}
+
+    def readiness(self, pool) -> Tuple[bool, dict]:
+        # Ready once warmed up, and only while the queue has headroom
+        alive, status = self.liveness(pool)
+        saturated = status["pool"]["queued"] >= settings.OFIQ_READY_MAX_QUEUE
+        ready = self.ready and alive and not saturated
+        # Reported, but an open circuit doesn't make us unready: requests are
+        # needed for the half-open probes that close it again
+        status.update({"ready": ready, "queue_saturated": saturated, "circuit": engine_breaker.as_dict()})
+        return ready, status
+
+
+engine_health = EngineHealth()
+
+
+def model_files(config_path: str) -> List[str]:
+    # OFIQ resolves model paths relative to the directory of the config file
+    with open(config_path, "r") as file:
+        text = file.read()
+    config_dir = os.path.dirname(config_path)
+    paths = []
+    for match in _MODEL_PATH.finditer(text):
+        path = match.group(1)
+        paths.append(path if os.path.isabs(path) else os.path.join(config_dir, path))
+    return paths
+
+
+def preflight_checks() -> List[str]:
+    # Config, models and warmup image; each engine adds its own checks
+    errors = []
+    if not os.path.isfile(settings.OFIQ_CONFIG):
+        errors.append(f"OFIQ config not found: {settings.OFIQ_CONFIG}")
+    else:
+        for path in model_files(settings.OFIQ_CONFIG):
+            if not os.path.isfile(path):
+                errors.append(f"OFIQ model file not found: {path}")
+    if not os.path.isfile(settings.OFIQ_WARMUP_IMAGE):
+        errors.append(f"Warmup image not found: {settings.OFIQ_WARMUP_IMAGE}")
+    return errors
+
+
+def prime_page_cache(paths: List[str]) -> None:
+    # Ask the kernel to start reading the binary and models into the page
+    # cache so the warmup run is not the first to fault them in.
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
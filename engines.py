@@ -0,0 +1,708 @@
+import abc
+import concurrent.futures
+import csv
+import hashlib
+import logging
+import os
+import queue
+import resource
+import tempfile
+import threading
+import time
+from typing import IO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import settings
+from circuitbreaker import engine_breaker
+from concurrencylimit import concurrency_limiter
+from cpuresources import THREAD_VARIABLES, pin, thread_environment, worker_cpus
+from customexceptions import CircuitOpenException, SubProcessException
+from enginehealth import engine_health, model_files, preflight_checks
+from inputtransport import open_transport
+from metrics import metrics
+from ofiqlib import OFIQLibrary
+from ofiqprocess import ProcessUsage, classify_failure, run_process
+from ofiqworker import WorkerProcess
+from resultpipe import ResultPipe
+from workerpool import current_slot, in_current_job
+
+logger = logging.getLogger(__name__)
+
+# staged name -> staged names of duplicates left out of a batch (see staging.ChunkDuplicates)
+Aliases = Dict[str, List[str]]
+# staged name -> why OFIQ could not score it
+Failures = Dict[str, SubProcessException]
+# (staged name, its row or why it failed, usage of the runs finished since the previous item)
+Scored = Tuple[str, Union[dict, SubProcessException], ProcessUsage]
+
+
+def read_results(results_path: str = 'results.csv', aliases: Optional[Aliases] = None) -> List:
+    # # Read output line by line
+    # for line in process.stdout:
+    #     print(line.decode().strip())  # Decode bytes to string
+    with open(results_path,'r') as file:
+        return expand_duplicates(parse_results(file), aliases)
+
+def parse_results(file: IO[str]) -> List:
+    data_dict = csv.DictReader(file,delimiter=';')
+    data_list = [normalize_row(row, row['Filename']) for row in data_dict]
+
+    return data_list
+
+def normalize_row(row: dict, filename: str) -> dict:
+    # Rows look the same whichever engine produced them: Filename as given
+    # and every measure a float, None where OFIQ left the cell empty
+    normalized = {'Filename': filename}
+    for column, value in row.items():
+        if column == 'Filename':
+            continue
+        if isinstance(value, str):
+            try:
+                value = float(value) if value.strip() else None
+            except ValueError:
+                pass
+        normalized[column] = value
+    return normalized
+
+def expand_duplicates(rows: List, aliases: Optional[Aliases]) -> List:
+    # Files left out of a batch run as duplicates (staged name -> duplicate
+    # staged names) get a copy of the row OFIQ wrote for the original
+    if not aliases:
+        return rows
+    expanded = []
+    for row in rows:
+        expanded.append(row)
+        directory, name = os.path.split(row['Filename'])
+        expanded.extend({**row, 'Filename': os.path.join(directory, alias)} for alias in aliases.get(name, ()))
+    return expanded
+
+def with_duplicates(name: str, result: Union[dict, SubProcessException], usage: ProcessUsage,
+                    aliases: Aliases) -> Iterator[Scored]:
+    # One scored image of a batch followed by the duplicates left out of the
+    # run, which share its row or its error
+    yield name, result, usage
+    for alias in aliases.get(name, ()):
+        if isinstance(result, dict):
+            directory = os.path.dirname(result['Filename'])
+            yield alias, {**result, 'Filename': os.path.join(directory, alias)}, ProcessUsage(0.0, 0.0, 0.0, 0)
+        else:
+            yield alias, result, ProcessUsage(0.0, 0.0, 0.0, 0)
+
+def analyze_images(image_path: str = settings.OFIQ_TEST_IMAGE, output_path: str = 'results.csv',
+                   config: str = settings.OFIQ_CONFIG, tenant: str = settings.DEFAULT_TENANT,
+                   isolating: bool = False) -> ProcessUsage:
+    # OFIQ writes to a partial file that is only renamed into place once the
+    # run succeeded, so an interrupted run never leaves a half-written CSV
+    partial_path = output_path + '.partial'
+    try:
+        usage = run_ofiq(image_path, partial_path, config=config, tenant=tenant, isolating=isolating)
+    except SubProcessException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    try:
+        os.replace(partial_path, output_path)
+    except FileNotFoundError:
+        raise SubProcessException(error_message="OFIQ exited without writing results", kind="engine_fault")
+    return usage
+
+def pinned_cpus() -> Optional[List[int]]:
+    # CPUs for the OFIQ run of the current pool slot when workers are pinned
+    if not settings.OFIQ_PIN_WORKERS:
+        return None
+    return worker_cpus(current_slot(), settings.OFIQ_THREADS_PER_WORKER)
+
+def run_ofiq(image_path: str, output_path: str, config: str = settings.OFIQ_CONFIG,
+             tenant: str = settings.DEFAULT_TENANT, pass_fds: Sequence[int] = (),
+             isolating: bool = False) -> ProcessUsage:
+    # isolating marks the runs that bisect a failed batch (see
+    # SubprocessEngine._bisect): while a failing run has more than one image
+    # it isn't known yet whether an image or the engine is at fault, so such
+    # a crash is not recorded in the circuit breaker
+    # bash_command = ["./install_x86_64_linux/Release/bin/OFIQSampleApp","-c","data/ofiq_config.jaxn","-i ","testimage/b-01-smile.png","-o","results.csv"]
+    bash_command = [settings.OFIQ_BINARY, '-c', config, '-i', image_path, '-o', output_path]
+
+    images = len(os.listdir(image_path)) if os.path.isdir(image_path) else 1
+    timeout = settings.OFIQ_RUN_TIMEOUT + settings.OFIQ_RUN_TIMEOUT_PER_IMAGE * images if settings.OFIQ_RUN_TIMEOUT else None
+
+    # Refused up front while the engine keeps failing (CircuitOpenException)
+    probe = engine_breaker.admit()
+    # run_process reaps the child with wait4 so we also get its CPU time and peak RSS
+    try:
+        result = run_process(bash_command, pass_fds=pass_fds, timeout=timeout,
+                             env=thread_environment(settings.OFIQ_THREADS_PER_WORKER), cpus=pinned_cpus())
+    except OSError as e:
+        engine_breaker.record(False, probe)
+        raise SubProcessException(error_message=f"Could not start OFIQ: {e}", kind="engine_fault", engine_wide=True)
+    usage = result.usage
+    metrics.record_usage(usage, config=config, tenant=tenant)
+    kind = classify_failure(result) if result.returncode != 0 else None
+    if kind != "cancelled":
+        engine_health.record_run(result.returncode == 0)
+    # Only engine faults and timeouts count against the engine; a run that
+    # failed on the image itself still shows the engine works
+    engine_wide = any(event["event"] == "model_error" for event in result.events)
+    if isolating and images > 1 and kind == "engine_fault" and not engine_wide:
+        engine_breaker.discard(probe)
+    else:
+        engine_breaker.record(kind not in ("engine_fault", "timeout"), probe)
+    # Runs that failed on an image end early and say nothing about latency.
+    # Only single-image runs are samples: a batch's wall time per image also
+    # spreads OFIQ's startup and model loading over the batch, so mixing the
+    # two would read a change in batch sizes as a change in contention.
+    if kind is None and images == 1:
+        concurrency_limiter.record(usage.wall_time)
+    elif kind == "timeout":
+        concurrency_limiter.record_timeout()
+    run_info = {"returncode": result.returncode, "input": image_path, "tenant": tenant, "config": config, **usage.as_dict()}
+    if kind == "cancelled":
+        metrics.increment("ofiq_runs_cancelled")
+        logger.info("OFIQ run cancelled", extra=run_info)
+        raise SubProcessException(error_message="OFIQ run cancelled", kind=kind)
+    if kind is not None:
+       logger.error("Subprocess error", extra={**run_info, "error_kind": kind, "stderr": result.stderr})
+       metrics.increment(f"ofiq_errors_{kind}")
+       message = f"OFIQ did not finish within {timeout:g}s" if kind == "timeout" else result.stderr
+       raise SubProcessException(
+           error_message=f"{message}", kind=kind,
+           engine_wide=engine_wide
+       )
+    logger.info("OFIQ run finished", extra={**run_info, "sample": True})
+    return usage
+
+
+class Engine(abc.ABC):
+    # One way of running OFIQ, selected with OFIQ_ENGINE. Every backend
+    # offers the same operations:
+    #   score_one       an image held in memory -> (rows, usage), the row's
+    #                   Filename being the name it was given
+    #   score_image     a file, or a directory as one batch -> (rows, usage);
+    #                   raises SubProcessException if anything failed
+    #   stream_batch    a staged batch directory -> (name, row or error,
+    #                   usage) for every image as soon as it is scored
+    #   score_batch     a staged batch directory -> (rows, usage, failures),
+    #                   failing images reported one by one
+    #   health          backend state for /readyz
+    #   release_slot    drop what was kept for a worker pool slot the pool
+    #                   has retired (see workerpool.WorkerPool.resize)
+    # Runs are counted in metrics, engine_health and the circuit breaker, and
+    # rows are shaped (normalize_row), the same way whichever backend is used.
+    name = "engine"
+
+    def preflight(self) -> List[str]:
+        # Problems that make the backend unusable, checked before warmup
+        return preflight_checks()
+
+    def warmup_files(self) -> List[str]:
+        # Files worth having in the page cache before the warmup run
+        return [settings.OFIQ_CONFIG, *model_files(settings.OFIQ_CONFIG)]
+
+    @property
+    def warmup_image(self) -> Optional[str]:
+        return settings.OFIQ_WARMUP_IMAGE
+
+    @abc.abstractmethod
+    def score_one(self, data: bytes, config: str = settings.OFIQ_CONFIG,
+                  tenant: str = settings.DEFAULT_TENANT, name: str = "upload") -> Tuple[List, ProcessUsage]:
+        ...
+
+    @abc.abstractmethod
+    def score_image(self, image_path: str, config: str = settings.OFIQ_CONFIG,
+                    tenant: str = settings.DEFAULT_TENANT,
+                    aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage]:
+        ...
+
+    @abc.abstractmethod
+    def stream_batch(self, directory: str, config: str = settings.OFIQ_CONFIG,
+                     tenant: str = settings.DEFAULT_TENANT,
+                     aliases: Optional[Aliases] = None) -> Iterator[Scored]:
+        # Duplicates (aliases) are yielded right after their original
+        ...
+
+    def score_batch(self, directory: str, config: str = settings.OFIQ_CONFIG,
+                    tenant: str = settings.DEFAULT_TENANT,
+                    aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage, Failures]:
+        rows, total, failures = [], ProcessUsage(0.0, 0.0, 0.0, 0), {}
+        for name, result, usage in self.stream_batch(directory, config, tenant, aliases):
+            total += usage
+            if isinstance(result, SubProcessException):
+                failures[name] = result
+            else:
+                rows.append(result)
+        return rows, total, failures
+
+    def health(self) -> dict:
+        return {"engine": self.name}
+
+    def release_slot(self, slot: int) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SubprocessEngine(Engine):
+    # One OFIQSampleApp process per job. A directory is one process for the
+    # whole batch; when it fails the batch is bisected to isolate the images
+    # OFIQ failed on.
+    name = "subprocess"
+
+    def preflight(self) -> List[str]:
+        errors = super().preflight()
+        if not os.path.isfile(settings.OFIQ_BINARY):
+            errors.insert(0, f"OFIQ binary not found: {settings.OFIQ_BINARY}")
+        elif not os.access(settings.OFIQ_BINARY, os.X_OK):
+            errors.insert(0, f"OFIQ binary is not executable: {settings.OFIQ_BINARY}")
+        return errors
+
+    def warmup_files(self) -> List[str]:
+        return [settings.OFIQ_BINARY, *super().warmup_files()]
+
+    def score_one(self, data: bytes, config: str = settings.OFIQ_CONFIG,
+                  tenant: str = settings.DEFAULT_TENANT, name: str = "upload") -> Tuple[List, ProcessUsage]:
+        # Uploaded bytes go to OFIQ through the configured transport (memfd by
+        # default) and the CSV is read back the same way, or from a pipe. OFIQ
+        # only knows the transport's path (/proc/self/fd/N); rows get `name`.
+        with open_transport(data) as transport:
+            if settings.OFIQ_OUTPUT_MODE == "fifo":
+                rows, usage = self._score_to_pipe(transport.image_path, config, tenant, pass_fds=transport.pass_fds)
+            else:
+                usage = run_ofiq(transport.image_path, transport.output_path, config=config,
+                                 tenant=tenant, pass_fds=transport.pass_fds)
+                rows = parse_results(transport.read_output())
+            if not rows:
+                raise SubProcessException(error_message="OFIQ exited without writing results", kind="engine_fault")
+            return [normalize_row(row, name) for row in rows], usage
+
+    def _score_to_pipe(self, image_path: str, config: str, tenant: str,
+                       pass_fds: Sequence[int] = (), isolating: bool = False) -> Tuple[List, ProcessUsage]:
+        # OFIQ writes its CSV into a FIFO and rows are parsed as they arrive
+        with ResultPipe() as pipe:
+            usage = run_ofiq(image_path, pipe.path, config=config, tenant=tenant, pass_fds=pass_fds,
+                             isolating=isolating)
+            return [normalize_row(row, row['Filename']) for row in pipe.finish()], usage
+
+    def score_image(self, image_path: str, config: str = settings.OFIQ_CONFIG,
+                    tenant: str = settings.DEFAULT_TENANT,
+                    aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage]:
+        return self._score_path(image_path, config, tenant, aliases)
+
+    def _score_path(self, image_path: str, config: str, tenant: str, aliases: Optional[Aliases],
+                    isolating: bool = False) -> Tuple[List, ProcessUsage]:
+        # Each job gets its own output file so concurrent runs can't clobber
+        # each other's results.csv
+        if settings.OFIQ_OUTPUT_MODE == "fifo":
+            rows, usage = self._score_to_pipe(image_path, config, tenant, isolating=isolating)
+            return expand_duplicates(rows, aliases), usage
+        with tempfile.TemporaryDirectory(prefix="ofiq-job-", dir=settings.OFIQ_WORK_DIR) as job_dir:
+            results_path = os.path.join(job_dir, 'results.csv')
+            usage = analyze_images(image_path, results_path, config=config, tenant=tenant, isolating=isolating)
+            return read_results(results_path, aliases), usage
+
+    def score_batch(self, directory: str, config: str = settings.OFIQ_CONFIG,
+                    tenant: str = settings.DEFAULT_TENANT,
+                    aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage, Failures]:
+        return self._isolate(directory, config, tenant, aliases or {})
+
+    def stream_batch(self, directory: str, config: str = settings.OFIQ_CONFIG,
+                     tenant: str = settings.DEFAULT_TENANT,
+                     aliases: Optional[Aliases] = None) -> Iterator[Scored]:
+        # One OFIQ run over the whole batch, on a helper thread, writes into a
+        # ResultPipe and rows are yielded as OFIQ writes them; the last one
+        # waits for the run to end and carries its usage. If the run fails,
+        # the images it wrote no row for are bisected (see _bisect) and
+        # yielded once that is done.
+        aliases = aliases or {}
+        names = sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+        arrived: queue.Queue = queue.Queue()
+        scored, last, error = set(), None, None
+        with ResultPipe(on_row=arrived.put) as pipe:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ofiq-stream") as runner:
+                run = runner.submit(in_current_job(run_ofiq), directory, pipe.path, config=config, tenant=tenant,
+                                    isolating=True)
+                # The reader has passed on every row once finish() returns
+                run.add_done_callback(lambda _: (pipe.finish(), arrived.put(None)))
+                for row in iter(arrived.get, None):
+                    if last is not None:
+                        yield from with_duplicates(os.path.basename(last['Filename']), last,
+                                                   ProcessUsage(0.0, 0.0, 0.0, 0), aliases)
+                    last = normalize_row(row, row['Filename'])
+                    scored.add(os.path.basename(last['Filename']))
+                try:
+                    usage = run.result()
+                except SubProcessException as e:
+                    usage, error = ProcessUsage(0.0, 0.0, 0.0, 0), e
+
+        rest = [name for name in names if name not in scored]
+        if error is None:
+            missing = SubProcessException(error_message="no result from OFIQ", kind="engine_fault")
+            tail = [(name, missing) for name in rest]
+        elif rest:
+            rest_dir = os.path.join(directory, "rest")
+            os.mkdir(rest_dir)
+            for name in rest:
+                os.rename(os.path.join(directory, name), os.path.join(rest_dir, name))
+            rows, rest_usage, failures = self._bisect(rest_dir, config, tenant, {}, error)
+            usage += rest_usage
+            tail = [(os.path.basename(row['Filename']), row) for row in rows] + list(failures.items())
+        else:
+            tail = []
+        if last is not None:
+            tail.insert(0, (os.path.basename(last['Filename']), last))
+        for name, result in tail:
+            yield from with_duplicates(name, result, usage, aliases)
+            usage = ProcessUsage(0.0, 0.0, 0.0, 0)
+
+    def _isolate(self, directory: str, config: str, tenant: str,
+                 aliases: Aliases) -> Tuple[List, ProcessUsage, Failures]:
+        try:
+            rows, usage = self._score_path(directory, config, tenant, aliases, isolating=True)
+            return rows, usage, {}
+        except SubProcessException as e:
+            return self._bisect(directory, config, tenant, aliases, e)
+
+    def _bisect(self, directory: str, config: str, tenant: str, aliases: Aliases,
+                error: SubProcessException) -> Tuple[List, ProcessUsage, Failures]:
+        # OFIQ stops at the first image it can't handle and fails the whole run.
+        # When a batch fails, its files are split into two halves (moved into
+        # subdirectories, which is cheap) and each half is scored again, until
+        # the images that fail are isolated. The rest keep their results and
+        # every failing image gets the error of its own run.
+        # Failures no image can cause (engine_wide, timeouts, cancelled runs)
+        # are not bisected, nor are halves that both fail with the same
+        # message (which then names no image): every image gets the error
+        # instead of launching OFIQ about twice per image. A crash says
+        # nothing, so halves that both crash are still bisected.
+        names = sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+        if len(names) <= 1 or error.engine_wide or error.kind in ("timeout", "cancelled", "overloaded"):
+            return [], ProcessUsage(0.0, 0.0, 0.0, 0), self._fail_all(names, aliases, error)
+        metrics.increment("batch_bisections")
+        halves = []
+        middle = len(names) // 2
+        for number, half in enumerate((names[:middle], names[middle:])):
+            half_dir = os.path.join(directory, f"half-{number}")
+            os.mkdir(half_dir)
+            for name in half:
+                os.rename(os.path.join(directory, name), os.path.join(half_dir, name))
+            try:
+                half_rows, half_usage = self._score_path(half_dir, config, tenant, aliases, isolating=True)
+                halves.append((half_dir, half_rows, half_usage, None))
+            except SubProcessException as e:
+                halves.append((half_dir, [], ProcessUsage(0.0, 0.0, 0.0, 0), e))
+            except CircuitOpenException as e:
+                # Every launch is admitted on its own, so the circuit can open
+                # part way through; the images scored so far keep their results
+                halves.append((half_dir, [], ProcessUsage(0.0, 0.0, 0.0, 0),
+                               SubProcessException(error_message=e.error_message, kind="overloaded")))
+        errors = [half_error for _, _, _, half_error in halves]
+        if all(errors) and len({(e.kind, e.error_message) for e in errors}) == 1 and errors[0].error_message.strip():
+            return [], ProcessUsage(0.0, 0.0, 0.0, 0), self._fail_all(names, aliases, errors[0])
+        rows, usage, failures = [], ProcessUsage(0.0, 0.0, 0.0, 0), {}
+        for half_dir, half_rows, half_usage, half_error in halves:
+            half_failures = {}
+            if half_error is not None:
+                half_rows, half_usage, half_failures = self._bisect(half_dir, config, tenant, aliases, half_error)
+            rows.extend(half_rows)
+            usage += half_usage
+            failures.update(half_failures)
+        return rows, usage, failures
+
+    def _fail_all(self, names: List[str], aliases: Aliases, error: SubProcessException) -> Failures:
+        failures = {}
+        for name in names:
+            failures.update(dict.fromkeys([name, *aliases.get(name, ())], error))
+        return failures
+
+    def health(self) -> dict:
+        return {"engine": self.name, "binary": settings.OFIQ_BINARY}
+
+
+class PerImageEngine(Engine):
+    # Base for backends that assess one image per call. Batches are scored
+    # image by image, so failures are isolated without bisection.
+    def __init__(self) -> None:
+        self._slots: Dict[object, dict] = {}
+        self._slots_lock = threading.Lock()
+
+    def _slot_state(self) -> dict:
+        # State kept for the pool slot running this job, which only one job
+        # holds at a time; outside the pool, for the calling thread
+        slot = current_slot()
+        key = slot if slot is not None else f"thread-{threading.get_ident()}"
+        with self._slots_lock:
+            return self._slots.setdefault(key, {})
+
+    def _pop_slot_state(self, slot: int) -> dict:
+        with self._slots_lock:
+            return self._slots.pop(slot, {})
+
+    @abc.abstractmethod
+    def _assess(self, data: bytes, filename: str, config: str) -> Tuple[dict, ProcessUsage]:
+        ...
+
+    def _run(self, data: bytes, filename: str, config: str, tenant: str) -> Tuple[dict, ProcessUsage]:
+        probe = engine_breaker.admit()
+        try:
+            row, usage = self._assess(data, filename, config)
+            row = normalize_row(row, filename)
+        except SubProcessException as e:
+            engine_health.record_run(False)
+            engine_breaker.record(e.kind not in ("engine_fault", "timeout"), probe)
+            if e.kind == "timeout":
+                concurrency_limiter.record_timeout()
+            metrics.increment(f"ofiq_errors_{e.kind}")
+            logger.error("OFIQ error", extra={"engine": self.name, "input": filename, "tenant": tenant,
+                                              "config": config, "error_kind": e.kind, "error": e.error_message})
+            raise
+        metrics.record_usage(usage, config=config, tenant=tenant)
+        engine_health.record_run(True)
+        engine_breaker.record(True, probe)
+        concurrency_limiter.record(usage.wall_time)
+        return row, usage
+
+    def _read(self, path: str) -> bytes:
+        # An unreadable input is the image's problem, as it is for OFIQSampleApp
+        try:
+            with open(path, 'rb') as file:
+                return file.read()
+        except OSError as e:
+            metrics.increment("ofiq_errors_input_error")
+            raise SubProcessException(error_message=f"Could not read image {path}: {e.strerror}", kind="input_error")
+
+    def score_one(self, data: bytes, config: str = settings.OFIQ_CONFIG,
+                  tenant: str = settings.DEFAULT_TENANT, name: str = "upload") -> Tuple[List, ProcessUsage]:
+        row, usage = self._run(data, name, config, tenant)
+        return [row], usage
+
+    def stream_batch(self, directory: str, config: str = settings.OFIQ_CONFIG,
+                     tenant: str = settings.DEFAULT_TENANT,
+                     aliases: Optional[Aliases] = None) -> Iterator[Scored]:
+        paths = [directory]
+        if os.path.isdir(directory):
+            paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+        for path in paths:
+            try:
+                row, usage = self._run(self._read(path), path, config, tenant)
+            except SubProcessException as e:
+                row, usage = e, ProcessUsage(0.0, 0.0, 0.0, 0)
+            except CircuitOpenException as e:
+                # The circuit opened part way through; the images scored so
+                # far keep their results
+                row = SubProcessException(error_message=e.error_message, kind="overloaded")
+                usage = ProcessUsage(0.0, 0.0, 0.0, 0)
+            yield from with_duplicates(os.path.basename(path), row, usage, aliases or {})
+
+    def score_image(self, image_path: str, config: str = settings.OFIQ_CONFIG,
+                    tenant: str = settings.DEFAULT_TENANT,
+                    aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage]:
+        rows, usage, failures = self.score_batch(image_path, config, tenant, aliases)
+        if failures:
+            raise next(iter(failures.values()))
+        return rows, usage
+
+
+class LibraryEngine(PerImageEngine):
+    # OFIQ loaded into this process through ctypes (see ofiqlib.py). Each
+    # pool slot keeps its own engine per config, since a library handle
+    # can't be used concurrently. Usage is the thread's CPU time (all of it
+    # counted as user time) and the peak RSS of the whole service. There is
+    # no child to kill, so OFIQ_RUN_TIMEOUT doesn't apply, and a crash in
+    # OFIQ takes the service down; the worker engine avoids both.
+    name = "library"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._instances: List[OFIQLibrary] = []
+        self._lock = threading.Lock()
+        # Read by the runtimes when OFIQ is loaded, which hasn't happened yet
+        for name in THREAD_VARIABLES:
+            os.environ[name] = str(settings.OFIQ_THREADS_PER_WORKER)
+
+    def preflight(self) -> List[str]:
+        errors = super().preflight()
+        if not os.path.isfile(settings.OFIQ_LIBRARY):
+            errors.insert(0, f"OFIQ library not found: {settings.OFIQ_LIBRARY}")
+        return errors
+
+    def warmup_files(self) -> List[str]:
+        return [settings.OFIQ_LIBRARY, *super().warmup_files()]
+
+    def _library(self, config: str) -> OFIQLibrary:
+        libraries = self._slot_state().setdefault("by_config", {})
+        if config not in libraries:
+            libraries[config] = OFIQLibrary(settings.OFIQ_LIBRARY, config)
+            with self._lock:
+                self._instances.append(libraries[config])
+        return libraries[config]
+
+    def _assess(self, data: bytes, filename: str, config: str) -> Tuple[dict, ProcessUsage]:
+        # Pinned before the engine is created too, so its thread pools inherit the slot's CPUs
+        pin(0, pinned_cpus())
+        started, cpu_started = time.monotonic(), time.thread_time()
+        row = self._library(config).assess(data, filename)
+        return row, ProcessUsage(time.monotonic() - started, time.thread_time() - cpu_started, 0.0,
+                                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def health(self) -> dict:
+        with self._lock:
+            return {"engine": self.name, "library": settings.OFIQ_LIBRARY, "instances": len(self._instances)}
+
+    def release_slot(self, slot: int) -> None:
+        for library in self._pop_slot_state(slot).get("by_config", {}).values():
+            with self._lock:
+                self._instances.remove(library)
+            library.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for library in self._instances:
+                library.close()
+
+
+class WorkerEngine(PerImageEngine):
+    # A persistent child process per pool slot and config that keeps the
+    # OFIQ library and its models loaded between images (see ofiqworker.py).
+    # Images go over a pipe; a worker that crashes or hangs past
+    # OFIQ_RUN_TIMEOUT_PER_IMAGE is killed and replaced on the next call.
+    # Workers are also recycled after OFIQ_WORKER_MAX_IMAGES images, above
+    # OFIQ_WORKER_MAX_RSS_MB or after OFIQ_WORKER_MAX_AGE seconds, to shed
+    # leaks and fragmentation. The replacement is started in the background
+    # and the old worker keeps scoring until it is ready, so recycling never
+    # takes a worker out of service.
+    name = "worker"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._workers: List[WorkerProcess] = []
+        self._lock = threading.Lock()
+        self._spawner = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="ofiq-worker-spawn")
+
+    def preflight(self) -> List[str]:
+        errors = super().preflight()
+        if not os.path.isfile(settings.OFIQ_LIBRARY):
+            errors.insert(0, f"OFIQ library not found: {settings.OFIQ_LIBRARY}")
+        return errors
+
+    def warmup_files(self) -> List[str]:
+        return [settings.OFIQ_LIBRARY, *super().warmup_files()]
+
+    def _spawn(self, config: str, cpus: Optional[List[int]]) -> WorkerProcess:
+        worker = WorkerProcess(settings.OFIQ_LIBRARY, config,
+                               env=thread_environment(settings.OFIQ_THREADS_PER_WORKER), cpus=cpus)
+        with self._lock:
+            self._workers = [w for w in self._workers if w.alive] + [worker]
+        return worker
+
+    def _retire(self, worker: WorkerProcess) -> None:
+        with self._lock:
+            self._workers = [w for w in self._workers if w is not worker and w.alive]
+        worker.close()
+
+    @staticmethod
+    def _recycle_reason(worker: WorkerProcess) -> Optional[str]:
+        if settings.OFIQ_WORKER_MAX_IMAGES and worker.images >= settings.OFIQ_WORKER_MAX_IMAGES:
+            return "images"
+        if settings.OFIQ_WORKER_MAX_RSS_MB and worker.rss_kb >= settings.OFIQ_WORKER_MAX_RSS_MB * 1024:
+            return "rss"
+        if settings.OFIQ_WORKER_MAX_AGE and worker.age >= settings.OFIQ_WORKER_MAX_AGE:
+            return "age"
+        return None
+
+    def _worker(self, config: str) -> WorkerProcess:
+        state = self._slot_state()
+        workers = state.setdefault("by_config", {})
+        # config -> (replacement being started, why the current worker is recycled)
+        replacements = state.setdefault("replacements", {})
+        worker = workers.get(config)
+        if worker is None or not worker.alive:
+            # A replacement that is already loading is quicker than a new one
+            replacement, _ = replacements.pop(config, (None, None))
+            if worker is not None:
+                metrics.increment("worker_restarts")
+            try:
+                worker = replacement.result() if replacement is not None else None
+            except SubProcessException:
+                worker = None
+            workers[config] = worker or self._spawn(config, pinned_cpus())
+            return workers[config]
+
+        if config not in replacements:
+            reason = self._recycle_reason(worker)
+            if reason is not None:
+                replacements[config] = (self._spawner.submit(self._spawn, config, worker.cpus), reason)
+            return worker
+        replacement, reason = replacements[config]
+        if not replacement.done():
+            return worker
+        del replacements[config]
+        try:
+            workers[config] = replacement.result()
+        except SubProcessException as e:
+            # Keep the old worker and try again on the next image
+            metrics.increment("worker_recycle_failures")
+            logger.error("Could not start a replacement OFIQ worker", extra={"error": e.error_message, "config": config})
+            return worker
+        metrics.increment(f"worker_recycled_{reason}")
+        logger.info("Recycled OFIQ worker", extra={"reason": reason, "old": worker.as_dict(),
+                                                   "new_pid": workers[config].pid})
+        self._spawner.submit(self._retire, worker)
+        return workers[config]
+
+    def _assess(self, data: bytes, filename: str, config: str) -> Tuple[dict, ProcessUsage]:
+        return self._worker(config).assess(data, filename, settings.OFIQ_RUN_TIMEOUT_PER_IMAGE or None)
+
+    def health(self) -> dict:
+        with self._lock:
+            workers = [worker.as_dict() for worker in self._workers if worker.alive]
+        return {"engine": self.name, "library": settings.OFIQ_LIBRARY, "workers": workers}
+
+    def release_slot(self, slot: int) -> None:
+        state = self._pop_slot_state(slot)
+        for worker in state.get("by_config", {}).values():
+            self._spawner.submit(self._retire, worker)
+        for replacement, _ in state.get("replacements", {}).values():
+            replacement.add_done_callback(self._retire_started)
+
+    def _retire_started(self, replacement: concurrent.futures.Future) -> None:
+        if replacement.exception() is None:
+            self._retire(replacement.result())
+
+    def close(self) -> None:
+        # Replacements still loading register themselves before this returns
+        self._spawner.shutdown(wait=True)
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+
+
+class StubEngine(PerImageEngine):
+    # Doesn't run OFIQ at all: every image gets scores derived from its
+    # content hash after OFIQ_STUB_DELAY seconds. For tests and for measuring
+    # the service's own overhead; it needs none of the OFIQ files.
+    name = "stub"
+
+    def preflight(self) -> List[str]:
+        return []
+
+    def warmup_files(self) -> List[str]:
+        return []
+
+    @property
+    def warmup_image(self) -> Optional[str]:
+        return None
+
+    def _assess(self, data: bytes, filename: str, config: str) -> Tuple[dict, ProcessUsage]:
+        started = time.monotonic()
+        if settings.OFIQ_STUB_DELAY:
+            time.sleep(settings.OFIQ_STUB_DELAY)
+        score = int(hashlib.sha256(data).hexdigest()[:4], 16) % 101
+        row = {"Filename": filename, "UnifiedQualityScore": float(score), "UnifiedQualityScore.scalar": float(score)}
+        return row, ProcessUsage(time.monotonic() - started, 0.0, 0.0, 0)
+
+
+ENGINES = {engine.name: engine for engine in (SubprocessEngine, LibraryEngine, WorkerEngine, StubEngine)}
+
+
+def create_engine(name: str) -> Engine:
+    if name not in ENGINES:
+        raise ValueError(f"Unknown OFIQ_ENGINE {name!r}, expected one of {', '.join(ENGINES)}")
+    return ENGINES[name]()
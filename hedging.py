@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, List, Optional
+
+from autoscaler import percentile
+from customexceptions import OverloadedException, SubProcessException
+from metrics import metrics
+from ofiqprocess import CancelScope, cancel_scope
+from workerpool import WorkerPool
+
+
+def _run_in_scope(scope: CancelScope, fn: Callable, args: tuple, kwargs: dict):
+    # Pool job: skipped if cancelled while still queued, otherwise run with
+    # `scope` current so the OFIQ process it starts can be killed
+    if scope.cancelled:
+        raise SubProcessException(error_message="OFIQ run cancelled", kind="cancelled")
+    token = cancel_scope.set(scope)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        cancel_scope.reset(token)
+
+
+def _retrieve(future: asyncio.Future) -> None:
+    # The losing run's error is expected; don't log it as never retrieved
+    future.exception()
+
+
+class Hedger:
+    # Runs pool jobs for single-image requests and keeps their latencies.
+    # A hedged job that hasn't finished after the p95 of recent latencies
+    # (at least min_delay, and only once min_samples are known) gets a
+    # duplicate on an idle worker. The first to succeed answers and the
+    # other is cancelled, which kills its OFIQ process. The other engines'
+    # losing run finishes unused: the library and stub engines have no
+    # process to kill, and killing a persistent worker would throw away its
+    # loaded models, costing more than the run it saves. At
+    # most `budget` of the pool's concurrency runs duplicates at once, and
+    # none are started while jobs are queued. A duplicate counts against the
+    # budget until both runs have stopped, since a loser that isn't killed
+    # keeps its worker as busy as the duplicate did.
+    def __init__(self, pool: WorkerPool, budget: float, min_delay: float, min_samples: int, window: int) -> None:
+        self.pool = pool
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._hedges = 0  # duplicates running now
+
+    def delay(self) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = list(self._latencies)
+        return max(self.min_delay, percentile(latencies, 0.95))
+
+    def _reserve(self) -> bool:
+        status = self.pool.snapshot()
+        with self._lock:
+            if self._hedges >= int(self.budget * status["concurrency"]):
+                metrics.increment("hedges_over_budget")
+                return False
+            if status["queued"] or status["running"] >= status["concurrency"]:
+                metrics.increment("hedges_no_idle_worker")
+                return False
+            self._hedges += 1
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._hedges -= 1
+
+    def _release_when_done(self, jobs: List[Future]) -> None:
+        remaining = [len(jobs)]
+
+        def finished(_: Future) -> None:
+            with self._lock:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    self._hedges -= 1
+
+        for job in jobs:
+            job.add_done_callback(finished)
+
+    async def run(self, hedge: bool, fn: Callable, *args, **kwargs):
+        started = time.monotonic()
+        primary_scope = CancelScope()
+        primary_job = self.pool.submit(_run_in_scope, primary_scope, fn, args, kwargs)
+        primary = asyncio.wrap_future(primary_job)
+        delay = self.delay() if hedge else None
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done and self._reserve():
+                result = await self._race(primary_job, primary, primary_scope, fn, args, kwargs)
+                self._record(started)
+                return result
+        result = await primary
+        self._record(started)
+        return result
+
+    async def _race(self, primary_job: Future, primary: asyncio.Future, primary_scope: CancelScope,
+                    fn: Callable, args: tuple, kwargs: dict):
+        hedge_scope = CancelScope()
+        try:
+            submitted = self.pool.submit(_run_in_scope, hedge_scope, fn, args, kwargs)
+        except OverloadedException:
+            self._release()
+            return await primary
+        self._release_when_done([primary_job, submitted])
+        metrics.increment("hedges_launched")
+        hedge = asyncio.wrap_future(submitted)
+        scopes = {primary: primary_scope, hedge: hedge_scope}
+        for run in scopes:
+            run.add_done_callback(_retrieve)
+
+        done, pending = await asyncio.wait(scopes, return_when=asyncio.FIRST_COMPLETED)
+        winner = primary if primary in done else hedge
+        if winner.exception() is not None and pending:
+            # A failure may be what made the run slow; the other one may still succeed
+            other = pending.pop()
+            await asyncio.wait({other})
+            if other.exception() is None:
+                winner = other
+        loser = hedge if winner is primary else primary
+        if not loser.done():
+            # Killing the process waits for it to be reaped; not on the event loop
+            asyncio.get_running_loop().run_in_executor(None, scopes[loser].cancel)
+        if winner is hedge:
+            metrics.increment("hedges_won")
+        return winner.result()
+
+    def _record(self, started: float) -> None:
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        delay = self.delay()
+        with self._lock:
+            return {"running": self._hedges, "budget": self.budget, "delay": delay}
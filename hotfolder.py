@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+from watchfiles import Change, watch
+
+import settings
+from customexceptions import PERMANENT_KINDS, OverloadedException, SubProcessException
+from metrics import metrics
+from resultstore import FileIndex, IndexEntry, ResultStore
+from staging import ChunkDuplicates, file_sha256, stage_file, staged_name
+
+logger = logging.getLogger(__name__)
+
+# (size, mtime_ns) of a file as it was when it was queued or staged
+FileVersion = Tuple[int, int]
+
+
+def _version(path: str) -> Optional[FileVersion]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class HotFolder:
+    # Scores images dropped into a watched directory. Changes reported by
+    # watchfiles are queued until the file has stopped changing for
+    # OFIQ_WATCH_SETTLE_SECONDS, then scored in batches through `submit`
+    # (which returns a Future of (rows, usage, failures) for a staged
+    # directory and the aliases of files left out of it as duplicates).
+    # Results go to the result store and to <output dir>/<relative path>.json,
+    # and the file index records what was scored so a restart only picks up
+    # files that are new or changed.
+    def __init__(self, watch_dir: str, output_dir: str, index: FileIndex, store: ResultStore,
+                 submit: Callable[[str, Dict[str, List[str]]], Future], config: str) -> None:
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self._index = index
+        self._store = store
+        self._submit = submit
+        self._config = config
+        self._pending: Dict[str, FileVersion] = {}
+        self._inflight: Dict[Future, Dict[str, Tuple[str, FileVersion]]] = {}  # staged name -> (path, version)
+        self._inflight_paths = set()
+        self._retries: Dict[str, int] = {}  # path -> engine-side failures so far
+        self._rescan_needed = True  # pick up files that arrived while we were down
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ofiq-hotfolder", daemon=True)
+
+    def start(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._thread.start()
+        logger.info("Watching folder for images", extra={"watch_dir": self.watch_dir, "output_dir": self.output_dir})
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def join(self, timeout: float) -> None:
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        try:
+            for changes in watch(self.watch_dir, stop_event=self._stop, debounce=settings.OFIQ_WATCH_DEBOUNCE_MS,
+                                 rust_timeout=1000, yield_on_timeout=True, recursive=True):
+                for change, path in changes:
+                    if change != Change.deleted:
+                        self._queue(path)
+                if self._rescan_needed:
+                    self._rescan()
+                self._collect(block=False)
+                self._dispatch()
+        except Exception:
+            logger.exception("Hot folder watcher stopped")
+        # Batches already handed to the pool are drained by the pool itself;
+        # record their results so they are not scored again after a restart
+        self._collect(block=True)
+
+    def _wanted(self, path: str) -> bool:
+        return (os.path.splitext(path)[1].lower() in settings.IMAGE_EXTENSIONS
+                and not path.startswith(self.output_dir + os.sep))
+
+    def _queue(self, path: str, version: Optional[FileVersion] = None) -> None:
+        if not self._wanted(path) or path in self._inflight_paths:
+            return
+        if path not in self._pending and len(self._pending) >= settings.OFIQ_WATCH_MAX_PENDING:
+            # Too much backlog to track file by file; find it again later
+            self._rescan_needed = True
+            return
+        version = version or _version(path)
+        if version is not None and not self._index.is_current(path, *version):
+            self._pending[path] = version
+
+    def _rescan(self) -> None:
+        self._rescan_needed = False
+        for root, _, files in os.walk(self.watch_dir):
+            for name in files:
+                if len(self._pending) >= settings.OFIQ_WATCH_MAX_PENDING:
+                    self._rescan_needed = True
+                    return
+                self._queue(os.path.join(root, name))
+
+    def _settled(self) -> List[Tuple[str, FileVersion]]:
+        # Files whose size and mtime did not change since they were queued
+        # and that have not been written to for the settle time
+        ready = []
+        horizon = time.time_ns() - int(settings.OFIQ_WATCH_SETTLE_SECONDS * 1e9)
+        for path, queued_version in list(self._pending.items()):
+            version = _version(path)
+            if version is None:
+                del self._pending[path]
+            elif version != queued_version:
+                self._pending[path] = version
+            elif version[1] <= horizon:
+                ready.append((path, version))
+        return ready
+
+    def _dispatch(self) -> None:
+        ready = self._settled()
+        while ready and len(self._inflight) < settings.OFIQ_WATCH_MAX_INFLIGHT_BATCHES:
+            batch, ready = ready[:settings.OFIQ_WATCH_BATCH_SIZE], ready[settings.OFIQ_WATCH_BATCH_SIZE:]
+            chunk_dir = tempfile.mkdtemp(prefix="ofiq-watch-", dir=settings.OFIQ_WORK_DIR)
+            staged, duplicates = {}, ChunkDuplicates()
+            for number, (path, version) in enumerate(batch):
+                name = staged_name(number, path)
+                try:
+                    if not settings.OFIQ_BATCH_DEDUP or duplicates.original(file_sha256(path), name) is None:
+                        stage_file(path, os.path.join(chunk_dir, name))
+                except OSError:
+                    continue  # removed in the meantime
+                staged[name] = (path, version)
+            try:
+                future = self._submit(chunk_dir, duplicates.aliases)
+            except OverloadedException:
+                shutil.rmtree(chunk_dir, ignore_errors=True)
+                return  # leave them pending, try again on the next tick
+            for path, _ in batch:
+                self._pending.pop(path, None)
+            self._inflight[future] = staged
+            self._inflight_paths.update(path for path, _ in staged.values())
+
+    def _collect(self, block: bool) -> None:
+        if not self._inflight:
+            return
+        done, _ = wait(list(self._inflight), timeout=None if block else 0,
+                       return_when=ALL_COMPLETED if block else FIRST_COMPLETED)
+        for future in done:
+            staged = self._inflight.pop(future)
+            self._inflight_paths.difference_update(path for path, _ in staged.values())
+            try:
+                rows, _, failures = future.result()
+            except OverloadedException:
+                # Never ran (pool shutting down or engine circuit open); try
+                # again later, or on the next start if we are stopping
+                for path, _ in staged.values():
+                    self._queue(path)
+                continue
+            except Exception as e:
+                # A bug in scoring must not stop the watcher; the batch counts
+                # as an engine-side failure of each of its files
+                logger.exception("Scoring a hot folder batch failed", extra={"files": len(staged)})
+                error = SubProcessException(error_message=f"Scoring failed: {e!r}", kind="engine_fault")
+                self._record(staged, {}, dict.fromkeys(staged, error))
+                continue
+            self._record(staged, {os.path.basename(row['Filename']): row for row in rows}, failures)
+
+    def _record(self, staged: Dict[str, Tuple[str, FileVersion]], rows: Dict[str, dict],
+                failures: Dict[str, SubProcessException]) -> None:
+        entries, results, retried = [], [], []
+        for name, (path, version) in staged.items():
+            row = rows.get(name)
+            if row is None:
+                error = failures.get(name)
+                if (error is None or error.kind not in PERMANENT_KINDS) and self._retry(path):
+                    retried.append(path)
+                    continue
+                message = error.error_message if error is not None else "no result from OFIQ"
+                entries.append(IndexEntry(path, *version, "failed", message))
+                continue
+            self._retries.pop(path, None)
+            row = {**row, 'Filename': path}
+            self._write_output(path, row)
+            results.append((path, row))
+            entries.append(IndexEntry(path, *version, "scored"))
+        self._store.put_many(self._config, results)
+        self._index.mark_many(entries)
+        for path, version in staged.values():
+            if _version(path) != version:
+                self._queue(path)  # rewritten while it was being scored
+        for path in retried:
+            self._queue(path)
+        metrics.increment("watch_files_scored", len(results))
+        metrics.increment("watch_files_failed", len(entries) - len(results))
+        metrics.increment("watch_files_retried", len(retried))
+
+    def _retry(self, path: str) -> bool:
+        # Whether a file that failed for engine-side reasons gets another try
+        attempts = self._retries.get(path, 0) + 1
+        if attempts > settings.OFIQ_WATCH_MAX_RETRIES:
+            del self._retries[path]
+            return False
+        self._retries[path] = attempts
+        return True
+
+    def _write_output(self, path: str, row: dict) -> None:
+        target = os.path.join(self.output_dir, os.path.relpath(path, self.watch_dir) + ".json")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + ".partial", "w") as file:
+            json.dump(row, file)
+        os.replace(target + ".partial", target)
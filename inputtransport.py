@@ -0,0 +1,100 @@
+import abc
+import io
+import os
+import shutil
+import tempfile
+from typing import Tuple
+
+import settings
+
+# Leading bytes of the image formats OFIQ reads, used to name staged files
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"BM", ".bmp"),
+    (b"\x00\x00\x00\x0cjP  ", ".jp2"),
+    (b"\xff\x4f\xff\x51", ".j2k"),
+    (b"II*\x00", ".tif"),
+    (b"MM\x00*", ".tif"),
+]
+
+
+def image_suffix(data: bytes) -> str:
+    for signature, suffix in _SIGNATURES:
+        if data.startswith(signature):
+            return suffix
+    return ".png"
+
+
+class InputTransport(abc.ABC):
+    # Hands an in-memory image to OFIQ and gets its CSV back. Subclasses
+    # decide where the bytes live; OFIQ only ever sees image_path and
+    # output_path, plus any descriptors it has to inherit (pass_fds).
+    image_path: str
+    output_path: str
+    pass_fds: Tuple[int, ...] = ()
+
+    @abc.abstractmethod
+    def read_output(self) -> io.StringIO:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "InputTransport":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class MemfdTransport(InputTransport):
+    # Image and CSV live in anonymous memory files. The descriptors are
+    # inherited by OFIQ under the same numbers, so it can open them through
+    # /proc/self/fd; nothing touches a filesystem.
+    def __init__(self, data: bytes) -> None:
+        self._input_fd = os.memfd_create("ofiq-input", os.MFD_CLOEXEC)
+        self._output_fd = os.memfd_create("ofiq-output", os.MFD_CLOEXEC)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._input_fd, view):]
+        self.image_path = f"/proc/self/fd/{self._input_fd}"
+        self.output_path = f"/proc/self/fd/{self._output_fd}"
+        self.pass_fds = (self._input_fd, self._output_fd)
+
+    def read_output(self) -> io.StringIO:
+        size = os.fstat(self._output_fd).st_size
+        return io.StringIO(os.pread(self._output_fd, size, 0).decode("utf-8", errors="replace"))
+
+    def close(self) -> None:
+        os.close(self._input_fd)
+        os.close(self._output_fd)
+
+
+class DirectoryTransport(InputTransport):
+    # Image and CSV in a private temporary directory, on tmpfs (/dev/shm)
+    # or on the regular work dir
+    def __init__(self, data: bytes, directory: str) -> None:
+        self._dir = tempfile.mkdtemp(prefix="ofiq-upload-", dir=directory)
+        self.image_path = os.path.join(self._dir, "input" + image_suffix(data))
+        self.output_path = os.path.join(self._dir, "results.csv")
+        with open(self.image_path, "wb") as file:
+            file.write(data)
+
+    def read_output(self) -> io.StringIO:
+        with open(self.output_path, "r") as file:
+            return io.StringIO(file.read())
+
+    def close(self) -> None:
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def open_transport(data: bytes) -> InputTransport:
+    # OFIQ_INPUT_TRANSPORT picks memfd, tmpfs or disk; memfd falls back to
+    # tmpfs where memfd_create isn't available
+    transport = settings.OFIQ_INPUT_TRANSPORT
+    if transport == "memfd" and hasattr(os, "memfd_create"):
+        return MemfdTransport(data)
+    if transport in ("memfd", "tmpfs") and os.path.isdir(settings.OFIQ_TMPFS_DIR):
+        return DirectoryTransport(data, settings.OFIQ_TMPFS_DIR)
+    return DirectoryTransport(data, settings.OFIQ_WORK_DIR)
@@ -0,0 +1,117 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from typing import Optional
+
+import settings
+from metrics import metrics
+
+# Request id of the request being served, set by the middleware in main.py
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName", "request_id", "sample"}
+
+
+class RequestIdFilter(logging.Filter):
+    # Runs in the caller's thread so the request id is captured before the
+    # record is handed over to the background writer.
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        return True
+
+
+class SuccessSampler(logging.Filter):
+    # Keeps only a fraction of records flagged as high-volume success logs
+    # (extra={"sample": True}). Warnings and errors are never sampled out.
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not getattr(record, "sample", False):
+            return True
+        return random.random() < self.rate
+
+
+class AccessLogMarker(logging.Filter):
+    # Flags successful uvicorn access records so SuccessSampler can thin them
+    # out; access records carry (client, method, path, http_version, status).
+    def filter(self, record: logging.LogRecord) -> bool:
+        args = record.args
+        if isinstance(args, tuple) and len(args) == 5 and isinstance(args[4], int) and args[4] < 400:
+            record.sample = True
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never block the request path: when the writer falls behind and the
+    # queue is full, drop the record and count it instead.
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment("log_records_dropped")
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def start_logging() -> None:
+    # Route the root and uvicorn loggers through a bounded queue drained by a
+    # background QueueListener thread that writes JSON lines to stdout.
+    global _listener
+    if _listener is not None:
+        return
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=settings.LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SuccessSampler(settings.LOG_SUCCESS_SAMPLE_RATE))
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(queue_handler.queue, writer, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(settings.LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    logging.getLogger("uvicorn.access").addFilter(AccessLogMarker())
+
+
+def stop_logging() -> None:
+    # Flushes whatever is still queued before returning
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,13 +1,79 @@
-import subprocess
-from typing import Any, List
-import csv, json
+from typing import Any, List, Optional, Tuple
+from contextlib import asynccontextmanager
+import asyncio, concurrent.futures, hashlib, json, os, shutil, signal, threading, time, uuid
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from customexceptions import SubProcessException
+from archiveingest import ArchiveBatch, ChunkStream
+from autoscaler import Autoscaler
+from concurrencylimit import concurrency_limiter
+from cpuresources import cpu_summary
+from customexceptions import (ArchiveException, CircuitOpenException, OverloadedException, PERMANENT_KINDS,
+                              SubProcessException)
+from directoryscan import DirectoryScan
+from hedging import Hedger
+from engines import Aliases, Failures, create_engine
+from hotfolder import HotFolder
+from enginehealth import engine_health, prime_page_cache
+from logpipeline import request_id_var, start_logging, stop_logging
+from metrics import metrics
+from nearduplicate import near_duplicates, perceptual_hash
+from ofiqprocess import ProcessUsage, terminate_children
+from resultstore import FileIndex, ResultStore, StateDatabase
+from singleflight import SingleFlight
+from workerpool import WorkerPool
+import settings
 import logging
 
-app = FastAPI()
+# How OFIQ is run (OFIQ_ENGINE); see engines.py
+engine = create_engine(settings.OFIQ_ENGINE)
+pool = WorkerPool(min(max(settings.OFIQ_WORKERS, settings.OFIQ_MIN_WORKERS), settings.OFIQ_MAX_WORKERS),
+                  settings.OFIQ_MAX_QUEUE, max_workers=settings.OFIQ_MAX_WORKERS, on_retire=engine.release_slot)
+autoscaler = Autoscaler(pool, settings.OFIQ_MIN_WORKERS, settings.OFIQ_MAX_WORKERS)
+concurrency_limiter.attach(pool)
+hedger = Hedger(pool, settings.OFIQ_HEDGE_BUDGET, settings.OFIQ_HEDGE_MIN_DELAY, settings.OFIQ_HEDGE_MIN_SAMPLES,
+                settings.OFIQ_HEDGE_WINDOW)
+# Identical uploads (same bytes, same config) in flight at the same time
+# share one OFIQ run; collapsed requests are counted as score_collapsed
+score_flights = SingleFlight("score")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_logging()
+    # Warm up in the background so liveness probes are answered meanwhile;
+    # /readyz reports not ready until this has finished
+    warmup = asyncio.create_task(asyncio.to_thread(warmup_engine))
+    state_db = StateDatabase(settings.OFIQ_STATE_DB)
+    app.state.file_index = FileIndex(state_db)
+    app.state.result_store = ResultStore(state_db)
+    hot_folder = None
+    if settings.OFIQ_WATCH_DIR:
+        hot_folder = HotFolder(settings.OFIQ_WATCH_DIR, settings.OFIQ_WATCH_OUTPUT_DIR,
+                               app.state.file_index, app.state.result_store,
+                               lambda chunk_dir, aliases: pool.submit(score_chunk, chunk_dir, tenant="hotfolder",
+                                                                      aliases=aliases),
+                               settings.OFIQ_CONFIG)
+        # Only start picking up files once the engine is known to work
+        warmup.add_done_callback(lambda _: engine_health.ready and hot_folder.start())
+    if not near_duplicates.available:
+        logging.warning("Near-duplicate cache is off (it needs Pillow and OFIQ_NEAR_DUP_CACHE_SIZE > 0); "
+                        "near_duplicate=true is ignored")
+    autoscaler.start()
+    drain_on_signals()
+    yield
+    autoscaler.stop()
+    if hot_folder is not None:
+        hot_folder.stop()
+    await start_drain()
+    await warmup
+    if hot_folder is not None:
+        await asyncio.to_thread(hot_folder.join, settings.OFIQ_KILL_GRACE)
+    await asyncio.to_thread(pool.shutdown)
+    engine.close()
+    state_db.close()
+    stop_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 # Need to implement middleware and allow all origins
 app.add_middleware(
@@ -17,60 +83,395 @@ app.add_middleware(
     allow_methods=["*"],  # Allows all methods (GET, POST, etc.)
     allow_headers=["*"],  # Allows all headers
 )
+
+# Tag every request with an id so its log records can be correlated
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    request_id = request.headers.get(settings.REQUEST_ID_HEADER) or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers[settings.REQUEST_ID_HEADER] = request_id
+    return response
+
 # bash command to up server: uvicorn main:app --host 0.0.0.0 --reload
 # --host 0.0.0.0 is to bind server to all network interfaces
+# In production add --timeout-graceful-shutdown with OFIQ_SHUTDOWN_DEADLINE +
+# OFIQ_KILL_GRACE (see settings.py)
 
-def analyze_images():
-    # bash_command = ["./install_x86_64_linux/Release/bin/OFIQSampleApp","-c","data/ofiq_config.jaxn","-i ","testimage/b-01-smile.png","-o","results.csv"] 
-    bash_command = ['./OFIQ-Project/install_x86_64_linux//Release//bin//OFIQSampleApp', '-c', 'OFIQ-Project/data/ofiq_config.jaxn', '-i', 'OFIQ-Project/data/tests/images/b-01-smile.png', '-o', 'results.csv'] 
-    # bash_command = ['./OFIQ-Project/install_x86_64_linux//Release//bin//OFIQSampleApp', '-c', 'data/ofiq_config.jaxn', '-i', 'OFIQ-Project/data/tests/images/b-01-smile.png', '-o', 'results.csv'] 
-
-    # Below code lines using Popen to stream output as process is running
-    # Start a process and interact with it
-    # result = subprocess.Popen(bash_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # for line in result.stdout:
-    #     print(line.decode().strip())
-    
-    # Use this for normal run
-    result = subprocess.run(bash_command,capture_output=True,text=True)
-    print(f"{result.returncode}:",result.stderr)
-    logging.error(f"Subprocess error: {result.returncode}: {result.stderr}")
-    if result.returncode != 0:
-       raise SubProcessException(           
-           error_message=f"{result.stderr}"
-       )
+def usage_headers(usage: ProcessUsage) -> dict:
+    return {
+        "X-OFIQ-Wall-Time": f"{usage.wall_time:.3f}",
+        "X-OFIQ-User-Time": f"{usage.user_time:.3f}",
+        "X-OFIQ-Sys-Time": f"{usage.sys_time:.3f}",
+        "X-OFIQ-Max-RSS-KB": str(usage.max_rss_kb),
+    }
     
 
+# OFIQ failure kind -> (HTTP status, whether the same request can succeed later)
+ERROR_RESPONSES = {
+    "input_error": (422, False),
+    "no_face": (422, False),
+    "engine_fault": (500, True),
+    "timeout": (504, True),
+    "cancelled": (503, True),
+    "overloaded": (503, True),
+}
+
+def error_content(exc: SubProcessException) -> dict:
+    return {"error": exc.kind, "message": exc.error_message, "retryable": ERROR_RESPONSES[exc.kind][1]}
+
 @app.exception_handler(SubProcessException)
 async def subprocess_exception_handling(request: Request, exc: SubProcessException):
-    
-    return JSONResponse(status_code=401,
-                        content={"message":exc.error_message}
+    status_code, retryable = ERROR_RESPONSES[exc.kind]
+    return JSONResponse(status_code=status_code,
+                        content=error_content(exc),
+                        headers={"Retry-After": "5"} if retryable else None
                         )      
+
+@app.exception_handler(ArchiveException)
+async def archive_exception_handling(request: Request, exc: ArchiveException):
+    return JSONResponse(status_code=400,
+                        content={"message":exc.error_message}
+                        )
+
+@app.exception_handler(CircuitOpenException)
+async def circuit_open_exception_handling(request: Request, exc: CircuitOpenException):
+    metrics.increment("requests_rejected_circuit_open")
+    return JSONResponse(status_code=503,
+                        content={"error": "engine_fault", "message":exc.error_message, "retryable": True},
+                        headers={"Retry-After": str(exc.retry_after)}
+                        )
+
+@app.exception_handler(OverloadedException)
+async def overloaded_exception_handling(request: Request, exc: OverloadedException):
+    metrics.increment("requests_rejected_overloaded")
+    return JSONResponse(status_code=503,
+                        content={"error": "overloaded", "message":exc.error_message, "retryable": True},
+                        headers={"Retry-After": str(exc.retry_after)}
+                        )
       
-def read_results() -> List:
-    # # Read output line by line
-    # for line in process.stdout:
-    #     print(line.decode().strip())  # Decode bytes to string
-    with open('results.csv','r') as file:
-        data_dict = csv.DictReader(file,delimiter=';')
-        data_list = [row for row in data_dict]
-    
-    return data_list
+def score_bytes(data: bytes, config: str = settings.OFIQ_CONFIG,
+                tenant: str = settings.DEFAULT_TENANT, name: str = "upload") -> Tuple[List, ProcessUsage]:
+    return engine.score_one(data, config=config, tenant=tenant, name=name)
+
+async def read_upload(request: Request) -> bytes:
+    # The request body, refused with 413 as soon as it is known to be over
+    # OFIQ_MAX_UPLOAD_BYTES: from Content-Length up front, else while it arrives
+    limit = settings.OFIQ_MAX_UPLOAD_BYTES
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise HTTPException(status_code=413, detail="Image is too large")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail="Image is too large")
+    return bytes(body)
+
+def named_rows(rows: List, name: str) -> List:
+    # Results shared with other requests (collapsed runs, the near-duplicate
+    # cache) carry the name of the upload they were scored for
+    return [{**row, 'Filename': name} for row in rows]
+
+def score_image(image_path: str, config: str = settings.OFIQ_CONFIG,
+                tenant: str = settings.DEFAULT_TENANT,
+                aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage]:
+    # image_path may also be a directory, which is scored as one batch;
+    # `aliases` names the duplicates that were left out of it
+    return engine.score_image(image_path, config=config, tenant=tenant, aliases=aliases)
+
+def warmup_engine() -> None:
+    # Verify the engine, config and models exist, then score the bundled
+    # image once so the first real request doesn't pay the cold-start cost
+    engine_health.preflight_errors = engine.preflight()
+    if engine_health.preflight_errors:
+        engine_health.warmup_status = "failed"
+        engine_health.warmup_error = "preflight checks failed"
+        for error in engine_health.preflight_errors:
+            logging.critical(error)
+        return
+
+    engine_health.warmup_status = "running"
+    started = time.monotonic()
+    try:
+        prime_page_cache(engine.warmup_files())
+        pool.prestart()
+        if engine.warmup_image is not None:
+            pool.submit(score_image, engine.warmup_image, tenant="warmup").result()
+    except Exception as e:
+        engine_health.warmup_status = "failed"
+        engine_health.warmup_error = getattr(e, "error_message", None) or repr(e)
+        logging.critical("OFIQ warmup failed", extra={"error": engine_health.warmup_error})
+        return
+    engine_health.warmup_seconds = time.monotonic() - started
+    engine_health.warmup_status = "done"
+    logging.info("OFIQ engine ready", extra={"engine": engine.name, "warmup_seconds": engine_health.warmup_seconds})
+
+async def drain_engine() -> None:
+    # Stop taking new work, give queued and running jobs until the deadline
+    # to finish, then fail whatever hasn't started with a retryable 503 and
+    # stop the OFIQ children that are still running.
+    engine_health.shutting_down = True
+    pool.close()
+    logging.info("Draining OFIQ work", extra={"pool": pool.snapshot()})
+    if await asyncio.to_thread(pool.drain, settings.OFIQ_SHUTDOWN_DEADLINE):
+        return
+    pool.abort_pending()
+    killed = await asyncio.to_thread(terminate_children, settings.OFIQ_KILL_GRACE)
+    logging.warning("Shutdown deadline reached, abandoned outstanding OFIQ work",
+                    extra={"pool": pool.snapshot(), "children_killed": killed})
+
+drain_task: Optional[asyncio.Task] = None
+
+def start_drain() -> asyncio.Task:
+    # Runs drain_engine once, whether started by a signal or by the lifespan
+    global drain_task
+    if drain_task is None:
+        drain_task = asyncio.get_running_loop().create_task(drain_engine())
+    return drain_task
+
+def drain_on_signals() -> None:
+    # uvicorn runs the lifespan shutdown only after every connection has
+    # closed, and those connections are waiting on the OFIQ work being
+    # drained. So start the drain (and report not ready) as soon as
+    # SIGTERM/SIGINT arrive, then hand the signal on to uvicorn's handler,
+    # which stops accepting connections. Signal handlers can only be set
+    # from the main thread, which is where uvicorn runs the event loop.
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(signum)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(start_drain)
+            previous(signum, frame)
+
+        signal.signal(signum, handler)
     
 @app.get("/getresults")
-def getResults():
+async def getResults(request: Request):
+    tenant = request.headers.get(settings.TENANT_HEADER, settings.DEFAULT_TENANT)
     try:
-        analyze_images()
-        data = read_results()
+        data, usage = await pool.run(score_image, settings.OFIQ_TEST_IMAGE, tenant=tenant)
         return JSONResponse(status_code=200,
-                            content=data
+                            content=data,
+                            headers=usage_headers(usage)
                             )
     except SubProcessException as e:
         raise e #must reraise e to show error message
 
+@app.post("/score")
+async def scoreUpload(request: Request, near_duplicate: bool = False, max_distance: Optional[int] = None,
+                      priority: str = "normal", filename: str = "upload"):
+    # Body is the raw image; `filename` is returned as the rows' Filename.
+    # With near_duplicate=true a result for a near-identical image scored
+    # recently may be returned instead of running OFIQ (see nearduplicate.py);
+    # when the cache is off the response says so in X-OFIQ-Near-Duplicate.
+    # priority=high requests are hedged when they run slow (see hedging.py)
+    tenant = request.headers.get(settings.TENANT_HEADER, settings.DEFAULT_TENANT)
+    data = await read_upload(request)
+    if not data:
+        raise HTTPException(status_code=400, detail="Request body must contain an image")
+    if max_distance is None:
+        max_distance = settings.OFIQ_NEAR_DUP_MAX_DISTANCE
+    if not 0 <= max_distance <= 64:
+        raise HTTPException(status_code=400, detail="max_distance must be between 0 and 64")
+    if priority not in ("normal", "high"):
+        raise HTTPException(status_code=400, detail="priority must be normal or high")
+
+    phash, hit = None, None
+    if near_duplicate and near_duplicates.available:
+        try:
+            phash = await asyncio.to_thread(perceptual_hash, data)
+        except Exception:
+            pass  # not decodable here; leave it to OFIQ
+        else:
+            hit = near_duplicates.lookup(phash, settings.OFIQ_CONFIG, max_distance)
+            if hit is not None and not settings.OFIQ_NEAR_DUP_VALIDATE:
+                distance, cached = hit
+                return JSONResponse(status_code=200,
+                                    content=named_rows(cached.rows, filename),
+                                    headers={"X-OFIQ-Near-Duplicate-Distance": str(distance)}
+                                    )
+
+    key = f"{hashlib.sha256(data).hexdigest()}:{settings.OFIQ_CONFIG}"
+    hedge = settings.OFIQ_HEDGING and priority == "high"
+    rows, usage = await score_flights.run(key, lambda: hedger.run(hedge, score_bytes, data, tenant=tenant,
+                                                                  name=filename))
+    rows = named_rows(rows, filename)
+    if hit is not None:
+        near_duplicates.record_validation(hit[1].rows, rows)
+    if phash is not None:
+        near_duplicates.add(phash, settings.OFIQ_CONFIG, rows)
+    headers = usage_headers(usage)
+    if near_duplicate and not near_duplicates.available:
+        headers["X-OFIQ-Near-Duplicate"] = "unavailable"
+    return JSONResponse(status_code=200,
+                        content=rows,
+                        headers=headers
+                        )
+
+# OFIQ exited cleanly but wrote no row for an image
+NO_RESULT = SubProcessException(error_message="no result from OFIQ", kind="engine_fault")
+
+def score_chunk(chunk_dir: str, tenant: str,
+                aliases: Optional[Aliases] = None) -> Tuple[List, ProcessUsage, Failures]:
+    # Scores a staged batch directory. Returns the rows, the usage of all OFIQ
+    # runs it took and the images OFIQ failed on (staged name -> error).
+    try:
+        return engine.score_batch(chunk_dir, tenant=tenant, aliases=aliases)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def submit_chunk(chunk_dir: str, tenant: str, aliases: Optional[Aliases] = None) -> concurrent.futures.Future:
+    # A chunk the pool refuses fails on its own (see chunk_result) rather
+    # than failing the whole batch request
+    try:
+        return pool.submit(score_chunk, chunk_dir, tenant=tenant, aliases=aliases)
+    except OverloadedException as e:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        refused = concurrent.futures.Future()
+        refused.set_exception(e)
+        return refused
+
+async def chunk_result(future: concurrent.futures.Future) -> Tuple[List, Failures, SubProcessException]:
+    # Rows and failures of a scored chunk, and the error for its images that
+    # have neither. A chunk refused because the pool was full or the engine
+    # circuit was open has no rows, and all its images are "overloaded". A
+    # chunk that failed in some other way fails each of its images.
+    try:
+        rows, _, failures = await asyncio.wrap_future(future)
+    except OverloadedException as e:
+        metrics.increment("batch_chunks_overloaded")
+        return [], {}, SubProcessException(error_message=e.error_message, kind="overloaded")
+    except SubProcessException as e:
+        return [], {}, e
+    except Exception as e:
+        logging.exception("Scoring a batch chunk failed")
+        metrics.increment("batch_chunks_failed")
+        return [], {}, SubProcessException(error_message=f"Scoring failed: {e!r}", kind="engine_fault")
+    return rows, failures, NO_RESULT
+
+@app.post("/batch/archive")
+async def scoreArchive(request: Request):
+    # Body is a zip or tar (optionally compressed) archive. Members are staged
+    # into chunks and scored while the rest of the upload is still arriving.
+    tenant = request.headers.get(settings.TENANT_HEADER, settings.DEFAULT_TENANT)
+    stream = ChunkStream(settings.OFIQ_ARCHIVE_QUEUE_CHUNKS)
+    batch = ArchiveBatch(lambda chunk_dir, aliases: submit_chunk(chunk_dir, tenant=tenant, aliases=aliases))
+    parser = asyncio.create_task(asyncio.to_thread(batch.run, stream))
+    try:
+        async for chunk in request.stream():
+            if parser.done():
+                break
+            if chunk and not stream.feed(chunk, block=False):
+                await asyncio.to_thread(stream.feed, chunk)
+        await asyncio.to_thread(stream.finish)
+        await parser
+
+        results, errors = {}, {}
+        for future, members in batch.chunks:
+            rows, failures, missing = await chunk_result(future)
+            for row in rows:
+                member = members.get(os.path.basename(row['Filename']), row['Filename'])
+                results[member] = {**row, 'Filename': member}
+            errors.update({member: error_content(failures.get(name, missing))
+                           for name, member in members.items() if member not in results})
+        return JSONResponse(status_code=200,
+                            content={"results": results, "errors": errors, "skipped": batch.skipped}
+                            )
+    finally:
+        stream.abandoned = True
+        # The parser stops at its next read once the upload is abandoned; its
+        # error was raised above already, or is moot if the upload failed
+        await asyncio.wait({parser})
+        if not parser.cancelled():
+            parser.exception()
+        # Chunks already handed to the pool still own files under the staging dir
+        await asyncio.to_thread(concurrent.futures.wait, [future for future, _ in batch.chunks])
+        batch.cleanup()
+
+@app.post("/batch/directory")
+async def scoreDirectory(request: Request, path: str, include_unchanged: bool = False):
+    # Scores a server-side directory tree, sending only images that are new
+    # or changed since the last scan to OFIQ
+    tenant = request.headers.get(settings.TENANT_HEADER, settings.DEFAULT_TENANT)
+    root = os.path.realpath(path)
+    if not any(root == allowed or root.startswith(allowed + os.sep) for allowed in settings.OFIQ_SCAN_ROOTS):
+        raise HTTPException(status_code=403, detail="Directory is outside the allowed scan roots")
+    if not os.path.isdir(root):
+        raise HTTPException(status_code=404, detail="Directory not found")
+
+    file_index, result_store = request.app.state.file_index, request.app.state.result_store
+    scan = DirectoryScan(root, file_index,
+                         lambda chunk_dir, aliases: submit_chunk(chunk_dir, tenant=tenant, aliases=aliases))
+    try:
+        await asyncio.to_thread(scan.run)
+
+        results, entries = {}, []
+        errors = {path: error_content(error) for path, error in scan.errors.items()}
+        for future, staged in scan.chunks:
+            rows, failures, missing = await chunk_result(future)
+            rows = {os.path.basename(row['Filename']): row for row in rows}
+            for staged_name, entry in staged.items():
+                row = rows.get(staged_name)
+                if row is None:
+                    error = failures.get(staged_name, missing)
+                    errors[entry.path] = error_content(error)
+                    if error.kind in PERMANENT_KINDS:
+                        # Others are not indexed, so the next scan tries again
+                        entries.append(entry._replace(status="failed", error=error.error_message))
+                else:
+                    results[entry.path] = {**row, 'Filename': entry.path}
+                    entries.append(entry)
+        await asyncio.to_thread(result_store.put_many, settings.OFIQ_CONFIG, results.items())
+        await asyncio.to_thread(file_index.mark_many, entries)
+        counts = {**scan.counts, "scored": len(results), "failed": len(errors)}
+
+        if include_unchanged:
+            for unchanged in scan.unchanged:
+                row = result_store.get(unchanged, settings.OFIQ_CONFIG)
+                if row is not None:
+                    results[unchanged] = row
+        return JSONResponse(status_code=200,
+                            content={"counts": counts,
+                                     "results": results, "errors": errors}
+                            )
+    finally:
+        await asyncio.to_thread(concurrent.futures.wait, [future for future, _ in scan.chunks])
+
+@app.get("/metrics")
+def getMetrics():
+    return JSONResponse(status_code=200,
+                        content={**metrics.snapshot(), "near_duplicates": near_duplicates.snapshot(),
+                                 "pool": autoscaler.snapshot(), "concurrency": concurrency_limiter.snapshot(),
+                                 "hedging": hedger.snapshot()}
+                        )
+
+@app.get("/healthz")
+def getLiveness():
+    alive, status = engine_health.liveness(pool)
+    return JSONResponse(status_code=200 if alive else 503,
+                        content=status
+                        )
+
+@app.get("/readyz")
+def getReadiness():
+    ready, status = engine_health.readiness(pool)
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={**status, "engine": engine.health(),
+                                 "cpu": cpu_summary(settings.OFIQ_THREADS_PER_WORKER)}
+                        )
+
 # Below is to facilitate code testing locally
 if __name__=="__main__":
+    from engines import analyze_images, read_results
     analyze_images()
     data = read_results()
     print(data)
@@ -0,0 +1,71 @@
+import threading
+from typing import Dict, Tuple
+
+import settings
+from ofiqprocess import ProcessUsage
+
+# Tenants past settings.METRICS_MAX_TENANTS are aggregated under this name
+OTHER_TENANTS = "other"
+
+
+class UsageAggregate:
+    def __init__(self) -> None:
+        self.runs = 0
+        self.wall_time = 0.0
+        self.user_time = 0.0
+        self.sys_time = 0.0
+        self.max_rss_kb = 0
+
+    def add(self, usage: ProcessUsage) -> None:
+        self.runs += 1
+        self.wall_time += usage.wall_time
+        self.user_time += usage.user_time
+        self.sys_time += usage.sys_time
+        self.max_rss_kb = max(self.max_rss_kb, usage.max_rss_kb)
+
+    def as_dict(self) -> dict:
+        runs = self.runs or 1
+        return {
+            "runs": self.runs,
+            "wall_time_total": self.wall_time,
+            "user_time_total": self.user_time,
+            "sys_time_total": self.sys_time,
+            "wall_time_avg": self.wall_time / runs,
+            "cpu_time_avg": (self.user_time + self.sys_time) / runs,
+            "max_rss_kb_peak": self.max_rss_kb,
+        }
+
+
+class Metrics:
+    # Process-wide counters and OFIQ resource usage, aggregated per config and
+    # per tenant (the first METRICS_MAX_TENANTS seen, the rest as "other").
+    # Everything is kept in memory and exposed through /metrics.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._usage: Dict[Tuple[str, str], UsageAggregate] = {}
+        self._counters: Dict[str, int] = {}
+        self._tenants = 0
+
+    def record_usage(self, usage: ProcessUsage, config: str, tenant: str) -> None:
+        with self._lock:
+            if ("tenant", tenant) not in self._usage:
+                if self._tenants >= settings.METRICS_MAX_TENANTS:
+                    tenant = OTHER_TENANTS
+                elif tenant != OTHER_TENANTS:
+                    self._tenants += 1
+            for key in (("config", config), ("tenant", tenant)):
+                self._usage.setdefault(key, UsageAggregate()).add(usage)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            usage: Dict[str, Dict[str, dict]] = {"config": {}, "tenant": {}}
+            for (kind, name), aggregate in self._usage.items():
+                usage[kind][name] = aggregate.as_dict()
+            return {"counters": dict(self._counters), "ofiq_usage": usage}
+
+
+metrics = Metrics()
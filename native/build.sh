@@ -0,0 +1,18 @@
+#!/bin/sh
+# Builds libofiq_capi.so (the C shim ofiqlib.py loads) against an OFIQ
+# install tree and places it next to the OFIQ library.
+#
+#   OFIQ_INSTALL    OFIQ install dir (default: OFIQ-Project/install_x86_64_linux/Release)
+#   OPENCV_CFLAGS / OPENCV_LIBS   OpenCV flags if pkg-config doesn't know opencv4
+set -e
+cd "$(dirname "$0")/.."
+OFIQ_INSTALL=${OFIQ_INSTALL:-OFIQ-Project/install_x86_64_linux/Release}
+OPENCV_CFLAGS=${OPENCV_CFLAGS:-$(pkg-config --cflags opencv4)}
+OPENCV_LIBS=${OPENCV_LIBS:-$(pkg-config --libs opencv4)}
+
+${CXX:-g++} -std=c++17 -O2 -shared -fPIC native/ofiq_capi.cpp \
+    -I"$OFIQ_INSTALL/include" $OPENCV_CFLAGS \
+    -L"$OFIQ_INSTALL/lib" -lofiq_lib $OPENCV_LIBS \
+    -Wl,-rpath,'$ORIGIN' \
+    -o "$OFIQ_INSTALL/lib/libofiq_capi.so"
+echo "Built $OFIQ_INSTALL/lib/libofiq_capi.so"
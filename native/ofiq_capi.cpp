@@ -0,0 +1,214 @@
+// C entry points around the OFIQ C++ interface, so the service can load the
+// engine in-process through ctypes (see ofiqlib.py) instead of spawning
+// OFIQSampleApp for every request. Images are passed as encoded bytes
+// (decoded here with OpenCV, which OFIQ already links) or as raw RGB pixels.
+// Build with native/build.sh.
+
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <exception>
+#include <memory>
+#include <string>
+
+#include <opencv2/imgcodecs.hpp>
+#include <opencv2/imgproc.hpp>
+
+#include <ofiq_lib.h>
+
+extern "C" {
+
+// One quality measure of an assessment
+typedef struct {
+    int measure;        // OFIQ::QualityMeasure value
+    char name[64];      // same name as the OFIQSampleApp CSV column
+    double raw_score;
+    double scalar;
+    int code;           // OFIQ::QualityMeasureReturnCode value
+} ofiq_capi_measure;
+
+// Return codes of ofiq_capi_assess_*; the Python side maps them onto the
+// service's error kinds
+enum {
+    OFIQ_CAPI_OK = 0,
+    OFIQ_CAPI_INPUT_ERROR = 1,
+    OFIQ_CAPI_NO_FACE = 2,
+    OFIQ_CAPI_ENGINE_FAULT = 3,
+    OFIQ_CAPI_BUFFER_TOO_SMALL = 4,
+};
+
+}
+
+namespace {
+
+struct Handle {
+    std::shared_ptr<OFIQ::Interface> engine;
+};
+
+struct MeasureName {
+    OFIQ::QualityMeasure measure;
+    const char* name;
+};
+
+const MeasureName kMeasureNames[] = {
+    {OFIQ::QualityMeasure::UnifiedQualityScore, "UnifiedQualityScore"},
+    {OFIQ::QualityMeasure::BackgroundUniformity, "BackgroundUniformity"},
+    {OFIQ::QualityMeasure::IlluminationUniformity, "IlluminationUniformity"},
+    {OFIQ::QualityMeasure::LuminanceMean, "LuminanceMean"},
+    {OFIQ::QualityMeasure::LuminanceVariance, "LuminanceVariance"},
+    {OFIQ::QualityMeasure::UnderExposurePrevention, "UnderExposurePrevention"},
+    {OFIQ::QualityMeasure::OverExposurePrevention, "OverExposurePrevention"},
+    {OFIQ::QualityMeasure::DynamicRange, "DynamicRange"},
+    {OFIQ::QualityMeasure::Sharpness, "Sharpness"},
+    {OFIQ::QualityMeasure::CompressionArtifacts, "CompressionArtifacts"},
+    {OFIQ::QualityMeasure::NaturalColour, "NaturalColour"},
+    {OFIQ::QualityMeasure::SingleFacePresent, "SingleFacePresent"},
+    {OFIQ::QualityMeasure::EyesOpen, "EyesOpen"},
+    {OFIQ::QualityMeasure::MouthClosed, "MouthClosed"},
+    {OFIQ::QualityMeasure::EyesVisible, "EyesVisible"},
+    {OFIQ::QualityMeasure::MouthOcclusionPrevention, "MouthOcclusionPrevention"},
+    {OFIQ::QualityMeasure::FaceOcclusionPrevention, "FaceOcclusionPrevention"},
+    {OFIQ::QualityMeasure::InterEyeDistance, "InterEyeDistance"},
+    {OFIQ::QualityMeasure::HeadSize, "HeadSize"},
+    {OFIQ::QualityMeasure::LeftwardCropOfTheFaceImage, "LeftwardCropOfTheFaceImage"},
+    {OFIQ::QualityMeasure::RightwardCropOfTheFaceImage, "RightwardCropOfTheFaceImage"},
+    {OFIQ::QualityMeasure::MarginAboveOfTheFaceImage, "MarginAboveOfTheFaceImage"},
+    {OFIQ::QualityMeasure::MarginBelowOfTheFaceImage, "MarginBelowOfTheFaceImage"},
+    {OFIQ::QualityMeasure::HeadPoseYaw, "HeadPoseYaw"},
+    {OFIQ::QualityMeasure::HeadPosePitch, "HeadPosePitch"},
+    {OFIQ::QualityMeasure::HeadPoseRoll, "HeadPoseRoll"},
+    {OFIQ::QualityMeasure::ExpressionNeutrality, "ExpressionNeutrality"},
+    {OFIQ::QualityMeasure::NoHeadCoverings, "NoHeadCoverings"},
+};
+
+void set_error(char* error, size_t error_size, const std::string& message) {
+    if (error == nullptr || error_size == 0) {
+        return;
+    }
+    std::strncpy(error, message.c_str(), error_size - 1);
+    error[error_size - 1] = '\0';
+}
+
+void set_name(ofiq_capi_measure& out, OFIQ::QualityMeasure measure) {
+    for (const auto& entry : kMeasureNames) {
+        if (entry.measure == measure) {
+            std::strncpy(out.name, entry.name, sizeof(out.name) - 1);
+            return;
+        }
+    }
+    std::snprintf(out.name, sizeof(out.name), "Measure%d", static_cast<int>(measure));
+}
+
+int status_code(const OFIQ::ReturnStatus& status) {
+    switch (status.code) {
+        case OFIQ::ReturnCode::Success:
+            return OFIQ_CAPI_OK;
+        case OFIQ::ReturnCode::ImageReadingError:
+            return OFIQ_CAPI_INPUT_ERROR;
+        case OFIQ::ReturnCode::FaceDetectionError:
+            return OFIQ_CAPI_NO_FACE;
+        default:
+            return OFIQ_CAPI_ENGINE_FAULT;
+    }
+}
+
+int assess(Handle* handle, const OFIQ::Image& image, ofiq_capi_measure* measures, size_t capacity,
+           size_t* count, char* error, size_t error_size) {
+    OFIQ::FaceImageQualityAssessment assessment;
+    OFIQ::ReturnStatus status = handle->engine->vectorQuality(image, assessment);
+    int code = status_code(status);
+    if (code != OFIQ_CAPI_OK) {
+        set_error(error, error_size, status.info);
+        return code;
+    }
+    *count = assessment.qAssessments.size();
+    if (*count > capacity) {
+        set_error(error, error_size, "measure buffer too small");
+        return OFIQ_CAPI_BUFFER_TOO_SMALL;
+    }
+    size_t index = 0;
+    for (const auto& [measure, result] : assessment.qAssessments) {
+        ofiq_capi_measure& out = measures[index++];
+        std::memset(&out, 0, sizeof(out));
+        out.measure = static_cast<int>(measure);
+        set_name(out, measure);
+        out.raw_score = result.rawScore;
+        out.scalar = result.scalar;
+        out.code = static_cast<int>(result.code);
+    }
+    return OFIQ_CAPI_OK;
+}
+
+OFIQ::Image rgb_image(const uint8_t* pixels, uint16_t width, uint16_t height) {
+    size_t size = static_cast<size_t>(width) * height * 3;
+    std::shared_ptr<uint8_t> data(new uint8_t[size], std::default_delete<uint8_t[]>());
+    std::memcpy(data.get(), pixels, size);
+    return OFIQ::Image(width, height, 24, data);
+}
+
+}  // namespace
+
+extern "C" {
+
+// Loads the models named in config_file (relative to config_dir). Returns
+// NULL and fills `error` on failure. A handle must only be used by one
+// thread at a time.
+void* ofiq_capi_create(const char* config_dir, const char* config_file, char* error, size_t error_size) {
+    try {
+        auto handle = std::make_unique<Handle>();
+        handle->engine = OFIQ::Interface::getImplementation();
+        OFIQ::ReturnStatus status = handle->engine->initialize(config_dir, config_file);
+        if (status.code != OFIQ::ReturnCode::Success) {
+            set_error(error, error_size, status.info);
+            return nullptr;
+        }
+        return handle.release();
+    } catch (const std::exception& e) {
+        set_error(error, error_size, e.what());
+        return nullptr;
+    }
+}
+
+void ofiq_capi_destroy(void* handle) {
+    delete static_cast<Handle*>(handle);
+}
+
+void ofiq_capi_version(int* major, int* minor, int* patch) {
+    OFIQ::Interface::getImplementation()->getVersion(*major, *minor, *patch);
+}
+
+// Assesses an encoded image (PNG, JPEG, ...) held in memory
+int ofiq_capi_assess_encoded(void* handle, const uint8_t* data, size_t size, ofiq_capi_measure* measures,
+                             size_t capacity, size_t* count, char* error, size_t error_size) {
+    try {
+        // Wraps the caller's buffer, no copy
+        cv::Mat buffer(1, static_cast<int>(size), CV_8UC1, const_cast<uint8_t*>(data));
+        cv::Mat decoded = cv::imdecode(buffer, cv::IMREAD_COLOR);
+        if (decoded.empty() || decoded.cols > UINT16_MAX || decoded.rows > UINT16_MAX) {
+            set_error(error, error_size, "could not decode image");
+            return OFIQ_CAPI_INPUT_ERROR;
+        }
+        cv::Mat rgb;
+        cv::cvtColor(decoded, rgb, cv::COLOR_BGR2RGB);
+        OFIQ::Image image = rgb_image(rgb.data, static_cast<uint16_t>(rgb.cols), static_cast<uint16_t>(rgb.rows));
+        return assess(static_cast<Handle*>(handle), image, measures, capacity, count, error, error_size);
+    } catch (const std::exception& e) {
+        set_error(error, error_size, e.what());
+        return OFIQ_CAPI_ENGINE_FAULT;
+    }
+}
+
+// Assesses an already decoded image: width * height * 3 bytes of RGB
+int ofiq_capi_assess_rgb(void* handle, const uint8_t* pixels, uint16_t width, uint16_t height,
+                         ofiq_capi_measure* measures, size_t capacity, size_t* count, char* error,
+                         size_t error_size) {
+    try {
+        OFIQ::Image image = rgb_image(pixels, width, height);
+        return assess(static_cast<Handle*>(handle), image, measures, capacity, count, error, error_size);
+    } catch (const std::exception& e) {
+        set_error(error, error_size, e.what());
+        return OFIQ_CAPI_ENGINE_FAULT;
+    }
+}
+
+}
@@ -0,0 +1,172 @@
+import io
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import settings
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it the cache stays off
+    Image = None
+
+
+def perceptual_hash(data: bytes) -> int:
+    # 64-bit difference hash: the image is shrunk to 9x8 grey pixels and
+    # every bit says whether a pixel is brighter than its right neighbour.
+    # Re-encoding, resaving or stripping metadata leaves it (nearly) unchanged.
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (64, 64))  # let the JPEG decoder downscale for us
+        pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left, right = pixels[row * 9 + column], pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    # Metric tree over Hamming distance. A lookup only descends into children
+    # whose edge distance is within max_distance of the query's distance to
+    # the node, so it touches a small part of the tree for small thresholds.
+    def __init__(self) -> None:
+        self._root: Optional[Tuple[int, Dict[int, tuple]]] = None
+        self.size = 0
+
+    def add(self, value: int) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = (value, {})
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> Iterator[Tuple[int, int]]:
+        # Yields (distance, stored value) for everything within max_distance
+        candidates = [self._root] if self._root is not None else []
+        while candidates:
+            node_value, children = candidates.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                yield distance, node_value
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    candidates.append(child)
+
+
+class CachedResult(NamedTuple):
+    phash: int
+    config: str
+    rows: List[dict]
+    scored_at: float
+
+
+class NearDuplicateCache:
+    # Recently scored images keyed by perceptual hash, so a re-capture that
+    # only differs by encoding or metadata can reuse the earlier result.
+    # Entries expire after OFIQ_NEAR_DUP_TTL seconds and the oldest are
+    # evicted beyond OFIQ_NEAR_DUP_CACHE_SIZE. Evicted hashes stay in the
+    # BK-tree (it has no delete) and are skipped on lookup; the tree is
+    # rebuilt once it holds twice as many hashes as the cache.
+    #
+    # In validation mode a hit is still scored by OFIQ and the difference
+    # between the cached and the fresh scores is recorded, to pick a
+    # threshold before serving cached results for real.
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, int], CachedResult]" = OrderedDict()
+        self._tree = BKTree()
+        self.hits = 0
+        self.misses = 0
+        self._deltas: Dict[str, List[float]] = {}  # column -> [count, sum, max] of |cached - fresh|
+        self._hit_distances: Dict[int, int] = {}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None and self._max_entries > 0
+
+    def lookup(self, phash: int, config: str, max_distance: int) -> Optional[Tuple[int, CachedResult]]:
+        # Nearest live entry within max_distance, as (distance, entry)
+        with self._lock:
+            self._expire()
+            best = None
+            for distance, value in self._tree.search(phash, max_distance):
+                entry = self._entries.get((config, value))
+                if entry is not None and (best is None or distance < best[0]):
+                    best = (distance, entry)
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._hit_distances[best[0]] = self._hit_distances.get(best[0], 0) + 1
+            return best
+
+    def add(self, phash: int, config: str, rows: List[dict]) -> None:
+        with self._lock:
+            key = (config, phash)
+            self._entries.pop(key, None)
+            self._entries[key] = CachedResult(phash, config, rows, time.monotonic())
+            self._tree.add(phash)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._expire()
+
+    def _expire(self) -> None:
+        horizon = time.monotonic() - self._ttl
+        while self._entries and next(iter(self._entries.values())).scored_at < horizon:
+            self._entries.popitem(last=False)
+        if self._tree.size > 2 * max(len(self._entries), 64):
+            self._tree = BKTree()
+            for _, value in self._entries:
+                self._tree.add(value)
+
+    def record_validation(self, cached: List[dict], fresh: List[dict]) -> None:
+        # Compares the numeric columns of the cached and the fresh first row
+        if not cached or not fresh:
+            return
+        with self._lock:
+            for column, value in fresh[0].items():
+                try:
+                    delta = abs(float(cached[0][column]) - float(value))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                stats = self._deltas.setdefault(column, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += delta
+                stats[2] = max(stats[2], delta)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "available": self.available,
+                "validate": settings.OFIQ_NEAR_DUP_VALIDATE,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "hit_distances": {str(distance): count for distance, count in sorted(self._hit_distances.items())},
+                "score_deltas": {
+                    column: {"compared": count, "mean_abs": total / count, "max_abs": largest}
+                    for column, (count, total, largest) in self._deltas.items()
+                },
+            }
+
+
+near_duplicates = NearDuplicateCache(settings.OFIQ_NEAR_DUP_CACHE_SIZE, settings.OFIQ_NEAR_DUP_TTL)
@@ -0,0 +1,106 @@
+import ctypes
+import os
+import threading
+from typing import Tuple
+
+from customexceptions import SubProcessException
+
+# Upper bound on the quality measures in one assessment (OFIQ has fewer than 30)
+MAX_MEASURES = 64
+_ERROR_BYTES = 1024
+
+# ofiq_capi_assess_* return codes -> error kinds (see ofiqprocess.classify_failure)
+_ERROR_KINDS = {1: "input_error", 2: "no_face", 3: "engine_fault", 4: "engine_fault"}
+
+
+class _Measure(ctypes.Structure):
+    # ofiq_capi_measure in native/ofiq_capi.cpp
+    _fields_ = [
+        ("measure", ctypes.c_int),
+        ("name", ctypes.c_char * 64),
+        ("raw_score", ctypes.c_double),
+        ("scalar", ctypes.c_double),
+        ("code", ctypes.c_int),
+    ]
+
+
+def _bind(library: ctypes.CDLL) -> None:
+    library.ofiq_capi_create.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t]
+    library.ofiq_capi_create.restype = ctypes.c_void_p
+    library.ofiq_capi_destroy.argtypes = [ctypes.c_void_p]
+    library.ofiq_capi_destroy.restype = None
+    library.ofiq_capi_version.argtypes = [ctypes.POINTER(ctypes.c_int)] * 3
+    library.ofiq_capi_version.restype = None
+    library.ofiq_capi_assess_encoded.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(_Measure), ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_size_t), ctypes.c_char_p, ctypes.c_size_t,
+    ]
+    library.ofiq_capi_assess_encoded.restype = ctypes.c_int
+    library.ofiq_capi_assess_rgb.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint16, ctypes.c_uint16, ctypes.POINTER(_Measure), ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_size_t), ctypes.c_char_p, ctypes.c_size_t,
+    ]
+    library.ofiq_capi_assess_rgb.restype = ctypes.c_int
+
+
+class OFIQLibrary:
+    # OFIQ loaded into this process through the C shim in native/ofiq_capi.cpp
+    # (libofiq_capi.so, built with native/build.sh). Images go to the engine
+    # as bytes in memory and come back as a row in the same layout as
+    # OFIQSampleApp's CSV, with float values. The models are loaded once in
+    # the constructor. An instance serialises its own calls; use one instance
+    # per thread for parallelism, ctypes releases the GIL during the call.
+    # Errors are raised as SubProcessException with the usual error kinds, so
+    # callers handle them like a failed OFIQ run.
+    def __init__(self, library_path: str, config_path: str) -> None:
+        try:
+            self._library = ctypes.CDLL(os.path.abspath(library_path))
+        except OSError as e:
+            raise SubProcessException(error_message=f"Could not load the OFIQ library: {e}", kind="engine_fault")
+        _bind(self._library)
+        config_dir, config_file = os.path.split(os.path.abspath(config_path))
+        error = ctypes.create_string_buffer(_ERROR_BYTES)
+        self._handle = self._library.ofiq_capi_create(config_dir.encode(), config_file.encode(), error, len(error))
+        if not self._handle:
+            raise SubProcessException(error_message=f"Could not initialise OFIQ: {error.value.decode(errors='replace')}",
+                                      kind="engine_fault")
+        self._lock = threading.Lock()
+
+    def assess(self, data: bytes, filename: str = "") -> dict:
+        # `data` is an encoded image (PNG, JPEG, ...), decoded by the shim
+        return self._call(filename, self._library.ofiq_capi_assess_encoded, data, len(data))
+
+    def assess_rgb(self, pixels: bytes, width: int, height: int, filename: str = "") -> dict:
+        # `pixels` is a decoded image, width * height * 3 bytes of RGB
+        if len(pixels) != width * height * 3:
+            raise SubProcessException(error_message="RGB buffer doesn't match the image size", kind="input_error")
+        return self._call(filename, self._library.ofiq_capi_assess_rgb, pixels, width, height)
+
+    def _call(self, filename: str, function, *args) -> dict:
+        measures = (_Measure * MAX_MEASURES)()
+        count = ctypes.c_size_t()
+        error = ctypes.create_string_buffer(_ERROR_BYTES)
+        with self._lock:
+            if not self._handle:
+                raise SubProcessException(error_message="OFIQ library has been closed", kind="engine_fault")
+            code = function(self._handle, *args, measures, MAX_MEASURES, ctypes.byref(count), error, len(error))
+        if code != 0:
+            raise SubProcessException(error_message=error.value.decode(errors="replace"),
+                                      kind=_ERROR_KINDS.get(code, "engine_fault"))
+        row = {"Filename": filename}
+        for measure in measures[:count.value]:
+            name = measure.name.decode()
+            row[name] = measure.raw_score
+            row[f"{name}.scalar"] = measure.scalar
+        return row
+
+    def version(self) -> Tuple[int, int, int]:
+        parts = [ctypes.c_int() for _ in range(3)]
+        self._library.ofiq_capi_version(*(ctypes.byref(part) for part in parts))
+        return tuple(part.value for part in parts)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._handle:
+                self._library.ofiq_capi_destroy(self._handle)
+                self._handle = None
@@ -0,0 +1,307 @@
+import contextvars
+import functools
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, asdict, field
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Set
+
+import settings
+from cpuresources import pin
+
+# OFIQ's own log output is forwarded here at the level parsed from each line
+engine_logger = logging.getLogger("ofiq.engine")
+
+# OFIQ children that have not been reaped yet, for terminate_children
+_children: Set[subprocess.Popen] = set()
+_children_lock = threading.Lock()
+
+
+@dataclass
+class ProcessUsage:
+    wall_time: float  # seconds
+    user_time: float  # CPU seconds in user mode
+    sys_time: float  # CPU seconds in kernel mode
+    max_rss_kb: int  # peak resident set size, kilobytes
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.sys_time
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    def __add__(self, other: "ProcessUsage") -> "ProcessUsage":
+        # Totals of several runs; the peak RSS is the highest of them
+        return ProcessUsage(self.wall_time + other.wall_time, self.user_time + other.user_time,
+                            self.sys_time + other.sys_time, max(self.max_rss_kb, other.max_rss_kb))
+
+
+@dataclass
+class ProcessResult:
+    returncode: int
+    stdout: str  # last lines only, see StreamCapture
+    stderr: str
+    usage: ProcessUsage
+    events: List[dict] = field(default_factory=list)
+    timed_out: bool = False
+    cancelled: bool = False
+
+
+class CancelScope:
+    # OFIQ work a caller may abandon (see hedging.py). Runs started while a
+    # scope is current in cancel_scope register how to stop their process;
+    # cancel() stops them and any that register afterwards.
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._stops: List[Callable[[], None]] = []
+
+    def add(self, stop: Callable[[], None]) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._stops.append(stop)
+                return
+        stop()
+
+    def remove(self, stop: Callable[[], None]) -> None:
+        with self._lock:
+            if stop in self._stops:
+                self._stops.remove(stop)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            stops, self._stops = self._stops, []
+        for stop in stops:
+            stop()
+
+
+cancel_scope: contextvars.ContextVar[Optional[CancelScope]] = contextvars.ContextVar("cancel_scope", default=None)
+
+
+_LEVEL_PATTERN = re.compile(r"^\s*\[?(trace|debug|info|warn|warning|error|critical|fatal)\]?[:\s]\s*(.*)$", re.IGNORECASE)
+_LEVELS = {
+    "trace": logging.DEBUG,
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warn": logging.WARNING,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+    "fatal": logging.CRITICAL,
+}
+
+# Known OFIQ log lines that are worth keeping as structured events.
+# (event name, pattern, level override or None to keep the parsed level)
+_KNOWN_LINES = [
+    ("progress", re.compile(r"processing image (?P<index>\d+)\s*/\s*(?P<total>\d+):?\s*(?P<path>.*)", re.IGNORECASE), logging.DEBUG),
+    ("config", re.compile(r"reading configuration from (?:file:?\s*)?(?P<path>.+)", re.IGNORECASE), logging.DEBUG),
+    ("no_face", re.compile(r"no face (?:was )?(?:detected|found)(?: in)?(?: image)?:?\s*(?P<path>\S+)?", re.IGNORECASE), None),
+    ("image_read_error", re.compile(r"(?:could not|cannot|can't|failed to|unable to) (?:read|load|open|decode) (?:the )?image:?\s*(?P<path>\S+)?", re.IGNORECASE), None),
+    ("model_error", re.compile(r"(?:could not|cannot|can't|failed to|unable to) (?:read|load|open) .*?(?P<path>\S+\.(?:onnx|caffemodel|pb|dat|xml|txt))", re.IGNORECASE), None),
+]
+
+
+def classify_failure(result: ProcessResult) -> str:
+    # Kind of a failed run, from how it ended and what OFIQ logged:
+    # "no_face" and "input_error" are about the image and won't change on a
+    # retry; "timeout" and "engine_fault" (crash, kill, missing model,
+    # anything unrecognised) are about the engine; "cancelled" runs were
+    # stopped because nobody needed their result any more
+    if result.cancelled:
+        return "cancelled"
+    if result.timed_out:
+        return "timeout"
+    events = {event["event"] for event in result.events}
+    if result.returncode < 0 or "model_error" in events:
+        return "engine_fault"
+    if "no_face" in events:
+        return "no_face"
+    if "image_read_error" in events:
+        return "input_error"
+    return "engine_fault"
+
+
+def parse_line(line: str):
+    # Returns (level or None, message, event dict or None) for one OFIQ log line
+    level = None
+    message = line
+    match = _LEVEL_PATTERN.match(line)
+    if match:
+        level = _LEVELS[match.group(1).lower()]
+        message = match.group(2)
+    for name, pattern, override in _KNOWN_LINES:
+        found = pattern.search(message)
+        if found:
+            event = {"event": name, **{k: v for k, v in found.groupdict().items() if v}}
+            return (override if override is not None else level), message, event
+    return level, message, None
+
+
+class StreamCapture:
+    # Keeps only the last `max_lines` lines of a child's output stream and a
+    # bounded list of parsed events, forwarding each line to engine_logger as
+    # it arrives instead of buffering the whole stream in memory.
+    def __init__(self, name: str, default_level: int, max_lines: int, max_events: int) -> None:
+        self.name = name
+        self.default_level = default_level
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.events: Deque[dict] = deque(maxlen=max_events)
+        self.total_lines = 0
+
+    def feed(self, line: str) -> None:
+        self.total_lines += 1
+        self.lines.append(line)
+        level, message, event = parse_line(line)
+        if event is not None:
+            event["stream"] = self.name
+            self.events.append(event)
+        level = self.default_level if level is None else level
+        if engine_logger.isEnabledFor(level):
+            engine_logger.log(level, message, extra={"ofiq_stream": self.name, "ofiq_event": event, "sample": level < logging.WARNING})
+
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+
+def drain_stream(stream, capture: StreamCapture, max_line_bytes: int) -> None:
+    # readline with a limit so a single runaway line can't grow unbounded;
+    # the remainder of an over-long line is discarded.
+    truncated = False
+    for chunk in iter(lambda: stream.readline(max_line_bytes), b""):
+        complete = chunk.endswith(b"\n")
+        if not truncated:
+            capture.feed(chunk.decode("utf-8", errors="replace").rstrip("\r\n"))
+        truncated = not complete
+    stream.close()
+
+
+def run_process(command: List[str], cwd: Optional[str] = None, pass_fds: Sequence[int] = (),
+                timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None,
+                cpus: Optional[List[int]] = None) -> ProcessResult:
+    # subprocess.run reaps the child with waitpid and throws away its rusage,
+    # so spawn with Popen and reap it ourselves with wait4. A child still
+    # running after `timeout` seconds is killed (timed_out in the result).
+    # With `cpus` the child is pinned to those CPUs. A child still running
+    # when the current CancelScope is cancelled is killed (cancelled in the
+    # result).
+    started = time.monotonic()
+    # Own session, so a Ctrl-C or SIGTERM aimed at the server's process group
+    # doesn't kill children mid-run; shutdown decides when to stop them.
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=True, pass_fds=pass_fds, env=env)
+    pin(process.pid, cpus)
+    with _children_lock:
+        _children.add(process)
+
+    captures = [
+        StreamCapture("stdout", logging.DEBUG, settings.OFIQ_LOG_TAIL_LINES, settings.OFIQ_LOG_MAX_EVENTS),
+        StreamCapture("stderr", logging.INFO, settings.OFIQ_LOG_TAIL_LINES, settings.OFIQ_LOG_MAX_EVENTS),
+    ]
+    # Reader threads run in a copy of the caller's context so forwarded lines
+    # keep the request id
+    readers = [
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(drain_stream, stream, capture, settings.OFIQ_LOG_LINE_BYTES),
+            daemon=True,
+        )
+        for stream, capture in zip((process.stdout, process.stderr), captures)
+    ]
+    for reader in readers:
+        reader.start()
+    timer, timed_out = None, threading.Event()
+    if timeout:
+        timer = threading.Timer(timeout, _kill_flagged, args=(process, timed_out))
+        timer.daemon = True
+        timer.start()
+    scope, cancelled = cancel_scope.get(), threading.Event()
+    stop = functools.partial(_kill_flagged, process, cancelled)
+    if scope is not None:
+        scope.add(stop)
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    if timer is not None:
+        timer.cancel()
+    if scope is not None:
+        scope.remove(stop)
+    wall_time = time.monotonic() - started
+    with _children_lock:
+        # Let Popen know the child is gone so it does not try to reap it again
+        process.returncode = os.waitstatus_to_exitcode(status)
+        _children.discard(process)
+    for reader in readers:
+        reader.join()
+
+    usage = ProcessUsage(
+        wall_time=wall_time,
+        user_time=rusage.ru_utime,
+        sys_time=rusage.ru_stime,
+        max_rss_kb=rusage.ru_maxrss,
+    )
+    stdout, stderr = captures
+    return ProcessResult(
+        process.returncode,
+        stdout.text(),
+        stderr.text(),
+        usage,
+        events=list(stdout.events) + list(stderr.events),
+        timed_out=timed_out.is_set(),
+        cancelled=cancelled.is_set(),
+    )
+
+
+def _kill_flagged(process: subprocess.Popen, flag: threading.Event) -> None:
+    # Kills the child and sets `flag` to say why, unless it already exited
+    with _children_lock:
+        if process.returncode is None:  # not reaped yet, so the pid is still ours
+            flag.set()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def track_child(process: subprocess.Popen) -> None:
+    # Long-lived children (persistent workers) are stopped by
+    # terminate_children like the one-shot runs; they must be started with
+    # start_new_session=True and untracked once reaped
+    with _children_lock:
+        _children.add(process)
+
+
+def untrack_child(process: subprocess.Popen) -> None:
+    with _children_lock:
+        _children.discard(process)
+
+
+def _signal_children(signum: int) -> int:
+    with _children_lock:
+        for process in _children:
+            if process.returncode is None:
+                try:
+                    os.killpg(process.pid, signum)
+                except ProcessLookupError:
+                    pass
+        return len(_children)
+
+
+def terminate_children(grace: float) -> int:
+    # SIGTERM every running OFIQ child, then SIGKILL whatever is left after
+    # `grace` seconds. The worker threads blocked in wait4 reap them.
+    # Returns the number of children that had to be killed.
+    if not _signal_children(signal.SIGTERM):
+        return 0
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        with _children_lock:
+            if not _children:
+                return 0
+        time.sleep(0.05)
+    return _signal_children(signal.SIGKILL)
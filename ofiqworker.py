@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import resource
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import settings
+from cpuresources import pin
+from customexceptions import SubProcessException
+from ofiqlib import OFIQLibrary
+from ofiqprocess import ProcessUsage, StreamCapture, drain_stream, track_child, untrack_child
+
+_PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+# Protocol between WorkerProcess and the child (this file run as a script).
+# The child writes one JSON line when the models are loaded ({"ready": true}
+# or an error), then answers every request with one JSON line. A request is
+# a JSON line {"filename": ..., "size": n} followed by n bytes of image.
+# Answers are {"row": {...}} or {"error": kind, "message": ...}, both with
+# the CPU time the assessment took and the child's peak RSS under "usage".
+
+
+class WorkerProcess:
+    # Parent side: a child process that keeps OFIQ and its models loaded and
+    # scores one image at a time. Not thread-safe; each worker thread has its
+    # own. A child that dies or doesn't answer within the timeout is killed
+    # and the worker is no longer `alive`. `env` and `cpus` are the child's
+    # environment and the CPUs it is pinned to, as for run_process.
+    def __init__(self, library_path: str, config_path: str, env: Optional[Dict[str, str]] = None,
+                 cpus: Optional[List[int]] = None) -> None:
+        self.config = config_path
+        self.cpus = cpus
+        self.started_at = time.monotonic()
+        self.images = 0
+        self.peak_rss_kb = 0
+        self._buffer = b""
+        self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__), library_path, config_path],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         start_new_session=True, env=env)
+        pin(self._process.pid, cpus)
+        track_child(self._process)
+        # OFIQ's log output is forwarded like a one-shot run's
+        self._stderr = StreamCapture("stderr", logging.INFO, settings.OFIQ_LOG_TAIL_LINES, settings.OFIQ_LOG_MAX_EVENTS)
+        threading.Thread(target=drain_stream, args=(self._process.stderr, self._stderr, settings.OFIQ_LOG_LINE_BYTES),
+                         name="ofiq-worker-stderr", daemon=True).start()
+        reply = self._reply(settings.OFIQ_RUN_TIMEOUT or None)
+        if "error" in reply:
+            self.close()
+            raise SubProcessException(error_message=reply["message"], kind=reply["error"])
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    @property
+    def alive(self) -> bool:
+        return self._process.returncode is None and self._process.poll() is None
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def rss_kb(self) -> int:
+        # Current RSS from /proc where there is one, else the peak the child reported
+        try:
+            with open(f"/proc/{self.pid}/statm") as statm:
+                return int(statm.read().split()[1]) * _PAGE_KB
+        except (OSError, ValueError, IndexError):
+            return self.peak_rss_kb
+
+    def assess(self, data: bytes, filename: str, timeout: Optional[float]) -> Tuple[dict, ProcessUsage]:
+        started = time.monotonic()
+        try:
+            self._process.stdin.write(json.dumps({"filename": filename, "size": len(data)}).encode() + b"\n")
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except (OSError, ValueError):
+            self._kill()
+            raise SubProcessException(error_message=f"OFIQ worker is gone: {self._stderr.text()}", kind="engine_fault")
+        reply = self._reply(timeout)
+        self.images += 1
+        usage = ProcessUsage(wall_time=time.monotonic() - started, **reply["usage"])
+        self.peak_rss_kb = usage.max_rss_kb
+        if "error" in reply:
+            raise SubProcessException(error_message=reply["message"], kind=reply["error"])
+        return reply["row"], usage
+
+    def _reply(self, timeout: Optional[float]) -> dict:
+        deadline = time.monotonic() + timeout if timeout else None
+        stdout = self._process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                self._kill()
+                raise SubProcessException(error_message=f"OFIQ worker did not answer within {timeout:g}s", kind="timeout")
+            readable, _, _ = select.select([stdout], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(stdout, 1 << 16)
+            if not chunk:
+                returncode = self._kill()
+                raise SubProcessException(error_message=f"OFIQ worker exited ({returncode}): {self._stderr.text()}",
+                                          kind="engine_fault")
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def _kill(self) -> int:
+        if self._process.poll() is None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        returncode = self._process.wait()
+        untrack_child(self._process)
+        return returncode
+
+    def close(self, grace: float = 5.0) -> None:
+        # EOF on stdin makes the child exit once it is done with the current image
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._process.wait(grace)
+        except subprocess.TimeoutExpired:
+            pass
+        self._kill()
+
+    def as_dict(self) -> dict:
+        return {"pid": self.pid, "config": self.config, "images": self.images,
+                "age_seconds": self.age, "rss_kb": self.rss_kb, "cpus": self.cpus}
+
+
+def serve(library_path: str, config_path: str) -> int:
+    # Child side. fd 1 becomes the protocol channel and anything OFIQ prints
+    # to stdout is sent to stderr instead, so it can't corrupt the replies.
+    protocol = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    def send(reply: dict) -> None:
+        protocol.write(json.dumps(reply).encode() + b"\n")
+        protocol.flush()
+
+    try:
+        library = OFIQLibrary(library_path, config_path)
+    except SubProcessException as e:
+        send({"error": e.kind, "message": e.error_message})
+        return 1
+    send({"ready": True})
+
+    stdin = sys.stdin.buffer
+    for line in stdin:
+        request = json.loads(line)
+        data = stdin.read(request["size"])
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            reply = {"row": library.assess(data, request["filename"])}
+        except SubProcessException as e:
+            reply = {"error": e.kind, "message": e.error_message}
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        reply["usage"] = {"user_time": after.ru_utime - before.ru_utime, "sys_time": after.ru_stime - before.ru_stime,
+                          "max_rss_kb": after.ru_maxrss}
+        send(reply)
+    library.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(serve(sys.argv[1], sys.argv[2]))
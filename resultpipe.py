@@ -0,0 +1,86 @@
+import csv
+import os
+import select
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional
+
+import settings
+
+
+class ResultPipe:
+    # A FIFO handed to OFIQ as its output file. A reader thread parses CSV
+    # rows as OFIQ writes them, so there is no results.csv to write and read
+    # back and parsing overlaps with scoring. `on_row` is called for every
+    # row as soon as it has been parsed.
+    #
+    # The FIFO is opened read-write on our side: it never reports EOF while
+    # OFIQ opens and closes it, and opening can't block if OFIQ dies before
+    # opening it. The reader stops once finish() says the process has exited
+    # and the pipe has been drained.
+    def __init__(self, on_row: Optional[Callable[[Dict[str, str]], None]] = None) -> None:
+        directory = settings.OFIQ_TMPFS_DIR if os.path.isdir(settings.OFIQ_TMPFS_DIR) else settings.OFIQ_WORK_DIR
+        self._dir = tempfile.mkdtemp(prefix="ofiq-pipe-", dir=directory)
+        self.path = os.path.join(self._dir, "results.csv")
+        os.mkfifo(self.path, 0o600)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        self._on_row = on_row
+        # Written to by finish() to wake the reader once OFIQ has exited
+        self._wake_read, self._wake_write = os.pipe()
+        self._finished = False
+        self._header: Optional[List[str]] = None
+        self.rows: List[Dict[str, str]] = []
+        self._reader = threading.Thread(target=self._read, name="ofiq-result-pipe", daemon=True)
+        self._reader.start()
+
+    def _read(self) -> None:
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        poller.register(self._wake_read, select.POLLIN)
+        buffer = b""
+        while True:
+            ready = {fd for fd, _ in poller.poll()}
+            if self._fd in ready:
+                chunk = os.read(self._fd, 1 << 16)
+                lines = (buffer + chunk).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    self._parse(line)
+            elif self._wake_read in ready:
+                break  # OFIQ is gone and the pipe is drained
+        if buffer:
+            self._parse(buffer)
+
+    def _parse(self, line: bytes) -> None:
+        text = line.decode("utf-8", errors="replace").rstrip("\r")
+        if not text:
+            return
+        values = next(csv.reader([text], delimiter=';'))
+        if self._header is None:
+            self._header = values
+            return
+        row = dict(zip(self._header, values))
+        self.rows.append(row)
+        if self._on_row is not None:
+            self._on_row(row)
+
+    def finish(self) -> List[Dict[str, str]]:
+        # Call once the OFIQ process has been reaped
+        if not self._finished:
+            self._finished = True
+            os.write(self._wake_write, b"x")
+            self._reader.join()
+        return self.rows
+
+    def close(self) -> None:
+        self.finish()
+        for fd in (self._fd, self._wake_read, self._wake_write):
+            os.close(fd)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self) -> "ResultPipe":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
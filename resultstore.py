@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+
+class StateDatabase:
+    # Small SQLite wrapper shared by the file index and the result store.
+    # One connection guarded by a lock; WAL keeps readers off the writer.
+    def __init__(self, path: str) -> None:
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.Lock()
+
+    def execute(self, sql: str, parameters: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql: str, rows: Iterable[tuple]) -> None:
+        with self.lock:
+            with self._connection:
+                self._connection.executemany(sql, rows)
+
+    def close(self) -> None:
+        with self.lock:
+            self._connection.close()
+
+
+class ResultStore:
+    # Latest OFIQ row per (image path, config)
+    def __init__(self, database: StateDatabase) -> None:
+        self._db = database
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " path TEXT NOT NULL, config TEXT NOT NULL, row TEXT NOT NULL, scored_at REAL NOT NULL,"
+            " PRIMARY KEY (path, config))"
+        )
+
+    def put_many(self, config: str, rows: Iterable[Tuple[str, dict]]) -> None:
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO results (path, config, row, scored_at) VALUES (?, ?, ?, ?)",
+            ((path, config, json.dumps(row), now) for path, row in rows),
+        )
+
+    def get(self, path: str, config: str) -> Optional[dict]:
+        found = self._db.execute("SELECT row FROM results WHERE path = ? AND config = ?", (path, config))
+        return json.loads(found[0][0]) if found else None
+
+
+class IndexEntry(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    status: str  # scored | failed
+    error: Optional[str] = None
+    sha256: Optional[str] = None  # only filled in by directory scans
+
+
+class FileIndex:
+    # Which files under a watched/scanned tree have been scored, and in which
+    # version (size + mtime, plus content hash when known), so restarts and
+    # re-scans skip them.
+    def __init__(self, database: StateDatabase) -> None:
+        self._db = database
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+            " status TEXT NOT NULL, error TEXT, updated_at REAL NOT NULL, sha256 TEXT)"
+        )
+        # Indexes created before content hashes were recorded
+        columns = [column[1] for column in self._db.execute("PRAGMA table_info(files)")]
+        if "sha256" not in columns:
+            self._db.execute("ALTER TABLE files ADD COLUMN sha256 TEXT")
+
+    def is_current(self, path: str, size: int, mtime_ns: int) -> bool:
+        found = self._db.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (path,))
+        return bool(found) and found[0] == (size, mtime_ns)
+
+    def lookup(self, path: str) -> Optional[IndexEntry]:
+        found = self._db.execute(
+            "SELECT path, size, mtime_ns, status, error, sha256 FROM files WHERE path = ?", (path,))
+        return IndexEntry(*found[0]) if found else None
+
+    def mark_many(self, entries: Iterable[IndexEntry]) -> None:
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, status, error, sha256, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((*entry, now) for entry in entries),
+        )
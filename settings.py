@@ -0,0 +1,209 @@
+import os
+
+import cpuresources
+
+# Paths to the OFIQ engine. Override through environment variables when the
+# OFIQ-Project tree lives somewhere else.
+OFIQ_BINARY = os.environ.get("OFIQ_BINARY", "./OFIQ-Project/install_x86_64_linux/Release/bin/OFIQSampleApp")
+OFIQ_CONFIG = os.environ.get("OFIQ_CONFIG", "OFIQ-Project/data/ofiq_config.jaxn")
+OFIQ_TEST_IMAGE = os.environ.get("OFIQ_TEST_IMAGE", "OFIQ-Project/data/tests/images/b-01-smile.png")
+
+# How OFIQ is run (see engines.py): "subprocess" (OFIQSampleApp per job),
+# "library" (the OFIQ library loaded in-process through native/ofiq_capi.cpp),
+# "worker" (the library in persistent child processes) or "stub" (no OFIQ,
+# synthetic scores after OFIQ_STUB_DELAY seconds, for tests and benchmarks)
+OFIQ_ENGINE = os.environ.get("OFIQ_ENGINE", "subprocess")
+OFIQ_LIBRARY = os.environ.get("OFIQ_LIBRARY", "./OFIQ-Project/install_x86_64_linux/Release/lib/libofiq_capi.so")
+OFIQ_STUB_DELAY = float(os.environ.get("OFIQ_STUB_DELAY", "0"))
+# Persistent workers (OFIQ_ENGINE=worker) are replaced after scoring
+# OFIQ_WORKER_MAX_IMAGES images, once their RSS exceeds OFIQ_WORKER_MAX_RSS_MB
+# or after OFIQ_WORKER_MAX_AGE seconds; 0 disables a limit. The replacement
+# loads its models while the old worker keeps scoring.
+OFIQ_WORKER_MAX_IMAGES = int(os.environ.get("OFIQ_WORKER_MAX_IMAGES", "10000"))
+OFIQ_WORKER_MAX_RSS_MB = int(os.environ.get("OFIQ_WORKER_MAX_RSS_MB", "0"))
+OFIQ_WORKER_MAX_AGE = float(os.environ.get("OFIQ_WORKER_MAX_AGE", "86400"))
+
+# Header used to attribute requests to a tenant for accounting
+TENANT_HEADER = os.environ.get("TENANT_HEADER", "X-Tenant-ID")
+DEFAULT_TENANT = os.environ.get("DEFAULT_TENANT", "default")
+# Usage is broken down for at most this many tenants in /metrics; the
+# header is client-supplied, so later tenants are counted as "other"
+METRICS_MAX_TENANTS = int(os.environ.get("METRICS_MAX_TENANTS", "100"))
+
+# Bounds on how much of OFIQ's stdout/stderr is kept per run. Only the last
+# OFIQ_LOG_TAIL_LINES lines of each stream are retained for error reporting.
+OFIQ_LOG_TAIL_LINES = int(os.environ.get("OFIQ_LOG_TAIL_LINES", "200"))
+OFIQ_LOG_LINE_BYTES = int(os.environ.get("OFIQ_LOG_LINE_BYTES", "4096"))
+OFIQ_LOG_MAX_EVENTS = int(os.environ.get("OFIQ_LOG_MAX_EVENTS", "100"))
+
+# Logging pipeline. Records flagged as high-volume success logs are kept with
+# probability LOG_SUCCESS_SAMPLE_RATE; warnings and errors are always kept.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_SUCCESS_SAMPLE_RATE = float(os.environ.get("LOG_SUCCESS_SAMPLE_RATE", "0.1"))
+REQUEST_ID_HEADER = os.environ.get("REQUEST_ID_HEADER", "X-Request-ID")
+
+# CPUs to plan for: the affinity mask, capped by the container's cgroup quota
+OFIQ_CPUS = int(os.environ.get("OFIQ_CPUS", str(cpuresources.available_cpus())))
+# Inference threads per OFIQ run, passed to each OFIQ child through
+# OMP_NUM_THREADS and friends (see cpuresources.py); by default workers
+# times threads fills OFIQ_CPUS. threadsweep.py measures the best split.
+OFIQ_THREADS_PER_WORKER = int(os.environ.get("OFIQ_THREADS_PER_WORKER", str(min(2, OFIQ_CPUS))))
+# Number of OFIQ runs allowed at the same time
+OFIQ_WORKERS = int(os.environ.get("OFIQ_WORKERS", str(max(1, OFIQ_CPUS // OFIQ_THREADS_PER_WORKER))))
+# Pin every worker to its own block of OFIQ_THREADS_PER_WORKER CPUs
+OFIQ_PIN_WORKERS = os.environ.get("OFIQ_PIN_WORKERS", "0") not in ("0", "false", "no")
+# The pool is autoscaled between these bounds (see autoscaler.py); both
+# default to OFIQ_WORKERS, a fixed pool, and OFIQ_WORKERS is the start size
+OFIQ_MIN_WORKERS = int(os.environ.get("OFIQ_MIN_WORKERS", str(OFIQ_WORKERS)))
+OFIQ_MAX_WORKERS = int(os.environ.get("OFIQ_MAX_WORKERS", str(OFIQ_WORKERS)))
+OFIQ_AUTOSCALE_INTERVAL = float(os.environ.get("OFIQ_AUTOSCALE_INTERVAL", "5"))
+# Wait times of the jobs started in this many seconds are considered
+OFIQ_AUTOSCALE_WINDOW = float(os.environ.get("OFIQ_AUTOSCALE_WINDOW", "60"))
+OFIQ_AUTOSCALE_UP_QUEUE = float(os.environ.get("OFIQ_AUTOSCALE_UP_QUEUE", "2"))
+OFIQ_AUTOSCALE_UP_WAIT = float(os.environ.get("OFIQ_AUTOSCALE_UP_WAIT", "2"))
+OFIQ_AUTOSCALE_UP_CHECKS = int(os.environ.get("OFIQ_AUTOSCALE_UP_CHECKS", "2"))
+OFIQ_AUTOSCALE_DOWN_SECONDS = float(os.environ.get("OFIQ_AUTOSCALE_DOWN_SECONDS", "300"))
+OFIQ_AUTOSCALE_COOLDOWN = float(os.environ.get("OFIQ_AUTOSCALE_COOLDOWN", "30"))
+# The pool isn't grown while this share of the CPU capacity (quota) is in use
+OFIQ_AUTOSCALE_MAX_LOAD = float(os.environ.get("OFIQ_AUTOSCALE_MAX_LOAD", "0.9"))
+# Pool size changes kept for /metrics
+OFIQ_AUTOSCALE_HISTORY = int(os.environ.get("OFIQ_AUTOSCALE_HISTORY", "500"))
+# Adaptive concurrency (see concurrencylimit.py): how many OFIQ runs go at
+# once is adjusted between OFIQ_CONCURRENCY_MIN and the pool size from the
+# per-image latency. It shrinks once the average over about
+# OFIQ_CONCURRENCY_SHORT_WINDOW runs exceeds OFIQ_CONCURRENCY_TOLERANCE times
+# the average over OFIQ_CONCURRENCY_LONG_WINDOW runs, and grows otherwise;
+# OFIQ_CONCURRENCY_SMOOTHING is how much of each change is applied at once.
+OFIQ_ADAPTIVE_CONCURRENCY = os.environ.get("OFIQ_ADAPTIVE_CONCURRENCY", "0") not in ("0", "false", "no")
+OFIQ_CONCURRENCY_MIN = int(os.environ.get("OFIQ_CONCURRENCY_MIN", "1"))
+OFIQ_CONCURRENCY_TOLERANCE = float(os.environ.get("OFIQ_CONCURRENCY_TOLERANCE", "1.5"))
+OFIQ_CONCURRENCY_SMOOTHING = float(os.environ.get("OFIQ_CONCURRENCY_SMOOTHING", "0.2"))
+OFIQ_CONCURRENCY_SHORT_WINDOW = int(os.environ.get("OFIQ_CONCURRENCY_SHORT_WINDOW", "10"))
+OFIQ_CONCURRENCY_LONG_WINDOW = int(os.environ.get("OFIQ_CONCURRENCY_LONG_WINDOW", "500"))
+# Hedging of /score?priority=high (see hedging.py): a request still running
+# after the p95 of the last OFIQ_HEDGE_WINDOW /score latencies (at least
+# OFIQ_HEDGE_MIN_DELAY seconds, and not before OFIQ_HEDGE_MIN_SAMPLES are
+# known) gets a duplicate run on an idle worker, the slower one is killed.
+# Only subprocess runs can be killed: with the library, worker and stub
+# engines the slower run finishes unused, and a persistent worker stays busy
+# with it. Duplicates never take more than OFIQ_HEDGE_BUDGET of the pool's
+# concurrency, counted until both runs have stopped; with fewer than
+# 1 / OFIQ_HEDGE_BUDGET workers there are none.
+OFIQ_HEDGING = os.environ.get("OFIQ_HEDGING", "1") not in ("0", "false", "no")
+OFIQ_HEDGE_BUDGET = float(os.environ.get("OFIQ_HEDGE_BUDGET", "0.1"))
+OFIQ_HEDGE_MIN_DELAY = float(os.environ.get("OFIQ_HEDGE_MIN_DELAY", "0.05"))
+OFIQ_HEDGE_MIN_SAMPLES = int(os.environ.get("OFIQ_HEDGE_MIN_SAMPLES", "20"))
+OFIQ_HEDGE_WINDOW = int(os.environ.get("OFIQ_HEDGE_WINDOW", "500"))
+# Scratch space for per-job output files; None means the system temp dir
+OFIQ_WORK_DIR = os.environ.get("OFIQ_WORK_DIR") or None
+# Image scored at startup before the service reports ready
+OFIQ_WARMUP_IMAGE = os.environ.get("OFIQ_WARMUP_IMAGE", OFIQ_TEST_IMAGE)
+
+# Jobs waiting for a worker beyond OFIQ_MAX_QUEUE are rejected with 503;
+# /readyz already reports not ready from OFIQ_READY_MAX_QUEUE so load
+# balancers stop routing to this instance before that happens.
+OFIQ_MAX_QUEUE = int(os.environ.get("OFIQ_MAX_QUEUE", "100"))
+OFIQ_READY_MAX_QUEUE = int(os.environ.get("OFIQ_READY_MAX_QUEUE", str(max(1, OFIQ_MAX_QUEUE * 3 // 4))))
+# Window over which the recent OFIQ failure rate is computed
+OFIQ_FAILURE_WINDOW_SECONDS = float(os.environ.get("OFIQ_FAILURE_WINDOW_SECONDS", "60"))
+# A worker busy with one job for longer than this is reported as stalled;
+# /healthz fails when every worker is stalled
+OFIQ_STALL_SECONDS = float(os.environ.get("OFIQ_STALL_SECONDS", "300"))
+
+# An OFIQ run is killed and reported as a timeout after OFIQ_RUN_TIMEOUT
+# seconds plus OFIQ_RUN_TIMEOUT_PER_IMAGE for every image in a batch run;
+# 0 disables the limit. A persistent worker gets OFIQ_RUN_TIMEOUT to load
+# its models and OFIQ_RUN_TIMEOUT_PER_IMAGE for each image.
+OFIQ_RUN_TIMEOUT = float(os.environ.get("OFIQ_RUN_TIMEOUT", "120"))
+OFIQ_RUN_TIMEOUT_PER_IMAGE = float(os.environ.get("OFIQ_RUN_TIMEOUT_PER_IMAGE", "10"))
+
+# Circuit breaker around OFIQ runs: it opens once OFIQ_BREAKER_FAILURE_RATE
+# of at least OFIQ_BREAKER_MIN_RUNS runs in the last
+# OFIQ_BREAKER_WINDOW_SECONDS failed with an engine fault (not a problem
+# with the image), refuses runs with 503 for OFIQ_BREAKER_OPEN_SECONDS and
+# then lets OFIQ_BREAKER_PROBES trial runs through to decide whether to close
+OFIQ_BREAKER_FAILURE_RATE = float(os.environ.get("OFIQ_BREAKER_FAILURE_RATE", "0.5"))
+OFIQ_BREAKER_MIN_RUNS = int(os.environ.get("OFIQ_BREAKER_MIN_RUNS", "5"))
+OFIQ_BREAKER_WINDOW_SECONDS = float(os.environ.get("OFIQ_BREAKER_WINDOW_SECONDS", "30"))
+OFIQ_BREAKER_OPEN_SECONDS = float(os.environ.get("OFIQ_BREAKER_OPEN_SECONDS", "30"))
+OFIQ_BREAKER_PROBES = int(os.environ.get("OFIQ_BREAKER_PROBES", "1"))
+
+# On shutdown, queued and running OFIQ jobs get this long to finish before
+# the remaining children are sent SIGTERM, and SIGKILL OFIQ_KILL_GRACE
+# seconds later. Keep the sum below the orchestrator's termination grace.
+# The drain starts when SIGTERM arrives; run uvicorn with
+# --timeout-graceful-shutdown set to the sum so a connection that outlives
+# the drain (a slow upload) can't hold up the exit either.
+OFIQ_SHUTDOWN_DEADLINE = float(os.environ.get("OFIQ_SHUTDOWN_DEADLINE", "20"))
+OFIQ_KILL_GRACE = float(os.environ.get("OFIQ_KILL_GRACE", "5"))
+
+# Files with these extensions are treated as images when scanning archives
+# and directories
+IMAGE_EXTENSIONS = tuple(os.environ.get("IMAGE_EXTENSIONS", ".png,.jpg,.jpeg,.bmp,.jp2,.tif,.tiff").split(","))
+
+# Archive uploads are staged into directories of OFIQ_ARCHIVE_CHUNK_SIZE
+# images, each scored as one OFIQ batch run as soon as it is complete.
+OFIQ_ARCHIVE_CHUNK_SIZE = int(os.environ.get("OFIQ_ARCHIVE_CHUNK_SIZE", "50"))
+# Staged chunks of one archive upload or directory scan that may wait for or
+# run on a worker at once; staging pauses until one is done, so a large
+# batch can't fill the disk or the pool queue. OFIQ_ARCHIVE_MAX_PENDING_CHUNKS
+# is the older name of the setting.
+OFIQ_MAX_PENDING_CHUNKS = int(os.environ.get("OFIQ_MAX_PENDING_CHUNKS")
+                              or os.environ.get("OFIQ_ARCHIVE_MAX_PENDING_CHUNKS") or str(OFIQ_WORKERS * 2))
+OFIQ_ARCHIVE_MAX_MEMBER_BYTES = int(os.environ.get("OFIQ_ARCHIVE_MAX_MEMBER_BYTES", str(50 * 1024 * 1024)))
+# Upload chunks buffered between the request and the archive parser
+OFIQ_ARCHIVE_QUEUE_CHUNKS = int(os.environ.get("OFIQ_ARCHIVE_QUEUE_CHUNKS", "64"))
+
+# SQLite file holding the file index and stored results
+OFIQ_STATE_DB = os.environ.get("OFIQ_STATE_DB", "ofiq-state.sqlite3")
+
+# Hot folder: images dropped into OFIQ_WATCH_DIR are scored and their
+# results written to OFIQ_WATCH_OUTPUT_DIR. Disabled when unset.
+OFIQ_WATCH_DIR = os.environ.get("OFIQ_WATCH_DIR") or None
+OFIQ_WATCH_OUTPUT_DIR = os.environ.get("OFIQ_WATCH_OUTPUT_DIR", "ofiq-results")
+OFIQ_WATCH_DEBOUNCE_MS = int(os.environ.get("OFIQ_WATCH_DEBOUNCE_MS", "1600"))
+# A file is only picked up once it has not been modified for this long
+OFIQ_WATCH_SETTLE_SECONDS = float(os.environ.get("OFIQ_WATCH_SETTLE_SECONDS", "2"))
+OFIQ_WATCH_BATCH_SIZE = int(os.environ.get("OFIQ_WATCH_BATCH_SIZE", "50"))
+OFIQ_WATCH_MAX_INFLIGHT_BATCHES = int(os.environ.get("OFIQ_WATCH_MAX_INFLIGHT_BATCHES", str(OFIQ_WORKERS)))
+# Upper bound on files tracked individually; beyond it the folder is rescanned
+OFIQ_WATCH_MAX_PENDING = int(os.environ.get("OFIQ_WATCH_MAX_PENDING", "10000"))
+# A file that failed for engine-side reasons (engine_fault, timeout,
+# cancelled, overloaded) is scored again up to this many times before it is
+# recorded as failed
+OFIQ_WATCH_MAX_RETRIES = int(os.environ.get("OFIQ_WATCH_MAX_RETRIES", "3"))
+
+# Directory scoring API: only trees under these roots (separated by the
+# OS path separator) may be scanned. Empty disables the endpoint.
+OFIQ_SCAN_ROOTS = [os.path.realpath(root) for root in os.environ.get("OFIQ_SCAN_ROOTS", "").split(os.pathsep) if root]
+OFIQ_SCAN_BATCH_SIZE = int(os.environ.get("OFIQ_SCAN_BATCH_SIZE", "50"))
+
+# How local files are placed into per-job input directories: hardlink,
+# symlink or copy. Links fall back to a copy when they can't be made (for
+# example a hard link across filesystems).
+OFIQ_STAGING_MODE = os.environ.get("OFIQ_STAGING_MODE", "hardlink")
+
+# Batch runs hash their inputs and stage files with identical content only
+# once; every duplicate gets a copy of the first one's result row
+OFIQ_BATCH_DEDUP = os.environ.get("OFIQ_BATCH_DEDUP", "1") not in ("0", "false", "no")
+
+# How uploaded images reach OFIQ: memfd (anonymous memory file), tmpfs
+# (a private directory under OFIQ_TMPFS_DIR) or disk (OFIQ_WORK_DIR)
+OFIQ_INPUT_TRANSPORT = os.environ.get("OFIQ_INPUT_TRANSPORT", "memfd")
+OFIQ_TMPFS_DIR = os.environ.get("OFIQ_TMPFS_DIR", "/dev/shm")
+OFIQ_MAX_UPLOAD_BYTES = int(os.environ.get("OFIQ_MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+
+# Where OFIQ writes its CSV: "file" (a results.csv read back after the run)
+# or "fifo" (a named pipe parsed while OFIQ is still scoring)
+OFIQ_OUTPUT_MODE = os.environ.get("OFIQ_OUTPUT_MODE", "file")
+
+# Near-duplicate cache for /score?near_duplicate=true: a re-capture whose
+# perceptual hash is within OFIQ_NEAR_DUP_MAX_DISTANCE bits (of 64) of an
+# image scored in the last OFIQ_NEAR_DUP_TTL seconds gets that result.
+# Needs Pillow. With OFIQ_NEAR_DUP_VALIDATE hits are still scored and the
+# score differences are reported under /metrics instead.
+OFIQ_NEAR_DUP_CACHE_SIZE = int(os.environ.get("OFIQ_NEAR_DUP_CACHE_SIZE", "10000"))
+OFIQ_NEAR_DUP_TTL = float(os.environ.get("OFIQ_NEAR_DUP_TTL", "3600"))
+OFIQ_NEAR_DUP_MAX_DISTANCE = int(os.environ.get("OFIQ_NEAR_DUP_MAX_DISTANCE", "4"))
+OFIQ_NEAR_DUP_VALIDATE = os.environ.get("OFIQ_NEAR_DUP_VALIDATE", "0") not in ("0", "false", "no")
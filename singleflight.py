@@ -0,0 +1,27 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from metrics import metrics
+
+
+class SingleFlight:
+    # Collapses concurrent calls with the same key onto one computation.
+    # The computation runs as its own task, so it keeps going for the other
+    # callers if the one that started it goes away (client disconnect).
+    # Everything runs on the event loop, so no locking is needed.
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            metrics.increment(f"{self._name}_collapsed")
+        return await asyncio.shield(task)
+
+    def __len__(self) -> int:
+        return len(self._inflight)
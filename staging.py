@@ -0,0 +1,87 @@
+import concurrent.futures
+import errno
+import hashlib
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional
+
+import settings
+from metrics import metrics
+
+# link() failures that mean "can't link here" rather than "source is gone"
+_LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def file_sha256(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def staged_name(number: int, source: str) -> str:
+    # Staged files are numbered so names from different source directories
+    # can't collide; the extension is kept because OFIQ looks at it
+    return f"{number:06d}{os.path.splitext(source)[1].lower()}"
+
+
+def wait_for_pending_chunks(chunks: Iterable[concurrent.futures.Future]) -> None:
+    # Blocks until fewer than OFIQ_MAX_PENDING_CHUNKS of the chunks already
+    # handed to the pool are still queued or running
+    pending = {future for future in chunks if not future.done()}
+    while len(pending) >= settings.OFIQ_MAX_PENDING_CHUNKS:
+        _, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+
+def stage_file(source: str, target: str) -> str:
+    # Places `source` at `target` for an OFIQ batch run without copying the
+    # bytes where possible: a hard link (same filesystem) or symlink,
+    # depending on OFIQ_STAGING_MODE, falling back to a copy only when the
+    # link can't be made. Keep OFIQ_WORK_DIR on the same filesystem as the
+    # image trees for hard links to apply. Returns the method used.
+    mode = settings.OFIQ_STAGING_MODE
+    if mode == "hardlink":
+        try:
+            os.link(source, target)
+            method = "hardlink"
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED:
+                raise
+            shutil.copyfile(source, target)
+            method = "copy"
+    elif mode == "symlink":
+        try:
+            os.symlink(os.path.abspath(source), target)
+            method = "symlink"
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED:
+                raise
+            shutil.copyfile(source, target)
+            method = "copy"
+    else:
+        shutil.copyfile(source, target)
+        method = "copy"
+    metrics.increment(f"staged_{method}")
+    return method
+
+
+class ChunkDuplicates:
+    # Content hashes of the files staged into one OFIQ batch run. A file with
+    # the same bytes as one already in the batch is not staged again; its
+    # staged name is recorded as an alias of the first one and the results
+    # are copied back to it (see read_results), so OFIQ scores it only once.
+    def __init__(self) -> None:
+        self._first: Dict[str, str] = {}  # sha256 -> staged name
+        self.aliases: Dict[str, List[str]] = {}  # staged name -> duplicate staged names
+
+    def original(self, sha256: str, name: str) -> Optional[str]:
+        # Returns the staged name holding the same content, or None if `name`
+        # is the first with this hash and has to be staged
+        first = self._first.setdefault(sha256, name)
+        if first == name:
+            return None
+        self.aliases.setdefault(first, []).append(name)
+        metrics.increment("batch_duplicates_skipped")
+        return first
+
+    def forget(self, sha256: str) -> None:
+        # For a first file that could not be staged after all
+        self._first.pop(sha256, None)
@@ -0,0 +1,86 @@
+// Stand-in for libofiq_capi.so (native/ofiq_capi.cpp) with the same entry
+// points and no OFIQ behind them, for the tests of ofiqlib.py. What an
+// assessment returns is picked by the image bytes:
+//   "RETURN <n>"  fails with return code n and the message "mock error <n>"
+//   anything else two measures, UnifiedQualityScore being the size % 100
+// assess_rgb scores the image width. Configs whose file name contains
+// "missing" fail to load. MOCK_DELAY_US delays every assessment.
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+typedef struct {
+    int measure;
+    char name[64];
+    double raw_score;
+    double scalar;
+    int code;
+} ofiq_capi_measure;
+
+static int destroyed = 0;
+
+// Handles destroyed so far, for checking close()
+int mock_ofiq_capi_destroyed(void) {
+    return destroyed;
+}
+
+void* ofiq_capi_create(const char* config_dir, const char* config_file, char* error, size_t error_size) {
+    if (strstr(config_file, "missing")) {
+        snprintf(error, error_size, "cannot read %s/%s", config_dir, config_file);
+        return NULL;
+    }
+    return malloc(1);
+}
+
+void ofiq_capi_destroy(void* handle) {
+    free(handle);
+    destroyed++;
+}
+
+void ofiq_capi_version(int* major, int* minor, int* patch) {
+    *major = 1;
+    *minor = 0;
+    *patch = 2;
+}
+
+static int fill(double score, ofiq_capi_measure* measures, size_t capacity, size_t* count, char* error,
+                size_t error_size) {
+    const char* delay = getenv("MOCK_DELAY_US");
+    if (delay) {
+        usleep(atoi(delay));
+    }
+    if (capacity < 2) {
+        snprintf(error, error_size, "measure buffer too small");
+        return 4;
+    }
+    memset(measures, 0, 2 * sizeof(ofiq_capi_measure));
+    strcpy(measures[0].name, "UnifiedQualityScore");
+    measures[0].raw_score = score;
+    measures[0].scalar = score;
+    strcpy(measures[1].name, "Sharpness");
+    measures[1].measure = 8;
+    measures[1].raw_score = 0.5;
+    measures[1].scalar = 50;
+    *count = 2;
+    return 0;
+}
+
+int ofiq_capi_assess_encoded(void* handle, const uint8_t* data, size_t size, ofiq_capi_measure* measures,
+                             size_t capacity, size_t* count, char* error, size_t error_size) {
+    if (size > 7 && memcmp(data, "RETURN ", 7) == 0) {
+        char code[16] = {0};
+        memcpy(code, data + 7, size - 7 < sizeof(code) - 1 ? size - 7 : sizeof(code) - 1);
+        snprintf(error, error_size, "mock error %d", atoi(code));
+        return atoi(code);
+    }
+    return fill((double)(size % 100), measures, capacity, count, error, error_size);
+}
+
+int ofiq_capi_assess_rgb(void* handle, const uint8_t* pixels, uint16_t width, uint16_t height,
+                         ofiq_capi_measure* measures, size_t capacity, size_t* count, char* error,
+                         size_t error_size) {
+    return fill((double)width, measures, capacity, count, error, error_size);
+}
@@ -0,0 +1,233 @@
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import Future
+
+import pytest
+
+import settings
+from archiveingest import ArchiveBatch, ChunkStream, iter_archive_members, iter_tar_members, iter_zip_members
+from customexceptions import ArchiveException
+
+# Image bytes containing a data descriptor signature, which a stored member
+# with a trailing descriptor must not mistake for its end
+IMAGE = b"\x89PNG\r\n\x1a\n" + b"PK\x07\x08" + bytes(range(256)) * 40
+OTHER_IMAGE = b"\xff\xd8\xff" + os.urandom(5000)
+
+
+class _Unseekable(io.RawIOBase):
+    # zipfile writes sizes into a trailing data descriptor when it can't seek back
+    def __init__(self, target: io.BytesIO) -> None:
+        super().__init__()
+        self._target = target
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return self._target.write(data)
+
+
+def make_zip(members, compression=zipfile.ZIP_DEFLATED, seekable=True, zip64=False) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer if seekable else _Unseekable(buffer), "w", compression=compression) as archive:
+        for name, data in members:
+            with archive.open(name, "w", force_zip64=zip64) as member:
+                member.write(data)
+    return buffer.getvalue()
+
+
+def make_tar(members, mode="w") -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def read_all(members):
+    return [(name, member.read()) for name, member in members]
+
+
+ZIP_VARIANTS = [
+    pytest.param(compression, seekable, zip64,
+                 id=f"{'stored' if compression == zipfile.ZIP_STORED else 'deflated'}"
+                    f"-{'seekable' if seekable else 'streamed'}{'-zip64' if zip64 else ''}")
+    for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+    for seekable in (True, False)
+    for zip64 in (False, True)
+]
+
+
+@pytest.mark.parametrize("compression, seekable, zip64", ZIP_VARIANTS)
+def test_zip_members_are_read_in_order(compression, seekable, zip64):
+    members = [("a/face.png", IMAGE), ("notes.txt", b"hello"), ("b/face.jpg", OTHER_IMAGE)]
+    data = make_zip(members, compression, seekable, zip64)
+    assert read_all(iter_zip_members(io.BytesIO(data))) == members
+
+
+@pytest.mark.parametrize("compression, seekable, zip64", ZIP_VARIANTS)
+def test_zip_members_left_unread_are_skipped(compression, seekable, zip64):
+    data = make_zip([("a.png", IMAGE), ("b.png", OTHER_IMAGE)], compression, seekable, zip64)
+    members = iter_zip_members(io.BytesIO(data))
+    name, _ = next(members)
+    assert name == "a.png"
+    assert read_all(members) == [("b.png", OTHER_IMAGE)]
+
+
+def test_zip_directory_entries_are_not_members():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.mkdir("faces")
+        archive.writestr("faces/a.png", IMAGE)
+    assert read_all(iter_zip_members(io.BytesIO(buffer.getvalue()))) == [("faces/a.png", IMAGE)]
+
+
+@pytest.mark.parametrize("compression, seekable, zip64", ZIP_VARIANTS)
+def test_truncated_zip_is_rejected(compression, seekable, zip64):
+    data = make_zip([("a.png", IMAGE), ("b.png", OTHER_IMAGE)], compression, seekable, zip64)
+    end_of_second = data.index(b"PK\x01\x02")  # start of the central directory
+    with pytest.raises(ArchiveException):
+        read_all(iter_zip_members(io.BytesIO(data[:end_of_second - 100])))
+
+
+def test_encrypted_zip_member_is_rejected():
+    data = bytearray(make_zip([("a.png", IMAGE)], zipfile.ZIP_STORED))
+    data[6] |= 0x1  # general purpose flags of the first local header
+    with pytest.raises(ArchiveException, match="Encrypted"):
+        read_all(iter_zip_members(io.BytesIO(bytes(data))))
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "w:bz2", "w:xz"])
+def test_tar_members_are_read_in_order(mode):
+    members = [("a/face.png", IMAGE), ("notes.txt", b"hello"), ("b/face.jpg", OTHER_IMAGE)]
+    assert read_all(iter_tar_members(io.BytesIO(make_tar(members, mode)))) == members
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_truncated_tar_is_rejected(mode):
+    data = make_tar([("a.png", IMAGE), ("b.png", OTHER_IMAGE)], mode)
+    with pytest.raises(ArchiveException):
+        read_all(iter_tar_members(io.BytesIO(data[:len(data) // 2])))
+
+
+def test_garbage_is_not_an_archive():
+    with pytest.raises(ArchiveException):
+        read_all(iter_archive_members(io.BufferedReader(io.BytesIO(b"not an archive" * 100))))
+
+
+@pytest.mark.parametrize("data", [make_zip([("a.png", IMAGE)]), make_tar([("a.png", IMAGE)], "w:gz")],
+                         ids=["zip", "tar.gz"])
+def test_archive_format_is_detected(data):
+    assert read_all(iter_archive_members(io.BufferedReader(io.BytesIO(data)))) == [("a.png", IMAGE)]
+
+
+class _Submitted:
+    # Stands in for the pool: records what every chunk held when it was handed over
+    def __init__(self) -> None:
+        self.chunks = []
+
+    def __call__(self, chunk_dir, aliases):
+        files = {name: open(os.path.join(chunk_dir, name), "rb").read() for name in os.listdir(chunk_dir)}
+        self.chunks.append((files, aliases))
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+def run_batch(data: bytes):
+    submitted = _Submitted()
+    batch = ArchiveBatch(submitted)
+    stream = ChunkStream(max_chunks=len(data) // 1000 + 2)
+    for offset in range(0, len(data), 1000):
+        stream.feed(data[offset:offset + 1000])
+    stream.finish()
+    try:
+        batch.run(stream)
+    finally:
+        batch.cleanup()
+    return batch, submitted
+
+
+@pytest.mark.parametrize("data", [make_zip([("a.png", IMAGE), ("readme.md", b"#"), ("b.PNG", OTHER_IMAGE),
+                                            ("c/model.onnx", b"x")], seekable=False),
+                                  make_tar([("a.png", IMAGE), ("readme.md", b"#"), ("b.PNG", OTHER_IMAGE),
+                                            ("c/model.onnx", b"x")], "w:gz")],
+                         ids=["zip", "tar.gz"])
+def test_batch_skips_members_that_are_not_images(data):
+    batch, submitted = run_batch(data)
+    assert batch.skipped == ["readme.md", "c/model.onnx"]
+    [(files, _)] = submitted.chunks
+    assert sorted(files.values()) == sorted([IMAGE, OTHER_IMAGE])
+    assert sorted(batch.chunks[0][1].values()) == ["a.png", "b.PNG"]
+
+
+def test_batch_stages_duplicate_content_once(monkeypatch):
+    monkeypatch.setattr(settings, "OFIQ_BATCH_DEDUP", True)
+    data = make_zip([("a.png", IMAGE), ("b.png", OTHER_IMAGE), ("copy/a.png", IMAGE), ("again.png", IMAGE)])
+    batch, submitted = run_batch(data)
+    [(files, aliases)] = submitted.chunks
+    members = batch.chunks[0][1]  # staged name -> member
+    original = next(name for name, member in members.items() if member == "a.png")
+    assert files == {original: IMAGE, next(name for name, member in members.items() if member == "b.png"): OTHER_IMAGE}
+    assert sorted(members[alias] for alias in aliases[original]) == ["again.png", "copy/a.png"]
+
+
+def test_batch_stages_duplicates_separately_without_dedup(monkeypatch):
+    monkeypatch.setattr(settings, "OFIQ_BATCH_DEDUP", False)
+    _, submitted = run_batch(make_zip([("a.png", IMAGE), ("copy/a.png", IMAGE)]))
+    [(files, aliases)] = submitted.chunks
+    assert list(files.values()) == [IMAGE, IMAGE]
+    assert not aliases
+
+
+def test_batch_splits_members_into_chunks(monkeypatch):
+    monkeypatch.setattr(settings, "OFIQ_ARCHIVE_CHUNK_SIZE", 2)
+    members = [(f"{number}.png", IMAGE + bytes([number])) for number in range(5)]
+    batch, submitted = run_batch(make_zip(members))
+    assert [len(files) for files, _ in submitted.chunks] == [2, 2, 1]
+    assert [member for _, staged in batch.chunks for member in staged.values()] == [name for name, _ in members]
+
+
+def test_batch_waits_for_pending_chunks(monkeypatch):
+    monkeypatch.setattr(settings, "OFIQ_ARCHIVE_CHUNK_SIZE", 1)
+    monkeypatch.setattr(settings, "OFIQ_MAX_PENDING_CHUNKS", 2)
+    futures = []
+
+    def submit(chunk_dir, aliases):
+        # Still pending when the next chunk is staged, done a little later
+        assert sum(not future.done() for future in futures) < 2
+        future = Future()
+        threading.Timer(0.05, future.set_result, (None,)).start()
+        futures.append(future)
+        return future
+
+    batch = ArchiveBatch(submit)
+    stream = ChunkStream(max_chunks=4)
+    stream.feed(make_zip([(f"{number}.png", IMAGE + bytes([number])) for number in range(6)]))
+    stream.finish()
+    try:
+        batch.run(stream)
+    finally:
+        batch.cleanup()
+    assert len(futures) == 6
+
+
+@pytest.mark.parametrize("data", [make_zip([("small.png", b"x"), ("big.png", IMAGE)], zipfile.ZIP_STORED),
+                                  make_zip([("small.png", b"x"), ("big.png", IMAGE)], seekable=False),
+                                  make_tar([("small.png", b"x"), ("big.png", IMAGE)])],
+                         ids=["zip-stored", "zip-deflated-streamed", "tar"])
+def test_batch_rejects_members_over_the_size_limit(monkeypatch, data):
+    monkeypatch.setattr(settings, "OFIQ_ARCHIVE_MAX_MEMBER_BYTES", len(IMAGE) - 1)
+    with pytest.raises(ArchiveException, match="too large: big.png"):
+        run_batch(data)
+
+
+def test_batch_rejects_a_truncated_archive():
+    data = make_zip([("a.png", IMAGE), ("b.png", OTHER_IMAGE)], zipfile.ZIP_STORED)
+    with pytest.raises(ArchiveException):
+        run_batch(data[:len(IMAGE) // 2])
@@ -0,0 +1,97 @@
+import ctypes
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from customexceptions import SubProcessException
+from ofiqlib import OFIQLibrary
+
+MOCK_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_ofiq_capi.c")
+
+
+@pytest.fixture(scope="session")
+def mock_library(tmp_path_factory) -> str:
+    compiler = shutil.which(os.environ.get("CC", "cc"))
+    if compiler is None:
+        pytest.skip("no C compiler to build the mock OFIQ library")
+    path = str(tmp_path_factory.mktemp("mocklib") / "libofiq_capi.so")
+    subprocess.run([compiler, "-shared", "-fPIC", "-O2", MOCK_SOURCE, "-o", path], check=True)
+    return path
+
+
+@pytest.fixture
+def library(mock_library):
+    library = OFIQLibrary(mock_library, "config/ofiq_config.jaxn")
+    yield library
+    library.close()
+
+
+def destroyed(mock_library: str) -> int:
+    return ctypes.CDLL(os.path.abspath(mock_library)).mock_ofiq_capi_destroyed()
+
+
+def test_assess_returns_a_row_like_the_csv(library):
+    row = library.assess(b"x" * 142, "face.png")
+    assert row == {"Filename": "face.png", "UnifiedQualityScore": 42.0, "UnifiedQualityScore.scalar": 42.0,
+                   "Sharpness": 0.5, "Sharpness.scalar": 50.0}
+
+
+def test_assess_rgb_passes_the_image_size(library):
+    row = library.assess_rgb(bytes(7 * 5 * 3), 7, 5, "frame")
+    assert row["Filename"] == "frame"
+    assert row["UnifiedQualityScore"] == 7.0
+
+
+def test_assess_rgb_rejects_a_buffer_of_the_wrong_size(library):
+    with pytest.raises(SubProcessException) as raised:
+        library.assess_rgb(bytes(10), 7, 5)
+    assert raised.value.kind == "input_error"
+
+
+@pytest.mark.parametrize("code, kind", [(1, "input_error"), (2, "no_face"), (3, "engine_fault"),
+                                        (4, "engine_fault"), (99, "engine_fault")])
+def test_return_codes_map_to_error_kinds(library, code, kind):
+    with pytest.raises(SubProcessException) as raised:
+        library.assess(f"RETURN {code}".encode())
+    assert (raised.value.kind, raised.value.error_message) == (kind, f"mock error {code}")
+
+
+def test_failed_assessment_leaves_the_library_usable(library):
+    with pytest.raises(SubProcessException):
+        library.assess(b"RETURN 2")
+    assert library.assess(b"x" * 7)["UnifiedQualityScore"] == 7.0
+
+
+def test_config_that_fails_to_load_is_an_engine_fault(mock_library):
+    with pytest.raises(SubProcessException) as raised:
+        OFIQLibrary(mock_library, "config/missing.jaxn")
+    assert raised.value.kind == "engine_fault"
+    assert "missing.jaxn" in raised.value.error_message
+
+
+def test_library_that_fails_to_load_is_an_engine_fault(tmp_path):
+    with pytest.raises(SubProcessException) as raised:
+        OFIQLibrary(str(tmp_path / "libofiq_capi.so"), "config/ofiq_config.jaxn")
+    assert raised.value.kind == "engine_fault"
+
+
+def test_version(library):
+    assert library.version() == (1, 0, 2)
+
+
+def test_close_destroys_the_handle_once(mock_library):
+    library = OFIQLibrary(mock_library, "config/ofiq_config.jaxn")
+    before = destroyed(mock_library)
+    library.close()
+    library.close()
+    assert destroyed(mock_library) == before + 1
+
+
+def test_assess_after_close_is_an_engine_fault(mock_library):
+    library = OFIQLibrary(mock_library, "config/ofiq_config.jaxn")
+    library.close()
+    with pytest.raises(SubProcessException) as raised:
+        library.assess(b"x")
+    assert raised.value.kind == "engine_fault"
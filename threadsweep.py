@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import time
+from typing import List, Tuple
+
+import settings
+from autoscaler import percentile
+from engines import create_engine
+from workerpool import WorkerPool
+
+# Benchmark sweep for OFIQ_WORKERS x OFIQ_THREADS_PER_WORKER: scores the
+# same images with every split of the available CPUs and reports throughput
+# and latency, so the best split for a host and OFIQ_ENGINE can be chosen.
+#
+#   python threadsweep.py IMAGE_DIR [--engine worker] [--rounds 2] [--pin]
+#
+# Runs OFIQ directly through the engines, without the HTTP server.
+
+
+def splits(cpus: int) -> List[Tuple[int, int]]:
+    # Every (workers, threads per worker) with workers * threads == cpus
+    pairs = {(cpus // threads, threads) for threads in range(1, cpus + 1) if cpus % threads == 0}
+    return sorted(pairs, key=lambda pair: pair[1])
+
+
+def run_split(engine_name: str, images: List[bytes], workers: int, threads: int, rounds: int) -> dict:
+    settings.OFIQ_THREADS_PER_WORKER = threads
+    engine = create_engine(engine_name)
+    pool = WorkerPool(workers, max_queue=len(images) * rounds + workers, on_retire=engine.release_slot)
+    try:
+        # One image per worker first, so model loading isn't measured
+        for future in [pool.submit(engine.score_one, images[0]) for _ in range(workers)]:
+            future.result()
+        latencies: List[float] = []
+
+        def timed(data: bytes) -> None:
+            started = time.monotonic()
+            engine.score_one(data)
+            latencies.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        futures = [pool.submit(timed, data) for _ in range(rounds) for data in images]
+        failed = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+        elapsed = time.monotonic() - started
+    finally:
+        pool.shutdown()
+        engine.close()
+    return {
+        "workers": workers,
+        "threads": threads,
+        "images_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "failed": failed,
+    }
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Find the best OFIQ worker x thread split for this host")
+    parser.add_argument("images", help="directory of sample images")
+    parser.add_argument("--engine", default=settings.OFIQ_ENGINE, help="OFIQ_ENGINE to benchmark")
+    parser.add_argument("--cpus", type=int, default=settings.OFIQ_CPUS, help="CPUs to split (default: OFIQ_CPUS)")
+    parser.add_argument("--rounds", type=int, default=2, help="passes over the images per split")
+    parser.add_argument("--pin", action="store_true", help="pin workers to CPUs (OFIQ_PIN_WORKERS)")
+    args = parser.parse_args(argv)
+
+    images = []
+    for name in sorted(os.listdir(args.images)):
+        path = os.path.join(args.images, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as file:
+                images.append(file.read())
+    if not images:
+        parser.error(f"no images in {args.images}")
+    settings.OFIQ_PIN_WORKERS = args.pin
+
+    print(f"{args.engine} engine, {args.cpus} CPUs, {len(images)} images x {args.rounds} rounds")
+    print(f"{'workers':>7} {'threads':>7} {'images/s':>9} {'p50 s':>7} {'p95 s':>7} {'failed':>6}")
+    results = []
+    for workers, threads in splits(args.cpus):
+        result = run_split(args.engine, images, workers, threads, args.rounds)
+        results.append(result)
+        print(f"{workers:>7} {threads:>7} {result['images_per_second']:>9.2f} {result['latency_p50']:>7.3f} "
+              f"{result['latency_p95']:>7.3f} {result['failed']:>6}")
+    best = max(results, key=lambda result: result["images_per_second"])
+    print(f"Best throughput: OFIQ_WORKERS={best['workers']} OFIQ_THREADS_PER_WORKER={best['threads']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
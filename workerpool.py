@@ -0,0 +1,196 @@
+import asyncio
+import contextvars
+import heapq
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from customexceptions import OverloadedException
+
+_current = threading.local()
+
+
+def current_slot() -> Optional[int]:
+    # Slot of the pool job running on this thread; None outside the pool
+    return getattr(_current, "slot", None)
+
+
+def in_current_job(fn: Callable) -> Callable:
+    # Wraps `fn` to run on a helper thread as part of the calling pool job:
+    # with the job's slot and a copy of its context
+    slot, context = current_slot(), contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        _current.slot = slot
+        try:
+            return context.run(fn, *args, **kwargs)
+        finally:
+            _current.slot = None
+
+    return run
+
+
+class WorkerPool:
+    # Bounded set of worker threads that each drive one OFIQ run at a time.
+    # Jobs run in a copy of the submitter's context so log records emitted
+    # from a worker keep the request id.
+    # Up to `workers` jobs run at once; resize() changes that between 1 and
+    # max_workers (see autoscaler.py). Every running job holds a slot number
+    # below `workers`, lowest free first, so per-worker state such as a
+    # loaded engine can be kept per slot. When a shrink retires a slot,
+    # on_retire(slot) is called once no job holds it any more.
+    # set_limit() caps how many of the slots run jobs at the same time
+    # without retiring any (see concurrencylimit.py).
+    def __init__(self, workers: int, max_queue: int, max_workers: Optional[int] = None,
+                 on_retire: Optional[Callable[[int], None]] = None) -> None:
+        self.workers = workers
+        self.max_workers = max(workers, max_workers or workers)
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ofiq-worker")
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._free_slots: List[int] = list(range(workers))  # heap
+        self._busy_slots: Set[int] = set()
+        self._on_retire = on_retire
+        self.limit: Optional[int] = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self._started_at: Dict[int, float] = {}  # worker thread id -> job start time
+        self._waits: Deque[Tuple[float, float]] = deque(maxlen=1000)  # (started at, seconds queued)
+        self.accepting = True
+        self._aborting = False
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if not self.accepting:
+                raise OverloadedException(error_message="Service is shutting down, retry on another instance")
+            if self.queued >= self.max_queue:
+                raise OverloadedException(error_message="OFIQ queue is full, retry later")
+            self.queued += 1
+        return self._executor.submit(self._run, contextvars.copy_context(), time.monotonic(), fn, args, kwargs)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _run(self, context: contextvars.Context, submitted: float, fn: Callable, args: tuple, kwargs: dict):
+        ident = threading.get_ident()
+        with self._lock:
+            # After a shrink there are more threads than slots; the extra
+            # ones wait here with their job still counted as queued
+            while (not self._free_slots or self.running >= self._concurrency()) and not self._aborting:
+                self._slot_freed.wait()
+            self.queued -= 1
+            if self._aborting:
+                raise OverloadedException(error_message="Service is shutting down, retry on another instance")
+            slot = heapq.heappop(self._free_slots)
+            self._busy_slots.add(slot)
+            self.running += 1
+            started = time.monotonic()
+            self._started_at[ident] = started
+            self._waits.append((started, started - submitted))
+        _current.slot = slot
+        try:
+            return context.run(fn, *args, **kwargs)
+        finally:
+            _current.slot = None
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                del self._started_at[ident]
+                self._busy_slots.discard(slot)
+                retired = slot >= self.workers
+                if not retired:
+                    heapq.heappush(self._free_slots, slot)
+                    self._slot_freed.notify()
+            if retired and self._on_retire is not None:
+                self._on_retire(slot)
+
+    def resize(self, workers: int) -> int:
+        # Changes how many jobs run at once, clamped to 1..max_workers.
+        # Running jobs above the new size finish first. Returns the new size.
+        workers = max(1, min(workers, self.max_workers))
+        with self._lock:
+            previous, self.workers = self.workers, workers
+            for slot in range(previous, workers):
+                if slot not in self._busy_slots and slot not in self._free_slots:
+                    heapq.heappush(self._free_slots, slot)
+            retired = [slot for slot in self._free_slots if slot >= workers]
+            self._free_slots = [slot for slot in self._free_slots if slot < workers]
+            heapq.heapify(self._free_slots)
+            self._slot_freed.notify_all()
+        if self._on_retire is not None:
+            for slot in retired:
+                self._on_retire(slot)
+        return workers
+
+    def _concurrency(self) -> int:
+        return min(self.workers, self.limit) if self.limit is not None else self.workers
+
+    def set_limit(self, limit: Optional[int]) -> None:
+        # None lets all `workers` slots run
+        with self._lock:
+            self.limit = limit
+            self._slot_freed.notify_all()
+
+    def wait_times(self, window: float) -> List[float]:
+        # How long the jobs started in the last `window` seconds were queued
+        horizon = time.monotonic() - window
+        with self._lock:
+            return [waited for started, waited in self._waits if started >= horizon]
+
+    def prestart(self) -> None:
+        # ThreadPoolExecutor creates threads lazily; park one job on every
+        # worker at once so all threads exist before the first request.
+        barrier = threading.Barrier(self.workers)
+        futures = [self._executor.submit(barrier.wait) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def stalled_workers(self, older_than: float) -> int:
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for started in self._started_at.values() if now - started > older_than)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            oldest = max((now - started for started in self._started_at.values()), default=0.0)
+            return {
+                "workers": self.workers,
+                "max_workers": self.max_workers,
+                "concurrency": self._concurrency(),
+                "queued": self.queued,
+                "max_queue": self.max_queue,
+                "running": self.running,
+                "completed": self.completed,
+                "oldest_running_seconds": oldest,
+            }
+
+    def close(self) -> None:
+        # Stop admitting new jobs; already queued jobs still run
+        with self._lock:
+            self.accepting = False
+
+    def drain(self, timeout: float) -> bool:
+        # Wait for queued and running jobs to finish. Returns False if some
+        # were still outstanding when the timeout expired.
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self.queued == 0 and self.running == 0:
+                    return True
+            time.sleep(0.1)
+        return False
+
+    def abort_pending(self) -> None:
+        # Jobs that have not started yet fail with a retryable 503 instead
+        # of being run
+        with self._lock:
+            self._aborting = True
+            self._slot_freed.notify_all()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)